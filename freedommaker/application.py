@@ -5,22 +5,29 @@ Command line application wrapper over image builder.
 """
 
 import argparse
+import calendar
 import datetime
 import logging
 import logging.config
 import os
+import sys
 
 import freedommaker
 
+from . import builders, library, preflight
 from .builder import ImageBuilder
 
 IMAGE_SIZE = '7800M'
+IMAGE_SIZE_MARGIN = '512M'
 BUILD_MIRROR = 'http://deb.debian.org/debian'
 MIRROR = 'http://deb.debian.org/debian'
 DISTRIBUTION = 'bullseye'
 BUILD_DIR = 'build'
 LOG_LEVEL = 'debug'
 HOSTNAME = 'libreserver'
+JOBS = 4
+LIBRESERVER_REPOSITORY = 'https://gitlab.com/bashrc2/libreserver.git'
+LIBRESERVER_BRANCH = 'bullseye'
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -34,6 +41,9 @@ class Application(object):
     def run(self):
         """Parse the command line args and execute the command."""
         self.parse_arguments()
+        if self.arguments.list_targets:
+            print('\n'.join(builders.get_target_names()))
+            return
 
         self.setup_logging()
         logger.info('Freedom Maker version - %s', freedommaker.__version__)
@@ -44,24 +54,53 @@ class Application(object):
         except os.error:
             pass
 
+        if self.arguments.reproducible:
+            os.environ['SOURCE_DATE_EPOCH'] = str(
+                self.arguments.source_date_epoch)
+
+        if not self.arguments.skip_preflight:
+            self.run_preflight_checks()
+
+        library.reclaim_loop_devices()
+
         for target in self.arguments.targets:
             logger.info('Building target - %s', target)
 
             cls = ImageBuilder.get_builder_class(target)
-            if not cls:
-                logger.warning('Unknown target - %s', target)
-                continue
-
             builder = cls(self.arguments)
             try:
+                fingerprint = builder.get_fingerprint()
+                if not self.arguments.force and \
+                   builder.is_built(fingerprint):
+                    logger.info('Target up to date, skipping - %s', target)
+                    continue
+
                 builder.build()
+                builder.write_fingerprint(fingerprint)
                 logger.info('Target complete - %s', target)
             except:  # noqa: E722
                 logger.error('Target failed - %s', target)
                 raise
 
-    def parse_arguments(self):
-        """Parse command line arguments."""
+    def run_preflight_checks(self):
+        """Check that the host can build the selected targets."""
+        builder_classes = [
+            builders.get_builder_class(target)
+            for target in self.arguments.targets
+        ]
+        checks = preflight.get_checks(builder_classes, self.arguments)
+        cache_dir = self.arguments.cache_dir or os.path.join(
+            self.arguments.build_dir, 'cache')
+        failures = preflight.run_checks(checks, cache_dir)
+        if failures:
+            logger.error('Build host is missing requirements:')
+            for failure in failures:
+                logger.error('  %s', failure)
+
+            sys.exit(-1)
+
+    def parse_arguments(self, args=None):
+        """Parse command line arguments, from sys.argv if args is None."""
         build_stamp = datetime.datetime.today().strftime('%Y-%m-%d')
 
         parser = argparse.ArgumentParser(
@@ -69,10 +108,23 @@ class Application(object):
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
         parser.add_argument('--build-stamp', default=build_stamp,
                             help='Build stamp to use on image file names')
-        parser.add_argument('--image-size', default=IMAGE_SIZE,
-                            help='Size of the image to build')
-        parser.add_argument('--build-mirror', default=BUILD_MIRROR,
-                            help='Debian mirror to use for building')
+        parser.add_argument(
+            '--image-size', default=IMAGE_SIZE,
+            help='Size of the image to build, "auto" to shrink the image to '
+            'its contents after building and grow it on first boot')
+        parser.add_argument(
+            '--image-size-margin', default=IMAGE_SIZE_MARGIN,
+            help='Free space to leave in the root file system when image size '
+            'is "auto"')
+        parser.add_argument(
+            '--build-mirror', default=BUILD_MIRROR,
+            help='Debian mirror to use for building, may be a local '
+            'directory')
+        parser.add_argument(
+            '--snapshot',
+            help='Build from a snapshot of the Debian archive at a time like '
+            '20210101T000000Z as used by snapshot.debian.org, "now" for the '
+            'current time. Recorded in the build profile for replaying.')
         parser.add_argument('--mirror', default=MIRROR,
                             help='Debian mirror to use in built image')
         parser.add_argument('--distribution', default=DISTRIBUTION,
@@ -92,9 +144,19 @@ class Application(object):
             'stable images by default')
         parser.add_argument('--disable-backports', action='store_true',
                             help='Disable backports in the image')
+        parser.add_argument(
+            '--libreserver-repository', default=LIBRESERVER_REPOSITORY,
+            help='Git repository of LibreServer to install in the image')
+        parser.add_argument('--libreserver-branch',
+                            default=LIBRESERVER_BRANCH,
+                            help='Branch of LibreServer to install')
         parser.add_argument(
             '--build-dir', default=BUILD_DIR,
             help='Directory to build images and create log file')
+        parser.add_argument(
+            '--cache-dir',
+            help='Directory to keep data reused across builds in '
+            '(default: cache/ inside build directory)')
         parser.add_argument(
             '--log-level', default=LOG_LEVEL, help='Log level',
             choices=('critical', 'error', 'warn', 'info', 'debug'))
@@ -105,19 +167,110 @@ class Application(object):
             help='Sign the images with default GPG key after building')
         parser.add_argument(
             '--force', action='store_true',
-            help='Force rebuild of images even when required image exists')
+            help='Force rebuild of images even when images built from the '
+            'same inputs exist')
         parser.add_argument(
             '--build-in-ram', action='store_true',
             help='Build the image in RAM so that it is faster, requires '
             'free RAM about the size of disk image')
+        parser.add_argument(
+            '--share-base-rootfs', action='store_true',
+            help='Build the root file system common to boards of an '
+            'architecture once and reuse it for each board')
+        parser.add_argument(
+            '--jobs', type=int, default=JOBS,
+            help='Number of independent build steps to run in parallel')
+        parser.add_argument(
+            '--reproducible', action='store_true',
+            help='Build images that are the same for the same inputs, using '
+            'SOURCE_DATE_EPOCH or the time of --snapshot for timestamps')
         parser.add_argument('--skip-compression', action='store_true',
                             help='Do not compress the generated image')
+        parser.add_argument(
+            '--empty-apt-lists', action='store_true',
+            help='Ship the image without apt package lists, they are '
+            'downloaded by the first apt-get update on the device')
+        parser.add_argument(
+            '--chunk-store',
+            help='Directory of a deduplicating chunk store to add raw images '
+            'to, writing a chunk index next to each image')
+        parser.add_argument(
+            '--delta', action='store_true',
+            help='Create a binary delta of each raw image from the previous '
+            'build of the same target, kept in the cache directory')
         parser.add_argument('--with-build-dep', action='store_true',
                             help='Include build dependencies in the image')
-        parser.add_argument('targets', nargs='+',
+        parser.add_argument(
+            '--skip-preflight', action='store_true',
+            help='Do not check that the build host has the required tools '
+            'and kernel features before building')
+        parser.add_argument('--list-targets', action='store_true',
+                            help='List the image targets that can be built')
+        parser.add_argument('targets', nargs='*',
                             help='Image targets to build')
 
-        self.arguments = parser.parse_args()
+        self.arguments = parser.parse_args(args)
+        if not self.arguments.targets and not self.arguments.list_targets:
+            parser.error('the following arguments are required: targets')
+
+        if self.arguments.jobs < 1:
+            parser.error('--jobs must be at least 1')
+
+        unknown_targets = [
+            target for target in self.arguments.targets
+            if target not in builders.TARGETS
+        ]
+        if unknown_targets:
+            parser.error('unknown targets: {}'.format(
+                ', '.join(unknown_targets)))
+
+        if os.path.isdir(self.arguments.build_mirror):
+            self.arguments.build_mirror = 'file://' + os.path.abspath(
+                self.arguments.build_mirror)
+
+        if self.arguments.snapshot:
+            if self.arguments.build_mirror != BUILD_MIRROR:
+                parser.error('--snapshot and --build-mirror can not be used '
+                             'together')
+
+            try:
+                snapshot = library.get_snapshot_id(self.arguments.snapshot)
+            except ValueError as exception:
+                parser.error(str(exception))
+
+            # All targets of a run use the same snapshot
+            self.arguments.snapshot = snapshot
+            self.arguments.build_mirror = library.SNAPSHOT_MIRROR.format(
+                snapshot)
+
+        self.arguments.source_date_epoch = None
+        if self.arguments.reproducible:
+            self.setup_reproducible_build(parser, build_stamp)
+
+    def setup_reproducible_build(self, parser, default_build_stamp):
+        """Decide the timestamp of a reproducible build and its settings."""
+        epoch = os.environ.get('SOURCE_DATE_EPOCH')
+        if epoch is None and self.arguments.snapshot:
+            epoch = calendar.timegm(
+                datetime.datetime.strptime(
+                    self.arguments.snapshot,
+                    library.SNAPSHOT_FORMAT).timetuple())
+
+        if epoch is None:
+            parser.error('--reproducible requires SOURCE_DATE_EPOCH to be set '
+                         'or --snapshot')
+
+        try:
+            self.arguments.source_date_epoch = int(epoch)
+        except ValueError:
+            parser.error('Invalid SOURCE_DATE_EPOCH: ' + epoch)
+
+        if self.arguments.build_stamp == default_build_stamp:
+            self.arguments.build_stamp = datetime.datetime.utcfromtimestamp(
+                self.arguments.source_date_epoch).strftime('%Y-%m-%d')
+
+        # Parallel steps make the layout of file systems vary
+        self.arguments.jobs = 1
 
     def setup_logging(self):
         """Setup logging."""
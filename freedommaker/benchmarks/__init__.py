@@ -0,0 +1,7 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Benchmarks of Freedom Maker's image building.
+
+Each module is runnable with 'python3 -m freedommaker.benchmarks.<module>'
+and prints its results as JSON.
+"""
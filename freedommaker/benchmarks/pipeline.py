@@ -0,0 +1,381 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Benchmark of the orchestration overhead of the image build pipeline.
+
+The build steps of each target are run as in a real build, but every command
+is handled by a stand-in for library.run() that records it, sleeps for a
+simulated latency and returns made up output. The file system of the image is
+a plain directory with a skeleton of the files that the steps edit. Loop
+devices are not attached.
+
+The result lists, for each target and step, the time spent in Freedom Maker
+itself, the number of processes that would be spawned, the number of chroot
+invocations and the critical path projected from the simulated latencies.
+
+Usage: python3 -m freedommaker.benchmarks.pipeline [--latency apt-get=0.5]
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+import freedommaker
+
+from .. import builders, library, scheduler, utils
+from ..application import Application
+
+# Files edited by build steps that debootstrap would have created
+FAKE_ROOTFS_FILES = {
+    'etc/apt/sources.list': '',
+    'etc/crontab': '',
+    'etc/fstab': '',
+    'etc/hosts': '127.0.0.1 localhost\n',
+    'etc/initramfs-tools/update-initramfs.conf': 'update_initramfs=yes\n',
+    'home/admin/.bashrc': '',
+}
+FAKE_ROOTFS_DIRECTORIES = [
+    'etc/apt/apt.conf.d', 'etc/dpkg/dpkg.cfg.d', 'etc/kernel/postinst.d',
+    'etc/kernel/postrm.d', 'etc/network/interfaces.d', 'etc/ssh',
+    'etc/systemd/network', 'root', 'tmp', 'usr/bin', 'usr/sbin',
+    'var/lib/apt/lists', 'var/www/html'
+]
+FAKE_BOOT_LOADER_FILES = [
+    'usr/lib/linux-image-benchmark/dtb',
+    'usr/lib/u-boot/am335x_boneblack/MLO',
+    'usr/lib/u-boot/am335x_boneblack/u-boot.img',
+]
+FAKE_BOOT_LOADER_SIZE = 1024
+
+# Step name given to commands run while cleaning up after the steps
+TEARDOWN = 'teardown'
+
+PRECISION = 4
+
+logger = logging.getLogger(__name__)
+
+
+class CommandRecorder():
+    """Stand-in for library.run() that records commands instead."""
+    def __init__(self, latencies, default_latency):
+        """Initialize the recorder.
+
+        latencies maps command names, such as 'apt-get', to the seconds that
+        running them is simulated to take. Commands run in a chroot are
+        looked up by the command run inside the chroot.
+
+        """
+        self.latencies = latencies
+        self.default_latency = default_latency
+        self.steps = {}
+        self.partition_count = 0
+        self.loop_device_count = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def wrap_step(self, step):
+        """Make commands run by a step be recorded under its name."""
+        method = step.method
+
+        def run_step():
+            self._local.step = step.name
+            try:
+                method()
+            finally:
+                self._local.step = None
+
+        step.method = run_step
+
+    def _get_step_record(self, name):
+        """Return the record of commands of a step."""
+        return self.steps.setdefault(name, {
+            'spawns': 0,
+            'chroot_invocations': 0,
+            'simulated_duration': 0,
+        })
+
+    def __call__(self, *args, **kwargs):
+        """Record commands, simulate their latency and fake output."""
+        output = b''
+        for command in args:
+            command = [str(part) for part in command]
+            is_chroot = command[0] == 'chroot'
+            inner_command = command[2:] if is_chroot else command
+            name = os.path.basename(inner_command[0])
+            latency = self.latencies.get(name, self.default_latency)
+            time.sleep(latency)
+            with self._lock:
+                record = self._get_step_record(
+                    getattr(self._local, 'step', None) or TEARDOWN)
+                record['spawns'] += 1
+                record['chroot_invocations'] += int(is_chroot)
+                record['simulated_duration'] += latency
+
+            output = self._handle(command, inner_command) or b''
+
+        return output
+
+    def _handle(self, command, inner_command):
+        """Apply the effects of a command and return its output."""
+        name = os.path.basename(inner_command[0])
+        if name == 'qemu-debootstrap':
+            create_fake_rootfs(inner_command[-2])
+        elif name == 'qemu-img' and inner_command[1] == 'create':
+            with open(inner_command[-2], 'wb') as file_handle:
+                file_handle.truncate(utils.parse_disk_size(
+                    inner_command[-1]))
+        elif name == 'parted' and 'mklabel' in inner_command:
+            self.partition_count = 0
+        elif name == 'parted' and 'mkpart' in inner_command:
+            self.partition_count += 1
+        elif name == 'kpartx' and '-asv' in inner_command:
+            device = os.path.basename(inner_command[-1])
+            return ''.join(
+                'add map {}p{} (253:{}): 0 2048 linear 7:0 2048\n'.format(
+                    device, number, number)
+                for number in range(1, self.partition_count + 1)).encode()
+        elif name == 'blkid':
+            return b'00000000-0000-0000-0000-000000000000\n'
+        elif name == 'git' and 'rev-parse' in inner_command:
+            return b'0' * 40 + b'\n'
+        elif name == 'tar' and '--create' in inner_command:
+            archive = inner_command[inner_command.index('--file') + 1]
+            open(archive, 'w').close()
+        elif name == 'bash' and command[0] == 'chroot':
+            match = re.search(r'DESTDIR=(\S+)', inner_command[-1])
+            if match:
+                destination = os.path.join(command[1],
+                                           match.group(1).lstrip('/'))
+                os.makedirs(destination, exist_ok=True)
+                open(os.path.join(destination, 'installed'), 'w').close()
+
+        return None
+
+    def attach_loop_device(self, backing_file):
+        """Stand-in for loop_devices.attach()."""
+        with self._lock:
+            self.loop_device_count += 1
+            return '/dev/loop-benchmark{}'.format(self.loop_device_count)
+
+
+def create_fake_rootfs(target):
+    """Create the files that build steps expect after debootstrap."""
+    for path in FAKE_ROOTFS_DIRECTORIES:
+        os.makedirs(os.path.join(target, path), exist_ok=True)
+
+    for path, content in FAKE_ROOTFS_FILES.items():
+        full_path = os.path.join(target, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as file_handle:
+            file_handle.write(content)
+
+    # Boot loader files that installed packages would have provided
+    for path in get_boot_loader_paths():
+        full_path = os.path.join(target, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as file_handle:
+            file_handle.write(bytes(FAKE_BOOT_LOADER_SIZE))
+
+
+def get_boot_loader_paths():
+    """Return paths of boot loader files copied from the image by builders."""
+    paths = set(FAKE_BOOT_LOADER_FILES)
+    for target in builders.get_target_names():
+        cls = builders.get_builder_class(target)
+        if getattr(cls, 'u_boot_path', None):
+            paths.add(cls.u_boot_path.lstrip('/'))
+
+        if getattr(cls, 'uboot_variant', None):
+            paths.add('usr/lib/u-boot/{}/u-boot.bin'.format(
+                cls.uboot_variant))
+
+    return sorted(paths)
+
+
+def fetch_fake_source_package(state, package, cache_dir):
+    """Stand-in for library.fetch_source_package()."""
+    directory = os.path.join(cache_dir, 'sources', package)
+    os.makedirs(os.path.join(directory, 'boot'), exist_ok=True)
+    open(os.path.join(directory, 'boot', 'bootcode.bin'), 'w').close()
+    return directory
+
+
+def _round(value):
+    """Round a duration for stable output."""
+    return round(value, PRECISION)
+
+
+def benchmark_target(target, arguments, recorder):
+    """Run the build steps of a target and return its measurements."""
+    directory = tempfile.mkdtemp(prefix='freedom-maker-benchmark-')
+    recorder.steps = {}
+    library._updated_git_mirrors.clear()
+    application = Application()
+    application.parse_arguments([
+        '--build-dir', directory, '--jobs',
+        str(arguments.jobs), '--skip-preflight', '--skip-compression',
+        target
+    ])
+    builder = builders.get_builder_class(target)(application.arguments)
+    backend = builder.builder_backends[builder.builder_backend]
+    get_steps = backend._get_steps
+    steps = []
+
+    def get_wrapped_steps():
+        """Return the steps of the build with commands recorded."""
+        steps.extend(get_steps())
+        for step in steps:
+            recorder.wrap_step(step)
+
+        return steps
+
+    start = time.monotonic()
+    try:
+        with patch.object(backend, '_get_steps', get_wrapped_steps):
+            backend.make_image()
+    finally:
+        duration = time.monotonic() - start
+        mount_point = backend.state.get('mount_point')
+        if mount_point and mount_point.startswith(tempfile.gettempdir()):
+            shutil.rmtree(mount_point, ignore_errors=True)
+
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return get_target_result(backend.state['profile'], steps, recorder,
+                             duration, arguments.timings)
+
+
+def get_target_result(profile, steps, recorder, duration, timings=True):
+    """Return the measurements of a target from the build profile."""
+    result_steps = {}
+    simulated_profile = {'steps': {}}
+    for name, record in sorted(recorder.steps.items()):
+        step_result = {
+            'spawns': record['spawns'],
+            'chroot_invocations': record['chroot_invocations'],
+        }
+        simulated = record['simulated_duration']
+        simulated_profile['steps'][name] = {'duration': simulated}
+        if timings:
+            step_duration = profile['steps'].get(name, {}).get('duration')
+            step_result['simulated_duration'] = _round(simulated)
+            if step_duration is not None:
+                step_result['duration'] = _round(step_duration)
+                step_result['overhead'] = _round(step_duration - simulated)
+
+        result_steps[name] = step_result
+
+    path, projected = scheduler.critical_path(steps, simulated_profile)
+    simulated_total = sum(record['simulated_duration']
+                          for record in recorder.steps.values())
+    result = {
+        'steps': result_steps,
+        'spawns': sum(step['spawns'] for step in result_steps.values()),
+        'chroot_invocations': sum(step['chroot_invocations']
+                                  for step in result_steps.values()),
+        'projected_critical_path': path,
+    }
+    if timings:
+        result.update({
+            'duration': _round(duration),
+            'simulated_duration': _round(simulated_total),
+            'overhead': _round(duration - simulated_total),
+            'critical_path': profile.get('critical_path', []),
+            'critical_path_duration': _round(
+                profile.get('critical_path_duration', 0)),
+            'projected_critical_path_duration': _round(projected),
+        })
+
+    return result
+
+
+def run_benchmark(arguments):
+    """Benchmark the selected targets and return the results."""
+    recorder = CommandRecorder(arguments.latencies, arguments.default_latency)
+    patches = [
+        patch('freedommaker.library.run', recorder),
+        patch('freedommaker.library.fetch_source_package',
+              fetch_fake_source_package),
+        patch('freedommaker.loop_devices.attach',
+              recorder.attach_loop_device),
+        patch('freedommaker.loop_devices.detach'),
+        patch('freedommaker.loop_devices.get_leaked_devices',
+              return_value=[]),
+    ]
+    results = {}
+    with contextlib.ExitStack() as stack:
+        for patcher in patches:
+            stack.enter_context(patcher)
+
+        # Keep standard output for the results
+        stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+
+        for target in arguments.targets or builders.get_target_names():
+            logger.info('Benchmarking target %s', target)
+            results[target] = benchmark_target(target, arguments, recorder)
+
+    return {
+        'version': freedommaker.__version__,
+        'settings': {
+            'jobs': arguments.jobs,
+            'default_latency': arguments.default_latency,
+            'latencies': arguments.latencies,
+        },
+        'targets': results,
+    }
+
+
+def parse_latency(value):
+    """Parse a COMMAND=SECONDS latency argument."""
+    name, separator, seconds = value.partition('=')
+    if not separator:
+        raise argparse.ArgumentTypeError(
+            'Expected COMMAND=SECONDS, got ' + value)
+
+    return name, float(seconds)
+
+
+def main():
+    """Run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the orchestration overhead of image builds')
+    parser.add_argument(
+        '--latency', action='append', type=parse_latency, default=[],
+        metavar='COMMAND=SECONDS',
+        help='Simulated run time of a command, may be repeated')
+    parser.add_argument(
+        '--default-latency', type=float, default=0.0,
+        help='Simulated run time of other commands (default: %(default)s)')
+    parser.add_argument(
+        '--jobs', type=int, default=4,
+        help='Number of build steps to run in parallel (default: '
+        '%(default)s)')
+    parser.add_argument(
+        '--no-timings', dest='timings', action='store_false',
+        help='Only report counts, which are the same on every run')
+    parser.add_argument('--output', help='File to write results to')
+    parser.add_argument('targets', nargs='*',
+                        help='Targets to benchmark (default: all)')
+    arguments = parser.parse_args()
+    arguments.latencies = dict(arguments.latency)
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run_benchmark(arguments)
+    output = json.dumps(results, indent=4, sort_keys=True) + '\n'
+    if arguments.output:
+        with open(arguments.output, 'w') as file_handle:
+            file_handle.write(output)
+    else:
+        sys.stdout.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,575 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Benchmark of the primitives of library.py that work on whole images.
+
+The primitives are run on real sparse files at several image sizes. Sample
+images are made of stripes of data read from files under /usr, explicit zeros
+and holes, similar to a freshly built image. No network access is needed.
+
+Sample data is read and each benchmark is set up in forked processes so that
+the memory of the main process stays the same throughout the run. Each timed
+run happens in a process forked from the setup process. The peak resident set
+size of the commands it runs is taken from the usage of its children. The
+kernel counts the memory of the process that started a command in the peak of
+the command, so it can't be lower than the process_rss reported alongside. For
+work done in Python, only the growth of the peak over the run is reported.
+Primitives whose commands are missing, or that need root for mounting, are
+reported as skipped.
+
+Usage: python3 -m freedommaker.benchmarks.primitives --sizes 64M,1G
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import freedommaker
+
+from .. import builders, library, preflight, utils
+from ..application import Application
+
+STRIPE_SIZE = 4 * 1024 * 1024
+# Contents of each stripe of a sample image, repeated over its size
+STRIPE_PATTERN = ('data', 'data', 'zeros', 'hole')
+SAMPLE_DIRECTORIES = ['/usr/lib', '/usr/share', '/usr/bin']
+
+BOOT_LOADER_PART_SIZE = 1024 * 1024
+BOOT_LOADER_PART_OFFSET = 8192
+FIRST_PARTITION_START = 4 * 1024 * 1024
+
+# Alternatives to the xz -9 of library.compress(): name, command, extension
+COMPRESSORS = [
+    ('xz-1', ['xz', '--no-warn', '--threads=0', '-1', '--force'], '.xz'),
+    ('xz-6', ['xz', '--no-warn', '--threads=0', '-6', '--force'], '.xz'),
+    ('zstd-3', ['zstd', '--threads=0', '-3', '--force', '--rm', '-q'],
+     '.zst'),
+    ('zstd-19', ['zstd', '--threads=0', '-19', '--force', '--rm', '-q'],
+     '.zst'),
+    ('gzip-6', ['gzip', '-6', '--force'], '.gz'),
+]
+
+PRECISION = 4
+MEBIBYTE = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class Benchmark():
+    """A primitive to measure on images of a given size."""
+    def __init__(self, name, method, commands=(), needs_root=False):
+        """Initialize the benchmark.
+
+        method is called with a context and returns a dictionary with the
+        timed callable under 'run', the bytes it processes under 'bytes' and
+        optionally a callable under 'report' that returns more results after
+        the run.
+
+        """
+        self.name = name
+        self.method = method
+        self.commands = commands
+        self.needs_root = needs_root
+
+    def get_skip_reason(self):
+        """Return why the benchmark can't run on this host or None."""
+        checks = [preflight.check_command(command)
+                  for command in self.commands]
+        if self.needs_root:
+            checks.append(preflight.check_root())
+
+        return next((check for check in checks if check), None)
+
+
+def _get_memory_status(field):
+    """Return a memory figure of this process in bytes."""
+    with open('/proc/self/status') as file_handle:
+        for line in file_handle:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+
+    return None
+
+
+def run_in_process(method, *args, **kwargs):
+    """Run a method in a forked process and return its result.
+
+    Memory used by the method is freed with the process. The result must be
+    serializable to JSON.
+
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            output = {'result': method(*args, **kwargs)}
+        except BaseException as exception:  # pylint: disable=broad-except
+            output = {'error': str(exception) or type(exception).__name__}
+
+        with os.fdopen(write_fd, 'w') as file_handle:
+            json.dump(output, file_handle)
+
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as file_handle:
+        output = file_handle.read()
+
+    os.waitpid(pid, 0)
+    output = json.loads(output) if output else {'error': 'Worker failed'}
+    if 'error' in output:
+        raise RuntimeError(output['error'])
+
+    return output['result']
+
+
+def _measure(method, *args, **kwargs):
+    """Run a method and return its duration and memory use."""
+    # Reset the peak resident set size inherited from the parent
+    with open('/proc/self/clear_refs', 'w') as file_handle:
+        file_handle.write('5')
+
+    start_rss = _get_memory_status('VmRSS')
+    start = time.monotonic()
+    method(*args, **kwargs)
+    return {
+        'duration': time.monotonic() - start,
+        'commands_peak_rss': resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        'process_rss': start_rss,
+        'rss_increase': max(_get_memory_status('VmHWM') - start_rss, 0),
+    }
+
+
+def measure(method, *args, **kwargs):
+    """Run a method in a forked process and return duration and memory use.
+
+    commands_peak_rss is the largest peak resident set size of the commands
+    run by the method, process_rss the resident set size of the process when
+    it started and rss_increase how much the peak resident set size of the
+    process grew while running the method.
+
+    """
+    try:
+        return run_in_process(_measure, method, *args, **kwargs)
+    except RuntimeError as exception:
+        return {'error': str(exception)}
+
+
+def get_allocated_size(path):
+    """Return the number of bytes allocated on disk for a file."""
+    return os.stat(path).st_blocks * 512
+
+
+def _iter_sample_data():
+    """Yield contents of files under sample directories, forever."""
+    while True:
+        found = False
+        for directory in SAMPLE_DIRECTORIES:
+            for root, directories, files in os.walk(directory):
+                directories.sort()
+                for file_name in sorted(files):
+                    path = os.path.join(root, file_name)
+                    if os.path.islink(path) or not os.path.isfile(path):
+                        continue
+
+                    try:
+                        with open(path, 'rb') as file_handle:
+                            data = file_handle.read(STRIPE_SIZE)
+                    except OSError:
+                        continue
+
+                    if data:
+                        found = True
+                        yield data
+
+        if not found:
+            raise ValueError('No sample data found in ' +
+                             ', '.join(SAMPLE_DIRECTORIES))
+
+
+def read_sample_data(size, sample_data):
+    """Return the given number of bytes of sample data."""
+    parts = []
+    remaining = size
+    while remaining > 0:
+        data = next(sample_data)[:remaining]
+        parts.append(data)
+        remaining -= len(data)
+
+    return b''.join(parts)
+
+
+def create_sample_image(path, size):
+    """Create a sparse image of data, zeros and holes."""
+    logger.info('Creating sample image %s of %d bytes', path, size)
+    sample_data = _iter_sample_data()
+    with open(path, 'wb') as file_handle:
+        file_handle.truncate(size)
+        for index, offset in enumerate(range(0, size, STRIPE_SIZE)):
+            kind = STRIPE_PATTERN[index % len(STRIPE_PATTERN)]
+            length = min(STRIPE_SIZE, size - offset)
+            if kind == 'hole':
+                continue
+
+            file_handle.seek(offset)
+            if kind == 'zeros':
+                file_handle.write(bytes(length))
+            else:
+                file_handle.write(read_sample_data(length, sample_data))
+
+
+def copy_sample_image(context, name):
+    """Return the path to a new copy of the sample image."""
+    path = os.path.join(context['directory'], name)
+    library.copy_file(context['sample_image'], path)
+    return path
+
+
+def benchmark_create_image(context):
+    """Create an empty sparse image."""
+    state = {'image_file': os.path.join(context['directory'], 'create.img')}
+    return {
+        'run': lambda: library.create_image(state, context['size_name']),
+        'bytes': context['size'],
+    }
+
+
+def benchmark_copy_image(context):
+    """Copy an image keeping it sparse."""
+    state = {'success': True}
+    target = os.path.join(context['directory'], 'copy.img')
+    return {
+        'run': lambda: library.copy_image(state, context['sample_image'],
+                                          target),
+        'bytes': context['size'],
+        'report': lambda: {'allocated': get_allocated_size(target)},
+    }
+
+
+def benchmark_sparsify_image(context):
+    """Turn zeros of an image into holes."""
+    image_file = copy_sample_image(context, 'sparsify.img')
+    return {
+        'run': lambda: library.sparsify_image(image_file),
+        'bytes': context['size'],
+        'report': lambda: {'allocated': get_allocated_size(image_file)},
+    }
+
+
+def _mount_dirty_filesystem(context, name):
+    """Mount an ext4 image whose free space holds deleted data."""
+    image_file = os.path.join(context['directory'], name)
+    open(image_file, 'w').close()
+    os.truncate(image_file, context['size'])
+    library.run(['mkfs.ext4', '-q', '-F', image_file])
+    mount_point = tempfile.mkdtemp(dir=context['directory'])
+    library.run(['mount', '-o', 'loop', image_file, mount_point])
+    context['cleanups'].append(lambda: os.rmdir(mount_point))
+    context['cleanups'].append(
+        lambda: library.run(['umount', mount_point], ignore_fail=True))
+
+    dirty_file = os.path.join(mount_point, 'dirty')
+    with open(dirty_file, 'wb') as file_handle:
+        sample_data = _iter_sample_data()
+        for _ in range(context['size'] // 2 // STRIPE_SIZE):
+            file_handle.write(read_sample_data(STRIPE_SIZE, sample_data))
+
+    os.remove(dirty_file)
+    os.sync()
+    return image_file, {'mount_point': mount_point}
+
+
+def benchmark_fill_free_space_with_zeros(context):
+    """Overwrite the free space of a file system with zeros."""
+    image_file, state = _mount_dirty_filesystem(context, 'fill.img')
+    return {
+        'run': lambda: library.fill_free_space_with_zeros(state),
+        'bytes': context['size'],
+        'report': lambda: {'allocated': get_allocated_size(image_file)},
+    }
+
+
+def benchmark_fill_and_sparsify(context):
+    """Overwrite the free space with zeros and turn them into holes."""
+    image_file, state = _mount_dirty_filesystem(context, 'fill-sparse.img')
+
+    def run():
+        library.fill_free_space_with_zeros(state)
+        library.run(['umount', state['mount_point']])
+        library.sparsify_image(image_file)
+        library.run(['mount', '-o', 'loop', image_file, state['mount_point']])
+
+    return {
+        'run': run,
+        'bytes': context['size'],
+        'report': lambda: {'allocated': get_allocated_size(image_file)},
+    }
+
+
+def benchmark_fstrim(context):
+    """Discard the free space of a file system, leaving holes."""
+    image_file, state = _mount_dirty_filesystem(context, 'fstrim.img')
+    return {
+        'run': lambda: library.run(['fstrim', state['mount_point']]),
+        'bytes': context['size'],
+        'report': lambda: {'allocated': get_allocated_size(image_file)},
+    }
+
+
+def get_compress_benchmark(name, command, extension):
+    """Return a benchmark method for compressing with a command."""
+    def benchmark_compress(context):
+        """Compress an image."""
+        image_file = copy_sample_image(context, name + '.img')
+        archive_file = image_file + extension
+
+        def run():
+            """Compress with the command or as library.compress() does."""
+            if command:
+                library.run(command + [image_file])
+            else:
+                library.compress(archive_file, image_file)
+
+        def report():
+            """Return size of the compressed image."""
+            output_size = os.path.getsize(archive_file)
+            return {
+                'output_size': output_size,
+                'ratio': round(output_size / context['size'], PRECISION),
+            }
+
+        return {'run': run, 'bytes': context['size'], 'report': report}
+
+    return benchmark_compress
+
+
+def benchmark_install_boot_loader_part(context):
+    """Write a boot loader file before the first partition."""
+    mount_point = tempfile.mkdtemp(dir=context['directory'])
+    part_file = os.path.join(mount_point, 'u-boot.bin')
+    with open(part_file, 'wb') as file_handle:
+        file_handle.write(
+            read_sample_data(BOOT_LOADER_PART_SIZE, _iter_sample_data()))
+
+    state = {
+        'image_file': copy_sample_image(context, 'boot-loader.img'),
+        'mount_point': mount_point,
+        'partition_table_type': 'msdos',
+        'first_partition_start': FIRST_PARTITION_START,
+    }
+    return {
+        'run': lambda: library.install_boot_loader_part(
+            state, 'u-boot.bin', BOOT_LOADER_PART_OFFSET),
+        'bytes': BOOT_LOADER_PART_SIZE,
+    }
+
+
+def get_vm_file_benchmark(target, extension):
+    """Return a benchmark method for converting to a VM image."""
+    def benchmark_create_vm_file(context):
+        """Convert an image into a VM image."""
+        application = Application()
+        application.parse_arguments(
+            ['--build-dir', context['directory'], target])
+        builder = builders.get_builder_class(target)(application.arguments)
+        vm_file = os.path.join(context['directory'], target + extension)
+        return {
+            'run': lambda: builder.create_vm_file(context['sample_image'],
+                                                  vm_file),
+            'bytes': context['size'],
+            'report': lambda: {'output_size': os.path.getsize(vm_file)},
+        }
+
+    return benchmark_create_vm_file
+
+
+def convert_vdi_with_qemu_img(context):
+    """Convert an image into a VDI image using qemu-img."""
+    vm_file = os.path.join(context['directory'], 'qemu-img.vdi')
+    return {
+        'run': lambda: library.run([
+            'qemu-img', 'convert', '-O', 'vdi', context['sample_image'],
+            vm_file
+        ]),
+        'bytes': context['size'],
+        'report': lambda: {'output_size': os.path.getsize(vm_file)},
+    }
+
+
+def get_benchmarks():
+    """Return all the benchmarks."""
+    benchmarks = [
+        Benchmark('create_image', benchmark_create_image, ('qemu-img', )),
+        Benchmark('copy_image', benchmark_copy_image, ('cp', )),
+        Benchmark('sparsify_image', benchmark_sparsify_image,
+                  ('cp', 'fallocate')),
+        Benchmark('fill_free_space_with_zeros',
+                  benchmark_fill_free_space_with_zeros,
+                  ('mkfs.ext4', 'mount', 'dd'), needs_root=True),
+        Benchmark('fill_free_space_with_zeros+sparsify_image',
+                  benchmark_fill_and_sparsify,
+                  ('mkfs.ext4', 'mount', 'dd', 'fallocate'),
+                  needs_root=True),
+        Benchmark('fstrim', benchmark_fstrim, ('mkfs.ext4', 'mount', 'fstrim'),
+                  needs_root=True),
+        Benchmark('compress', get_compress_benchmark('compress', None, '.xz'),
+                  ('cp', 'xz')),
+    ]
+    benchmarks += [
+        Benchmark('compress:' + name,
+                  get_compress_benchmark(name, command, extension),
+                  ('cp', command[0]))
+        for name, command, extension in COMPRESSORS
+    ]
+    benchmarks += [
+        Benchmark('install_boot_loader_part',
+                  benchmark_install_boot_loader_part, ('cp', )),
+        Benchmark('create_vm_file:qcow2',
+                  get_vm_file_benchmark('qemu-amd64', '.qcow2'),
+                  ('qemu-img', )),
+        Benchmark('create_vm_file:vdi',
+                  get_vm_file_benchmark('virtualbox-amd64', '.vdi'),
+                  ('VBoxManage', )),
+        Benchmark('create_vm_file:vdi-qemu-img', convert_vdi_with_qemu_img,
+                  ('qemu-img', )),
+    ]
+    return benchmarks
+
+
+def _round(value):
+    """Round a measurement for stable output."""
+    return round(value, PRECISION)
+
+
+def _run_job(benchmark, context):
+    """Set up a benchmark, measure its run and clean up."""
+    context = dict(context, cleanups=[])
+    try:
+        job = benchmark.method(context)
+        measurement = measure(job['run'])
+        if 'error' not in measurement and 'report' in job:
+            measurement.update(job['report']())
+    finally:
+        for cleanup in reversed(context['cleanups']):
+            cleanup()
+
+    measurement['bytes'] = job['bytes']
+    return measurement
+
+
+def run_benchmark(benchmark, context, repeat):
+    """Run a benchmark and return the fastest of its measurements."""
+    reason = benchmark.get_skip_reason()
+    if reason:
+        return {'skipped': reason}
+
+    measurements = []
+    for _ in range(repeat):
+        directory = tempfile.mkdtemp(dir=context['work_dir'])
+        try:
+            measurement = run_in_process(_run_job, benchmark,
+                                         dict(context, directory=directory))
+        except RuntimeError as exception:
+            measurement = {'error': str(exception)}
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        if 'error' in measurement:
+            return measurement
+
+        measurements.append(measurement)
+
+    result = min(measurements, key=lambda measurement: measurement['duration'])
+    for field in ('commands_peak_rss', 'process_rss', 'rss_increase'):
+        result[field] = max(measurement[field]
+                            for measurement in measurements)
+
+    result['throughput'] = round(
+        result['bytes'] / MEBIBYTE / max(result['duration'], 1e-9), 1)
+    result['duration'] = _round(result['duration'])
+    return result
+
+
+def run_benchmarks(arguments):
+    """Run the selected benchmarks at each size and return the results."""
+    benchmarks = [
+        benchmark for benchmark in get_benchmarks()
+        if not arguments.only or benchmark.name in arguments.only
+    ]
+    work_dir = tempfile.mkdtemp(prefix='freedom-maker-benchmark-',
+                                dir=arguments.directory)
+    results = {}
+    try:
+        for size_name in arguments.sizes:
+            size = utils.parse_disk_size(size_name)
+            sample_image = os.path.join(work_dir, 'sample.img')
+            run_in_process(create_sample_image, sample_image, size)
+            context = {
+                'work_dir': work_dir,
+                'sample_image': sample_image,
+                'size': size,
+                'size_name': size_name,
+            }
+            results[size_name] = {}
+            for benchmark in benchmarks:
+                logger.info('Running %s on %s image', benchmark.name,
+                            size_name)
+                results[size_name][benchmark.name] = run_benchmark(
+                    benchmark, context, arguments.repeat)
+
+            os.remove(sample_image)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'version': freedommaker.__version__,
+        'settings': {
+            'sizes': arguments.sizes,
+            'repeat': arguments.repeat,
+            'stripe_pattern': list(STRIPE_PATTERN),
+            'stripe_size': STRIPE_SIZE,
+        },
+        'results': results,
+    }
+
+
+def main():
+    """Run the benchmarks and print the results as JSON."""
+    names = [benchmark.name for benchmark in get_benchmarks()]
+    parser = argparse.ArgumentParser(
+        description='Benchmark library primitives on real image files')
+    parser.add_argument(
+        '--sizes', type=lambda value: value.split(','),
+        default=['64M', '256M', '1G'],
+        help='Comma separated image sizes (default: 64M,256M,1G)')
+    parser.add_argument(
+        '--repeat', type=int, default=1,
+        help='Number of runs of each benchmark, the fastest is reported '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '--directory',
+        help='Directory to create images in (default: temporary directory)')
+    parser.add_argument('--only', action='append', choices=names,
+                        help='Benchmark to run, may be repeated')
+    parser.add_argument('--output', help='File to write results to')
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run_benchmarks(arguments)
+    output = json.dumps(results, indent=4, sort_keys=True) + '\n'
+    if arguments.output:
+        with open(arguments.output, 'w') as file_handle:
+            file_handle.write(output)
+    else:
+        sys.stdout.write(output)
+
+
+if __name__ == '__main__':
+    main()
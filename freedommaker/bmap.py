@@ -0,0 +1,127 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Create block maps of sparse images in the format used by bmaptool.
+
+A block map lists the ranges of blocks in an image that contain data along
+with their checksums. Flashing tools use it to write only those blocks.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+
+BLOCK_SIZE = 4096
+CHECKSUM_TYPE = 'sha256'
+READ_SIZE = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def get_data_ranges(file_descriptor, size):
+    """Return (start, end) byte ranges of a file that are not holes."""
+    ranges = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(file_descriptor, offset, os.SEEK_DATA)
+        except OSError as exception:
+            # No more data after offset
+            if exception.errno == errno.ENXIO:
+                break
+
+            raise
+
+        end = os.lseek(file_descriptor, start, os.SEEK_HOLE)
+        ranges.append((start, end))
+        offset = end
+
+    return ranges
+
+
+def get_block_ranges(data_ranges, block_size=BLOCK_SIZE):
+    """Return inclusive (first, last) block ranges covering byte ranges."""
+    block_ranges = []
+    for start, end in data_ranges:
+        first = start // block_size
+        last = (end - 1) // block_size
+        if block_ranges and first <= block_ranges[-1][1] + 1:
+            block_ranges[-1] = (block_ranges[-1][0],
+                                max(last, block_ranges[-1][1]))
+        else:
+            block_ranges.append((first, last))
+
+    return block_ranges
+
+
+def _get_checksum(file_descriptor, start, end):
+    """Return the checksum of a range of bytes in a file."""
+    checksum = hashlib.new(CHECKSUM_TYPE)
+    offset = start
+    while offset < end:
+        data = os.pread(file_descriptor, min(READ_SIZE, end - offset), offset)
+        if not data:
+            break
+
+        checksum.update(data)
+        offset += len(data)
+
+    return checksum.hexdigest()
+
+
+def write_bmap(image_file, bmap_file, block_size=BLOCK_SIZE):
+    """Write a block map in bmap format version 2.0 for an image."""
+    logger.info('Creating block map %s for %s', bmap_file, image_file)
+    size = os.path.getsize(image_file)
+    file_descriptor = os.open(image_file, os.O_RDONLY)
+    try:
+        block_ranges = get_block_ranges(
+            get_data_ranges(file_descriptor, size), block_size)
+        ranges = []
+        for first, last in block_ranges:
+            checksum = _get_checksum(file_descriptor, first * block_size,
+                                     min((last + 1) * block_size, size))
+            text = str(first) if first == last else '{}-{}'.format(
+                first, last)
+            ranges.append('        <Range chksum="{}"> {} </Range>\n'.format(
+                checksum, text))
+    finally:
+        os.close(file_descriptor)
+
+    blocks_count = -(-size // block_size)
+    mapped_blocks_count = sum(last - first + 1
+                              for first, last in block_ranges)
+    template = '''<?xml version="1.0" ?>
+<!-- Block map of {image_name}, generated by Freedom Maker. -->
+<bmap version="2.0">
+    <ImageSize> {size} </ImageSize>
+    <BlockSize> {block_size} </BlockSize>
+    <BlocksCount> {blocks_count} </BlocksCount>
+    <MappedBlocksCount> {mapped_blocks_count} </MappedBlocksCount>
+    <ChecksumType> {checksum_type} </ChecksumType>
+    <BmapFileChecksum> {bmap_checksum} </BmapFileChecksum>
+    <BlockMap>
+{ranges}    </BlockMap>
+</bmap>
+'''
+    values = {
+        'image_name': os.path.basename(image_file),
+        'size': size,
+        'block_size': block_size,
+        'blocks_count': blocks_count,
+        'mapped_blocks_count': mapped_blocks_count,
+        'checksum_type': CHECKSUM_TYPE,
+        'ranges': ''.join(ranges),
+    }
+
+    # Checksum of the file is calculated with the checksum itself zeroed
+    digest_size = hashlib.new(CHECKSUM_TYPE).digest_size * 2
+    content = template.format(bmap_checksum='0' * digest_size, **values)
+    bmap_checksum = hashlib.new(CHECKSUM_TYPE, content.encode()).hexdigest()
+    content = template.format(bmap_checksum=bmap_checksum, **values)
+
+    with open(bmap_file, 'w') as file_handle:
+        file_handle.write(content)
+
+    logger.info('Block map lists %d of %d blocks', mapped_blocks_count,
+                blocks_count)
@@ -3,10 +3,13 @@
 Base worker class to run various commands that build the image.
 """
 
+import json
 import logging
 import os
 
-from . import internal, library
+import freedommaker
+
+from . import bmap, chunks, internal, library, utils
 
 # initramfs-tools is a dependency for the kernel-image package. However, when
 # kernel is not installed, as in case of Raspberry Pi image, explicit
@@ -15,9 +18,23 @@ BASE_PACKAGES = [
     'initramfs-tools',
 ]
 
+# Size of the image built when the final size is decided by its contents
+AUTO_IMAGE_SIZE = '7800M'
+
+# Arguments that don't change the images built
+NON_FINGERPRINT_ARGUMENTS = [
+    'build_dir', 'build_in_ram', 'cache_dir', 'force', 'jobs', 'list_targets',
+    'log_level', 'share_base_rootfs', 'skip_preflight', 'targets'
+]
+
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
+def get_build_image_size(image_size):
+    """Return the size of image to build for a requested image size."""
+    return AUTO_IMAGE_SIZE if image_size == 'auto' else image_size
+
+
 class ImageBuilder(object):  # pylint: disable=too-many-instance-attributes
     """Base for all image builders."""
     architecture = None
@@ -38,6 +55,7 @@ class ImageBuilder(object):  # pylint: disable=too-many-instance-attributes
     debootstrap_variant = None
 
     extra_storage_size = '1000M'
+    required_commands = ()
 
     @classmethod
     def get_target_name(cls):
@@ -47,13 +65,9 @@ class ImageBuilder(object):  # pylint: disable=too-many-instance-attributes
     @classmethod
     def get_builder_class(cls, target):
         """Return an builder class given target name."""
-        from . import builders  # noqa: F401, pylint: disable=unused-variable
+        from . import builders
 
-        for subclass in cls.get_subclasses():
-            if subclass.get_target_name() == target:
-                return subclass
-
-        raise ValueError('No such target')
+        return builders.get_builder_class(target)
 
     @classmethod
     def get_subclasses(cls):
@@ -65,8 +79,11 @@ class ImageBuilder(object):  # pylint: disable=too-many-instance-attributes
     def __init__(self, arguments):
         """Initialize object."""
         self.arguments = arguments
-        self.packages = BASE_PACKAGES
+        self.base_packages = list(BASE_PACKAGES)
+        self.packages = list(BASE_PACKAGES)
         self.ram_directory = None
+        self.image_size = get_build_image_size(self.arguments.image_size)
+        self.shrink_image = self.arguments.image_size == 'auto'
 
         self.builder_backends = {}
         self.builder_backends['internal'] = internal.InternalBuilderBackend(
@@ -74,36 +91,183 @@ class ImageBuilder(object):  # pylint: disable=too-many-instance-attributes
 
         self.image_file = os.path.join(self.arguments.build_dir,
                                        self._get_image_base_name() + '.img')
+        self.cache_dir = self.arguments.cache_dir or os.path.join(
+            self.arguments.build_dir, 'cache')
+        self.profile_file = os.path.join(
+            self.arguments.build_dir,
+            self._get_image_base_name() + '.profile.json')
+        self.fingerprint_file = os.path.join(
+            self.arguments.build_dir,
+            self._get_image_base_name() + '.fingerprint')
+        self.artifacts = []
 
     def build(self):
         """Run the image building process."""
         archive_file = self.image_file + '.xz'
         self.make_image()
+        self.create_bmap(self.image_file)
+        self.store_chunks(self.image_file)
+        self.create_delta(self.image_file)
         self.compress(archive_file, self.image_file)
 
         self.sign(archive_file)
 
+    def get_fingerprint_inputs(self):
+        """Return all inputs that decide the contents of the built images."""
+        cls = type(self)
+        attributes = {}
+        for name in dir(cls):
+            value = getattr(cls, name)
+            if not name.startswith('_') and (value is None or isinstance(
+                    value, (str, int, float, bool, list, tuple))):
+                attributes[name] = value
+
+        arguments = {
+            name: value
+            for name, value in vars(self.arguments).items()
+            if name not in NON_FINGERPRINT_ARGUMENTS
+        }
+        custom_packages = [
+            utils.get_file_checksum(package)
+            for package in self.arguments.custom_package or []
+        ]
+        backend = self.builder_backends[self.builder_backend]
+        return {
+            'version': freedommaker.__version__,
+            'builder': cls.__name__,
+            'attributes': attributes,
+            'arguments': arguments,
+            'custom_packages': custom_packages,
+            'backend': backend.get_fingerprint_inputs(),
+        }
+
+    def get_fingerprint(self):
+        """Return the fingerprint of all inputs of the build."""
+        return utils.get_fingerprint(self.get_fingerprint_inputs())
+
+    def is_built(self, fingerprint):
+        """Return whether images with a given fingerprint already exist."""
+        try:
+            with open(self.fingerprint_file) as file_handle:
+                cached = json.load(file_handle)
+        except (FileNotFoundError, ValueError):
+            return False
+
+        if cached.get('fingerprint') != fingerprint:
+            return False
+
+        artifacts = cached.get('artifacts') or []
+        return bool(artifacts) and all(
+            os.path.exists(os.path.join(self.arguments.build_dir, artifact))
+            for artifact in artifacts)
+
+    def write_fingerprint(self, fingerprint):
+        """Record the fingerprint of the inputs and the images built."""
+        with open(self.fingerprint_file, 'w') as file_handle:
+            json.dump(
+                {
+                    'fingerprint': fingerprint,
+                    'artifacts': [
+                        os.path.basename(artifact)
+                        for artifact in self.artifacts
+                    ],
+                }, file_handle, indent=4, sort_keys=True)
+
+    def add_artifact(self, path):
+        """Record a file produced by the build."""
+        self.artifacts.append(path)
+
     def make_image(self):
         """Call a builder backend to create basic image."""
         builder = self.builder_backend
         self.builder_backends[builder].make_image()
 
-    def _get_image_base_name(self):
+    def _get_image_base_name(self, build_stamp=None):
         """Return the base file name of the final image."""
         free_tag = 'free' if self.free else 'nonfree'
 
         return 'libreserver-{distribution}-{free_tag}_{build_stamp}' \
             '_{machine}-{architecture}'.format(
                 distribution=self.arguments.distribution, free_tag=free_tag,
-                build_stamp=self.arguments.build_stamp, machine=self.machine,
-                architecture=self.architecture)
+                build_stamp=build_stamp or self.arguments.build_stamp,
+                machine=self.machine, architecture=self.architecture)
+
+    def create_bmap(self, image_file):
+        """Create a block map of the image for writing only used blocks."""
+        library.sparsify_image(image_file)
+        bmap.write_bmap(image_file, image_file + '.bmap')
+        self.add_artifact(image_file + '.bmap')
+
+    def store_chunks(self, image_file):
+        """Add the image to the chunk store, if one is used."""
+        if not self.arguments.chunk_store:
+            return
+
+        chunks.store_image(image_file, self.arguments.chunk_store,
+                           image_file + '.chunks.json')
+        self.add_artifact(image_file + '.chunks.json')
+
+    def create_delta(self, image_file):
+        """Create a binary delta from the previous build of this target.
+
+        The image is then kept as the previous build for the next run.
+
+        """
+        if not self.arguments.delta:
+            return
+
+        size = os.path.getsize(image_file)
+        if size > library.DELTA_MAX_SIZE:
+            logger.warning(
+                'Image %s is too large for a delta, try --image-size auto',
+                image_file)
+            return
+
+        previous_file = os.path.join(
+            self.cache_dir, 'previous-images',
+            self._get_image_base_name(build_stamp='previous') + '.img')
+        image_info = {
+            'name': os.path.basename(image_file),
+            'build_stamp': self.arguments.build_stamp,
+            'size': size,
+            'sha256': utils.get_file_checksum(image_file),
+        }
+        try:
+            with open(previous_file + '.json') as file_handle:
+                previous_info = json.load(file_handle)
+        except FileNotFoundError:
+            previous_info = None
+
+        if previous_info and os.path.exists(previous_file):
+            delta_file = image_file + '.delta.zst'
+            library.create_delta(previous_file, image_file, delta_file)
+            with open(delta_file + '.json', 'w') as file_handle:
+                json.dump(
+                    {
+                        'format': 'zstd-patch-from',
+                        'source': previous_info,
+                        'target': image_info,
+                    }, file_handle, indent=4, sort_keys=True)
+
+            self.add_artifact(delta_file)
+            self.add_artifact(delta_file + '.json')
+        else:
+            logger.info('No previous build to create delta from for %s',
+                        image_file)
+
+        os.makedirs(os.path.dirname(previous_file), exist_ok=True)
+        library.copy_file(image_file, previous_file)
+        with open(previous_file + '.json', 'w') as file_handle:
+            json.dump(image_info, file_handle, indent=4, sort_keys=True)
 
     def compress(self, archive_file, image_file):
         """Compress the generate image."""
         if not self.arguments.skip_compression:
             library.compress(archive_file, image_file)
+            self.add_artifact(archive_file)
         else:
             logger.info('Skipping image compression')
+            self.add_artifact(image_file)
 
     def sign(self, archive):
         """Signed the final output image."""
@@ -111,6 +275,7 @@ class ImageBuilder(object):  # pylint: disable=too-many-instance-attributes
             return
 
         library.sign(archive)
+        self.add_artifact(archive + '.sig')
 
     @staticmethod
     def _replace_extension(file_name, new_extension):
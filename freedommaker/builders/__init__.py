@@ -2,33 +2,56 @@
 """
 Package containing all the builders.
 
-isort:skip_file
+Builders are looked up by target name in a static registry and only the
+module of the requested builder is imported.
 """
 
-# pylint: disable=unused-import
-from . import a20_olinuxino_lime2
-from . import a20_olinuxino_lime
-from . import a20_olinuxino_micro
-from . import amd64
-from . import arm
-from . import arm64
-from . import armhf
-from . import banana_pro
-from . import beaglebone
-from . import cubieboard2
-from . import cubietruck
-from . import i386
-from . import lamobo_r1
-from . import orange_pi_zero
-from . import pcduino3
-from . import pine64_plus
-from . import pine64_lts
-from . import qemu_amd64
-from . import qemu_i386
-from . import raspberry_pi_2
-from . import raspberry_pi_3
-from . import raspberry_pi_3_b_plus
-from . import raspberry_pi_with_uboot
-from . import vagrant
-from . import virtualbox_amd64
-from . import virtualbox_i386
+import importlib
+
+# Map of target name to module and class implementing the builder
+TARGETS = {
+    'a20-olinuxino-lime': ('a20_olinuxino_lime',
+                           'A20OLinuXinoLimeImageBuilder'),
+    'a20-olinuxino-lime2': ('a20_olinuxino_lime2',
+                            'A20OLinuXinoLime2ImageBuilder'),
+    'a20-olinuxino-micro': ('a20_olinuxino_micro',
+                            'A20OLinuXinoMicroImageBuilder'),
+    'amd64': ('amd64', 'AMD64ImageBuilder'),
+    'arm64': ('arm64', 'ARM64ImageBuilder'),
+    'armhf': ('armhf', 'ARMHFImageBuilder'),
+    'banana-pro': ('banana_pro', 'BananaProImageBuilder'),
+    'beaglebone': ('beaglebone', 'BeagleBoneImageBuilder'),
+    'cubieboard2': ('cubieboard2', 'Cubieboard2ImageBuilder'),
+    'cubietruck': ('cubietruck', 'CubietruckImageBuilder'),
+    'i386': ('i386', 'I386ImageBuilder'),
+    'lamobo-r1': ('lamobo_r1', 'LamoboR1ImageBuilder'),
+    'orange-pi-zero': ('orange_pi_zero', 'OrangePiZeroImageBuilder'),
+    'pcduino3': ('pcduino3', 'PCDuino3ImageBuilder'),
+    'pine64-lts': ('pine64_lts', 'Pine64LTSImageBuilder'),
+    'pine64-plus': ('pine64_plus', 'Pine64PlusImageBuilder'),
+    'qemu-amd64': ('qemu_amd64', 'QemuAmd64ImageBuilder'),
+    'qemu-i386': ('qemu_i386', 'QemuI386ImageBuilder'),
+    'raspberry2': ('raspberry_pi_2', 'RaspberryPi2ImageBuilder'),
+    'raspberry3': ('raspberry_pi_3', 'RaspberryPi3ImageBuilder'),
+    'raspberry3-b-plus': ('raspberry_pi_3_b_plus',
+                          'RaspberryPi3BPlusImageBuilder'),
+    'vagrant': ('vagrant', 'VagrantImageBuilder'),
+    'virtualbox-amd64': ('virtualbox_amd64', 'VirtualBoxAmd64ImageBuilder'),
+    'virtualbox-i386': ('virtualbox_i386', 'VirtualBoxI386ImageBuilder'),
+}
+
+
+def get_target_names():
+    """Return the sorted list of all the targets that can be built."""
+    return sorted(TARGETS)
+
+
+def get_builder_class(target):
+    """Import and return the builder class for a target name."""
+    try:
+        module_name, class_name = TARGETS[target]
+    except KeyError:
+        raise ValueError('No such target')
+
+    module = importlib.import_module('.' + module_name, __name__)
+    return getattr(module, class_name)
@@ -20,5 +20,4 @@ class A20ImageBuilder(ARMImageBuilder):
 
         library.install_boot_loader_part(state,
                                          self.u_boot_path,
-                                         seek='8',
-                                         size='1k')
+                                         offset=8 * 1024)
@@ -20,12 +20,10 @@ class BeagleBoneImageBuilder(ARMImageBuilder):
         """Install the boot loader onto the image."""
         library.install_boot_loader_part(state,
                                          'usr/lib/u-boot/am335x_boneblack/MLO',
-                                         seek='1',
-                                         size='128k',
-                                         count='1')
+                                         offset=128 * 1024,
+                                         max_size=128 * 1024)
         library.install_boot_loader_part(
             state,
             'usr/lib/u-boot/am335x_boneblack/u-boot.img',
-            seek='1',
-            size='384k',
-            count='2')
+            offset=384 * 1024,
+            max_size=768 * 1024)
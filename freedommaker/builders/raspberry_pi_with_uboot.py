@@ -3,6 +3,9 @@
 Base worker class to build Raspberry Pi 2 and 3 images.
 """
 
+import os
+import shutil
+
 from .. import library
 from .arm import ARMImageBuilder
 
@@ -20,26 +23,22 @@ class RaspberryPiWithUBoot(ARMImageBuilder):
         if not self.uboot_variant:
             raise NotImplementedError
 
-        firmware_package = 'raspi-firmware'
-        script = '''
-set -e
-set -x
-set -o pipefail
-
-apt-get install --no-install-recommends -y dpkg-dev
-cd /tmp
-apt-get source {firmware_package}
-cp {firmware_package}*/boot/* /boot/firmware
-rm -rf {firmware_package}*
-cd /
-
-# remove unneeded firmware files
-rm -f /boot/firmware/fixup_*
-rm -f /boot/firmware/start_*
-
-# u-boot setup
-apt-get install -y u-boot-rpi
-cp /usr/lib/u-boot/{uboot_variant}/u-boot.bin /boot/firmware/kernel.img
-cp /usr/lib/u-boot/{uboot_variant}/u-boot.bin /boot/firmware/kernel7.img
-'''.format(firmware_package=firmware_package, uboot_variant=self.uboot_variant)
-        library.run_in_chroot(state, ['bash', '-c', script])
+        source = library.fetch_source_package(state, 'raspi-firmware',
+                                              self.cache_dir)
+        source_boot = os.path.join(source, 'boot')
+        firmware = library.path_in_root(state, '/boot/firmware')
+        for name in sorted(os.listdir(source_boot)):
+            path = os.path.join(source_boot, name)
+            # Skip unneeded firmware files
+            if not os.path.isfile(path) or \
+               name.startswith(('fixup_', 'start_')):
+                continue
+
+            shutil.copyfile(path, os.path.join(firmware, name))
+
+        # u-boot setup
+        library.install_package(state, 'u-boot-rpi')
+        uboot = library.path_in_root(
+            state, '/usr/lib/u-boot/{}/u-boot.bin'.format(self.uboot_variant))
+        for name in ('kernel.img', 'kernel7.img'):
+            shutil.copyfile(uboot, os.path.join(firmware, name))
@@ -12,6 +12,7 @@ from .virtualbox_amd64 import VirtualBoxAmd64ImageBuilder
 class VagrantImageBuilder(VirtualBoxAmd64ImageBuilder):
     """Image builder for Vagrant package."""
     vagrant_extension = '.box'
+    required_commands = ('VBoxManage', 'vagrant')
 
     @classmethod
     def get_target_name(cls):
@@ -29,6 +30,7 @@ class VagrantImageBuilder(VirtualBoxAmd64ImageBuilder):
         self.create_vm_file(self.image_file, vm_file)
         os.remove(self.image_file)
         self.vagrant_package(vm_file, vagrant_file)
+        self.add_artifact(vagrant_file)
 
     def vagrant_package(self, vm_file, vagrant_file):
         """Create a vagrant package from VM file."""
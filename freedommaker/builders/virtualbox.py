@@ -12,6 +12,7 @@ from .vm import VMImageBuilder
 class VirtualBoxImageBuilder(VMImageBuilder):
     """Base image builder for all VirtualBox targets."""
     vm_image_extension = '.vdi'
+    required_commands = ('VBoxManage', )
 
     @classmethod
     def get_target_name(cls):
@@ -0,0 +1,247 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Deduplicating store of image contents split into content-defined chunks.
+
+Images are split into chunks whose boundaries depend only on the contents of
+the image. The same data in two images, such as the root file system shared by
+images of different boards, produces the same chunks, so each is stored only
+once. An index file lists the chunks needed to assemble an image.
+
+Boundaries are decided per block of the image. A chunk ends after a block
+whose CRC matches a mask, within minimum and maximum chunk sizes. Runs of
+zeros and holes are not stored and make up chunks of their own.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import lzma
+import os
+import urllib.parse
+import urllib.request
+import zlib
+
+from . import bmap
+
+BLOCK_SIZE = 4096
+MIN_BLOCKS = 16
+MAX_BLOCKS = 256
+BOUNDARY_MASK = 0x3f  # Average of 64 blocks per chunk
+COMPRESSION_PRESET = 3
+INDEX_VERSION = 1
+PENDING_CHUNKS = 64
+
+ZERO_BLOCK = bytes(BLOCK_SIZE)
+
+logger = logging.getLogger(__name__)
+
+
+def _iter_blocks(file_descriptor, size):
+    """Yield offset, length and data of blocks in a file.
+
+    Holes are yielded as a single item with None as data.
+
+    """
+    offset = 0
+    data_ranges = bmap.get_data_ranges(file_descriptor, size)
+    for start, end in data_ranges + [(size, size)]:
+        start = start // BLOCK_SIZE * BLOCK_SIZE
+        if start > offset:
+            yield offset, start - offset, None
+            offset = start
+
+        while offset < end:
+            data = os.pread(file_descriptor, BLOCK_SIZE, offset)
+            yield offset, len(data), data
+            offset += len(data)
+
+
+def iter_chunks(path):
+    """Yield offset, size and data of content-defined chunks of a file.
+
+    Chunks of zeros are yielded with None as data.
+
+    """
+    file_descriptor = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(file_descriptor).st_size
+        pending = []
+        start = 0
+        zeros = None
+        for offset, length, data in _iter_blocks(file_descriptor, size):
+            if data is None or data == ZERO_BLOCK[:length]:
+                if pending:
+                    yield start, offset - start, b''.join(pending)
+                    pending = []
+
+                if zeros and zeros[0] + zeros[1] == offset:
+                    zeros = (zeros[0], zeros[1] + length)
+                else:
+                    zeros = (offset, length)
+
+                continue
+
+            if zeros:
+                yield zeros[0], zeros[1], None
+                zeros = None
+
+            if not pending:
+                start = offset
+
+            pending.append(data)
+            if len(pending) >= MAX_BLOCKS or \
+               (len(pending) >= MIN_BLOCKS and
+                    zlib.crc32(data) & BOUNDARY_MASK == 0):
+                yield start, offset + length - start, b''.join(pending)
+                pending = []
+
+        if pending:
+            yield start, size - start, b''.join(pending)
+
+        if zeros:
+            yield zeros[0], zeros[1], None
+    finally:
+        os.close(file_descriptor)
+
+
+def get_chunk_id(data):
+    """Return the identifier of a chunk."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def _get_chunk_path(chunk_id):
+    """Return the path of a chunk relative to the store."""
+    return '{}/{}.xz'.format(chunk_id[:4], chunk_id)
+
+
+def _store_chunk(store, chunk_id, data):
+    """Compress and write a chunk into the store unless it exists."""
+    path = os.path.join(store, _get_chunk_path(chunk_id))
+    if os.path.exists(path):
+        return False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = '{}.{}.temp'.format(path, os.getpid())
+    with open(temp_path, 'wb') as file_handle:
+        file_handle.write(lzma.compress(data, preset=COMPRESSION_PRESET))
+
+    os.rename(temp_path, path)
+    return True
+
+
+def store_image(image_file, store, index_file):
+    """Split an image into chunks, add them to a store and write an index."""
+    logger.info('Storing chunks of %s in %s', image_file, store)
+    entries = []
+    stored_count = 0
+    pending = []
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        for offset, size, data in iter_chunks(image_file):
+            chunk_id = None
+            if data is not None:
+                chunk_id = get_chunk_id(data)
+                pending.append(
+                    executor.submit(_store_chunk, store, chunk_id, data))
+
+            entries.append([offset, size, chunk_id])
+            if len(pending) >= PENDING_CHUNKS:
+                stored_count += sum(future.result() for future in pending)
+                pending = []
+
+        stored_count += sum(future.result() for future in pending)
+
+    index = {
+        'version': INDEX_VERSION,
+        'size': os.path.getsize(image_file),
+        'chunks': entries,
+    }
+    with open(index_file, 'w') as file_handle:
+        json.dump(index, file_handle)
+
+    chunk_count = sum(1 for entry in entries if entry[2])
+    logger.info('Image %s has %d chunks, %d new in store', image_file,
+                chunk_count, stored_count)
+
+
+def read_chunk(store, chunk_id):
+    """Read and verify a chunk from a store directory or URL."""
+    path = _get_chunk_path(chunk_id)
+    if urllib.parse.urlparse(store).scheme:
+        url = store.rstrip('/') + '/' + path
+        with urllib.request.urlopen(url) as response:
+            compressed = response.read()
+    else:
+        with open(os.path.join(store, path), 'rb') as file_handle:
+            compressed = file_handle.read()
+
+    data = lzma.decompress(compressed)
+    if get_chunk_id(data) != chunk_id:
+        raise ValueError('Chunk {} in store is corrupt'.format(chunk_id))
+
+    return data
+
+
+def _get_seed_chunks(seeds):
+    """Return location of chunks found in seed files by chunk identifier."""
+    chunks = {}
+    for seed in seeds:
+        logger.info('Reading chunks of seed %s', seed)
+        for offset, size, data in iter_chunks(seed):
+            if data is not None:
+                chunks.setdefault(get_chunk_id(data), (seed, offset, size))
+
+    return chunks
+
+
+def assemble_image(index_file, store, output_file, seeds=()):
+    """Assemble an image from an index and a chunk store.
+
+    Chunks that are found in any of the seed files, such as an older version
+    of the image, are copied from there instead of the store.
+
+    """
+    with open(index_file) as file_handle:
+        index = json.load(file_handle)
+
+    if index.get('version') != INDEX_VERSION:
+        raise ValueError('Unsupported index version {}'.format(
+            index.get('version')))
+
+    seed_chunks = _get_seed_chunks(seeds)
+    fetched_count = 0
+    seeded_count = 0
+    file_descriptor = os.open(output_file,
+                              os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(file_descriptor, index['size'])
+        for offset, size, chunk_id in index['chunks']:
+            if chunk_id is None:
+                continue
+
+            data = None
+            if chunk_id in seed_chunks:
+                seed, seed_offset, seed_size = seed_chunks[chunk_id]
+                with open(seed, 'rb') as file_handle:
+                    file_handle.seek(seed_offset)
+                    data = file_handle.read(seed_size)
+
+                if get_chunk_id(data) == chunk_id:
+                    seeded_count += 1
+                else:
+                    data = None
+
+            if data is None:
+                data = read_chunk(store, chunk_id)
+                fetched_count += 1
+
+            if len(data) != size:
+                raise ValueError('Chunk {} has unexpected size'.format(
+                    chunk_id))
+
+            os.pwrite(file_descriptor, data, offset)
+    finally:
+        os.close(file_descriptor)
+
+    logger.info('Assembled %s: %d chunks from seeds, %d from store',
+                output_file, seeded_count, fetched_count)
@@ -3,53 +3,164 @@
 Basic image builder using internal implementation.
 """
 
+import json
 import logging
+import os
+import shutil
 
-from . import library, utils
+import freedommaker
+
+from . import library, scheduler, utils
 
 logger = logging.getLogger(__name__)
 
+# Resources held exclusively by a build step while it runs
+APT = 'apt'  # dpkg/apt lock inside the chroot
+LOOP = 'loop'  # image file, its loop devices and partition mappings
+NETWORK = 'network'
+
+# Inputs of a base root file system that change over time for the same boards
+TIME_VARYING_BASE_ROOTFS_INPUTS = ('version', 'build_mirror_release',
+                                   'libreserver_commit')
+
+GROW_ROOT_SCRIPT = '''#!/bin/bash
+# Grow the root partition and file system to fill the disk
+marker=/var/lib/freedommaker/root-grown
+if [ -f "$marker" ]; then
+  exit 0
+fi
+
+device=$(findmnt --noheadings --output SOURCE --nofsroot /)
+fstype=$(findmnt --noheadings --output FSTYPE /)
+disk=/dev/$(lsblk --noheadings --nodeps --output PKNAME "$device")
+partition=$(cat "/sys/class/block/$(basename "$device")/partition")
+
+growpart "$disk" "$partition" || true
+case "$fstype" in
+  btrfs) btrfs filesystem resize max / ;;
+  ext4) resize2fs "$device" ;;
+esac
+
+mkdir -p "$(dirname "$marker")"
+touch "$marker"
+'''
+
 
 class InternalBuilderBackend():
     """Build an image using internal implementation."""
     def __init__(self, builder):
         """Initialize the builder."""
         self.builder = builder
-        self.state = {'success': True}
+        self.state = {'success': True, 'profile': {}}
 
     def make_image(self):
         """Create a disk image."""
         # enable systemd resolved?
+        arguments = self.builder.arguments
+        self.state['profile']['build_mirror'] = arguments.build_mirror
+        if arguments.snapshot:
+            self.state['profile']['snapshot'] = arguments.snapshot
+
         try:
-            self._get_temp_image_file()
-            self._create_empty_image()
-            self._create_partitions()
-            self._loopback_setup()
-            self._create_filesystems()
-            self._mount_filesystems()
-            self._setup_extra_storage()
-            self._debootstrap()
-            self._set_hostname()
-            # self._lock_root_user()
-            self._create_sudo_user()
-            self._set_libreserver_disk_image_flag()
-            self._create_fstab()
-            self._mount_additional_filesystems()
-            self._setup_build_apt()
-            self._install_libreserver_packages()
-            self._remove_ssh_keys()
-            self._generate_keys_on_first_boot()
-            self._install_boot_loader()
-            self._setup_final_apt()
-            self._enable_eth0()
-            self._install_webserver()
-            self._fill_free_space_with_zeros()
+            scheduler.run_steps(self._get_steps(),
+                                jobs=self.builder.arguments.jobs,
+                                profile=self.state['profile'])
         except (Exception, KeyboardInterrupt) as exception:
             logger.exception('Exception during build - %s', exception)
             self.state['success'] = False
             raise
         finally:
             self._teardown()
+            self._write_profile()
+
+    def get_fingerprint_inputs(self):
+        """Return the inputs of the build that are not builder attributes.
+
+        Packages resolved from the mirror and the LibreServer commit change
+        over time for the same builder and arguments.
+
+        """
+        arguments = self.builder.arguments
+        return {
+            'components': self._get_components(),
+            'packages': self._get_packages(),
+            'backports': self._should_use_backports(),
+            'build_mirror_release': library.get_release_checksum(
+                arguments.build_mirror, arguments.distribution),
+            'libreserver_commit': self._get_libreserver_commit(),
+        }
+
+    def _get_steps(self):
+        """Return the steps of the build as a dependency graph.
+
+        Each step lists the steps that must finish before it can start and the
+        resources it holds exclusively while running. Steps that only edit
+        files in the mounted file system can run alongside long package
+        installations.
+
+        """
+        step = scheduler.Step
+        return [
+            step('get_temp_image_file', self._get_temp_image_file),
+            step('create_empty_image', self._create_empty_image,
+                 ['get_temp_image_file'], [LOOP]),
+            step('create_partitions', self._create_partitions,
+                 ['create_empty_image'], [LOOP]),
+            step('loopback_setup', self._loopback_setup,
+                 ['create_partitions'], [LOOP]),
+            step('create_filesystems', self._create_filesystems,
+                 ['loopback_setup'], [LOOP]),
+            step('mount_filesystems', self._mount_filesystems,
+                 ['create_filesystems'], [LOOP]),
+            step('setup_extra_storage', self._setup_extra_storage,
+                 ['mount_filesystems'], [LOOP]),
+            step('debootstrap', self._debootstrap, ['setup_extra_storage'],
+                 [APT, NETWORK]),
+            step('set_hostname', self._set_hostname, ['debootstrap']),
+            # step('lock_root_user', self._lock_root_user, ['debootstrap']),
+            step('create_sudo_user', self._create_sudo_user, ['debootstrap'],
+                 [APT]),
+            step('set_libreserver_disk_image_flag',
+                 self._set_libreserver_disk_image_flag, ['debootstrap']),
+            step('create_fstab', self._create_fstab, ['debootstrap']),
+            step('mount_additional_filesystems',
+                 self._mount_additional_filesystems, ['debootstrap']),
+            step('setup_build_apt', self._setup_build_apt,
+                 ['mount_additional_filesystems'], [APT, NETWORK]),
+            step('install_board_packages', self._install_board_packages,
+                 ['setup_build_apt'], [APT, NETWORK]),
+            step('install_libreserver_packages',
+                 self._install_libreserver_packages,
+                 ['setup_build_apt', 'create_sudo_user'], [APT, NETWORK]),
+            step('remove_ssh_keys', self._remove_ssh_keys,
+                 ['install_libreserver_packages']),
+            step('generate_keys_on_first_boot',
+                 self._generate_keys_on_first_boot, ['debootstrap']),
+            # Both edit /etc/crontab
+            step('grow_root_on_first_boot', self._grow_root_on_first_boot,
+                 ['generate_keys_on_first_boot']),
+            step('install_boot_loader', self._install_boot_loader,
+                 ['install_board_packages', 'create_fstab'], [APT, NETWORK]),
+            step('install_webserver', self._install_webserver,
+                 ['setup_build_apt'], [APT, NETWORK]),
+            step('setup_final_apt', self._setup_final_apt, [
+                'install_board_packages', 'install_libreserver_packages',
+                'install_boot_loader', 'install_webserver'
+            ], [APT, NETWORK]),
+            step('enable_eth0', self._enable_eth0,
+                 ['mount_additional_filesystems']),
+            step('update_initramfs', self._update_initramfs, [
+                'install_libreserver_packages', 'install_boot_loader',
+                'install_webserver', 'enable_eth0', 'create_fstab'
+            ], [APT]),
+            step('fill_free_space_with_zeros',
+                 self._fill_free_space_with_zeros, [
+                     'set_hostname', 'set_libreserver_disk_image_flag',
+                     'remove_ssh_keys', 'generate_keys_on_first_boot',
+                     'grow_root_on_first_boot', 'setup_final_apt',
+                     'update_initramfs'
+                 ]),
+        ]
 
     def _get_temp_image_file(self):
         """Get the temporary path to where the image should be built.
@@ -66,7 +177,7 @@ class InternalBuilderBackend():
             return library.create_temp_image(self.state,
                                              self.builder.image_file)
 
-        size = utils.add_disk_sizes(self.builder.arguments.image_size,
+        size = utils.add_disk_sizes(self.builder.image_size,
                                     self.builder.extra_storage_size)
         size = utils.add_disk_sizes(size, '100M')  # Buffer
         return library.create_ram_directory_image(self.state,
@@ -75,7 +186,10 @@ class InternalBuilderBackend():
 
     def _create_empty_image(self):
         """Create an empty disk image to create parititions in."""
-        library.create_image(self.state, self.builder.arguments.image_size)
+        library.create_image(self.state, self.builder.image_size)
+        if self.builder.shrink_image:
+            library.schedule_cleanup(self.state, library.shrink_image,
+                                     self.state, 'root')
 
     def _create_partitions(self):
         """Create partition table and partitions in the image."""
@@ -111,6 +225,9 @@ class InternalBuilderBackend():
 
         library.set_boot_flag(self.state,
                               partition_number=boot_partition_number)
+        if self.builder.arguments.reproducible:
+            library.set_disk_identifiers(self.state,
+                                         self.builder.get_fingerprint())
 
     def _loopback_setup(self):
         """Perform mapping to loopback devices from partitions in image file."""
@@ -118,33 +235,56 @@ class InternalBuilderBackend():
 
     def _create_filesystems(self):
         """Create file systems inside the partitions created."""
-        if self.builder.firmware_filesystem_type:
-            library.create_filesystem(self.state['devices']['firmware'],
-                                      self.builder.firmware_filesystem_type)
-
-        if self.builder.efi_filesystem_type:
-            library.create_filesystem(self.state['devices']['efi'],
-                                      self.builder.efi_filesystem_type)
-
-        if self.builder.boot_filesystem_type:
-            library.create_filesystem(self.state['devices']['boot'],
-                                      self.builder.boot_filesystem_type)
-
-        library.create_filesystem(self.state['devices']['root'],
-                                  self.builder.root_filesystem_type)
+        for label in ('firmware', 'efi', 'boot', 'root'):
+            filesystem_type = getattr(self.builder,
+                                      label + '_filesystem_type')
+            if filesystem_type:
+                library.create_filesystem(self.state['devices'][label],
+                                          filesystem_type,
+                                          self._get_filesystem_uuid(label))
+
+    def _get_filesystem_uuid(self, label):
+        """Return the UUID for a file system, None for a random one."""
+        if not self.builder.arguments.reproducible:
+            return None
+
+        return library.get_reproducible_uuid(self.builder.get_fingerprint(),
+                                             'filesystem/' + label)
 
     def _mount_filesystems(self):
-        """Mount the filesystems in the right places."""
-        library.mount_filesystem(self.state, 'root', None)
+        """Mount the filesystems in the right places.
 
-        if self.builder.boot_filesystem_type:
-            library.mount_filesystem(self.state, 'boot', 'boot')
+        In reproducible builds, files differing between builds are removed
+        and modification times are clamped just before each file system is
+        unmounted.
 
-        if self.builder.efi_filesystem_type:
-            library.mount_filesystem(self.state, 'efi', 'boot/efi')
-
-        if self.builder.firmware_filesystem_type:
-            library.mount_filesystem(self.state, 'firmware', 'boot/firmware')
+        """
+        reproducible = self.builder.arguments.reproducible
+        epoch = self.builder.arguments.source_date_epoch
+        library.mount_filesystem(self.state, 'root', None)
+        if self.builder.shrink_image:
+            margin = utils.parse_disk_size(
+                self.builder.arguments.image_size_margin)
+            library.schedule_cleanup(self.state, library.shrink_filesystem,
+                                     self.state, 'root',
+                                     self.builder.root_filesystem_type, margin)
+
+        if reproducible:
+            library.schedule_cleanup(self.state, library.clamp_timestamps,
+                                     self.state, None, epoch)
+            library.schedule_cleanup(self.state,
+                                     library.remove_volatile_files,
+                                     self.state)
+
+        for label, sub_mount_point in (('boot', 'boot'), ('efi', 'boot/efi'),
+                                       ('firmware', 'boot/firmware')):
+            if getattr(self.builder, label + '_filesystem_type'):
+                library.mount_filesystem(self.state, label, sub_mount_point)
+                if reproducible:
+                    library.schedule_cleanup(self.state,
+                                             library.clamp_timestamps,
+                                             self.state, sub_mount_point,
+                                             epoch)
 
     def _setup_extra_storage(self):
         """Setup some extra storage for root filesystem.
@@ -162,19 +302,24 @@ class InternalBuilderBackend():
                                     self.builder.root_filesystem_type,
                                     self.builder.extra_storage_size)
 
-    def _mount_additional_filesystems(self):
+    def _mount_additional_filesystems(self, state=None):
         """Mount extra filesystems: dev, devpts, sys and proc."""
-        library.mount_filesystem(self.state, '/dev', 'dev', is_bind_mount=True)
-        library.mount_filesystem(self.state, '/dev/pts', 'dev/pts',
-                                 is_bind_mount=True)
-        library.mount_filesystem(self.state, '/proc', 'proc',
+        state = self.state if state is None else state
+        library.mount_filesystem(state, '/dev', 'dev', is_bind_mount=True)
+        library.mount_filesystem(state, '/dev/pts', 'dev/pts',
                                  is_bind_mount=True)
-        library.mount_filesystem(self.state, '/sys', 'sys', is_bind_mount=True)
+        library.mount_filesystem(state, '/proc', 'proc', is_bind_mount=True)
+        library.mount_filesystem(state, '/sys', 'sys', is_bind_mount=True)
+        library.mount_local_mirror(state, self.builder.arguments.build_mirror)
 
         # Kill all the processes on the / filesystem before attempting to
         # unmount /dev/pts. Otherwise, unmounting /dev/pts will fail.
-        library.schedule_cleanup(self.state, library.process_cleanup,
-                                 self.state)
+        if os.path.ismount(state['mount_point']):
+            library.schedule_cleanup(state, library.process_cleanup, state)
+        else:
+            # A plain directory is on the host's file system
+            library.schedule_cleanup(state, library.kill_chroot_processes,
+                                     state)
 
     def _get_packages(self):
         """Return the list of extra packages to install.
@@ -187,6 +332,18 @@ class InternalBuilderBackend():
             self._get_filesystem_packages() + \
             self._get_extra_packages()
 
+    def _get_base_rootfs_packages(self):
+        """Return packages common to boards sharing a base root file system."""
+        return self.builder.base_packages + self._get_kernel_packages()
+
+    def _get_board_packages(self):
+        """Return packages not in the shared base root file system."""
+        base_packages = self._get_base_rootfs_packages()
+        return [
+            package for package in self._get_packages()
+            if package not in base_packages
+        ]
+
     def _get_basic_packages(self):
         """Return a list of basic packages for all king of images."""
         return self.builder.packages
@@ -225,6 +382,9 @@ class InternalBuilderBackend():
         ]:
             packages += ['btrfs-progs']
 
+        if self.builder.shrink_image:
+            packages += ['cloud-guest-utils', 'fdisk']
+
         return packages
 
     def _get_extra_packages(self):
@@ -245,13 +405,159 @@ class InternalBuilderBackend():
         return components
 
     def _debootstrap(self):
-        """Run debootstrap on the mount point."""
+        """Run debootstrap on the mount point.
+
+        When sharing of base root file systems is enabled, copy the base root
+        file system instead.
+
+        """
+        library.enable_unsafe_io(self.state)
+        if self.builder.arguments.share_base_rootfs:
+            self.state['base_rootfs'] = self._copy_base_rootfs()
+        else:
+            self._run_debootstrap(self.state, self._get_packages())
+
+        library.defer_initramfs_updates(self.state)
+
+    def _run_debootstrap(self, state, packages):
+        """Run debootstrap on the mount point of a given state."""
         variant = self.builder.debootstrap_variant or '-'
-        library.qemu_debootstrap(self.state, self.builder.architecture,
+        library.qemu_debootstrap(state, self.builder.architecture,
                                  self.builder.arguments.distribution, variant,
-                                 self._get_components(), self._get_packages(),
+                                 self._get_components(), packages,
                                  self.builder.arguments.build_mirror)
 
+    def _install_board_packages(self):
+        """Install packages of the board missing from the base root fs."""
+        if 'base_rootfs' not in self.state:
+            return
+
+        library.install_packages(self.state, self._get_board_packages())
+
+    def _get_libreserver_mirror(self):
+        """Return the path of the host mirror of LibreServer repository."""
+        return os.path.join(self.builder.cache_dir, 'libreserver.git')
+
+    def _get_libreserver_commit(self):
+        """Update the LibreServer mirror and return the commit to install."""
+        arguments = self.builder.arguments
+        mirror = self._get_libreserver_mirror()
+        library.update_git_mirror(arguments.libreserver_repository, mirror)
+        return library.get_git_commit(mirror, arguments.libreserver_branch)
+
+    def _get_base_rootfs_inputs(self):
+        """Return the inputs of the base root file system.
+
+        Boards of an architecture with the same kernel flavor share a base
+        root file system. Packages specific to a board are installed after
+        copying it. The checksum of the Release file makes a new base
+        to be built when packages in the archive are updated.
+
+        """
+        arguments = self.builder.arguments
+        return {
+            'version': freedommaker.__version__,
+            'architecture': self.builder.architecture,
+            'distribution': arguments.distribution,
+            'variant': self.builder.debootstrap_variant,
+            'components': self._get_components(),
+            'kernel_flavor': self.builder.kernel_flavor,
+            'packages': self._get_base_rootfs_packages(),
+            'build_mirror': arguments.build_mirror,
+            'build_mirror_release': library.get_release_checksum(
+                arguments.build_mirror, arguments.distribution),
+            'backports': self._should_use_backports(),
+            'libreserver_commit': self._get_libreserver_commit(),
+        }
+
+    def _copy_base_rootfs(self):
+        """Copy the base root file system to the mount point and return it.
+
+        The base root file system contains everything that is common for the
+        boards of an architecture and kernel flavor: debootstrap, the sudo
+        user and LibreServer packages. It is built first if it is not in the
+        cache. Each board then copies it and applies only its own steps.
+
+        """
+        inputs = self._get_base_rootfs_inputs()
+        key = utils.get_fingerprint(inputs)
+        directory = os.path.join(self.builder.cache_dir, 'rootfs', key)
+        os.makedirs(os.path.dirname(directory), exist_ok=True)
+        with library.lock_file(directory + '.lock'):
+            if os.path.isfile(directory + '.complete'):
+                logger.info('Using base root file system %s', directory)
+            else:
+                library.remove_chroot_directory(directory)
+                with open(directory + '.json', 'w') as file_handle:
+                    json.dump(inputs, file_handle, indent=4, sort_keys=True)
+
+                self._build_base_rootfs(directory)
+                open(directory + '.complete', 'w').close()
+
+            # Copy while holding the lock so that it is not pruned meanwhile
+            library.copy_rootfs(self.state, directory)
+
+        self._prune_base_rootfs(key, inputs)
+        return directory
+
+    def _prune_base_rootfs(self, key, inputs):
+        """Remove base root file systems superseded by the one with a key.
+
+        A base is superseded when its inputs differ only in those that change
+        over time, like the archive and LibreServer updates. Bases with other
+        kernel flavors, components or mirrors are kept.
+
+        """
+        rootfs_directory = os.path.join(self.builder.cache_dir, 'rootfs')
+        for name in sorted(os.listdir(rootfs_directory)):
+            directory = os.path.join(rootfs_directory, name)
+            if name == key or not os.path.isdir(directory):
+                continue
+
+            try:
+                with open(directory + '.json') as file_handle:
+                    other_inputs = json.load(file_handle)
+            except (FileNotFoundError, ValueError):
+                continue
+
+            fields = (set(inputs) | set(other_inputs)) - set(
+                TIME_VARYING_BASE_ROOTFS_INPUTS)
+            if any(
+                    other_inputs.get(field) != inputs.get(field)
+                    for field in fields):
+                continue
+
+            with library.lock_file(directory + '.lock'):
+                logger.info('Removing superseded base root file system %s',
+                            directory)
+                if os.path.exists(directory + '.complete'):
+                    os.remove(directory + '.complete')
+
+                library.remove_chroot_directory(directory)
+                if os.path.exists(directory + '.json'):
+                    os.remove(directory + '.json')
+
+    def _build_base_rootfs(self, directory):
+        """Build the base root file system in a directory."""
+        logger.info('Building base root file system %s', directory)
+        os.makedirs(directory)
+        state = {'success': True, 'mount_point': directory}
+        try:
+            library.enable_unsafe_io(state)
+            self._run_debootstrap(state, self._get_base_rootfs_packages())
+            library.defer_initramfs_updates(state)
+            self._mount_additional_filesystems(state)
+            self._setup_build_apt(state)
+            self._create_sudo_user(state)
+            self._install_libreserver_packages(state)
+            # Each board regenerates initramfs at the end of its build
+            library.restore_initramfs_config(state)
+        except (Exception, KeyboardInterrupt):
+            state['success'] = False
+            raise
+        finally:
+            library.cleanup(state)
+
     def _set_hostname(self):
         """Set hostname in debootstrapped file system."""
         library.set_hostname(self.state, self.builder.arguments.hostname)
@@ -264,87 +570,107 @@ class InternalBuilderBackend():
     def _install_webserver(self):
         """Setup webserver."""
         library.install_package(self.state, 'nginx')
-        # echo -e '<html><head><title>LibreServer</title></head><body bgcolor="linen" text="black"><div style="font-size: 100px; text-align: center;">LibreServer</div><div style="font-size: 38px; text-align: center;">To begin installation login with:</div><div style="font-size: 38px; text-align: center;"><p role="alert"><b>ssh admin@192.168.x.y</b></p></div><div style="font-size: 38px; text-align: center;"><p>The initial password is <b>libreserver</b>. After changing your password ssh back in again with your chosen password.</p><p>When the install is complete <i>ssh access will not be available</i> unless you turn it on via the settings screen.</p></div></body></html>' > /var/www/html/index.nginx-debian.html
-        script = 'echo -e ' + \
-            "'<html><head><title>LibreServer</title>" + \
-            "</head><body bgcolor=\"linen\" text=\"black\">" + \
-            "<div style=\"font-size: 100px; text-align: center;\">" + \
-            "LibreServer</div>" + \
-            "<div style=\"font-size: 38px; text-align: center;\">" + \
-            "To begin installation login with:</div>" + \
-            "<div style=\"font-size: 38px; " + \
-            "text-align: center;\"><p role=\"alert\">" + \
-            "<b>ssh admin@192.168.x.y</b>" + \
-            "</p></div>" + \
-            "<div style=\"font-size: 38px; text-align: center;\">" + \
-            "<p>The initial password is <b>libreserver</b>. " + \
-            "After changing your password ssh back in again " + \
-            "with your chosen password.</p>" + \
-            "<p>When the install is complete <i>ssh access " + \
-            "will not be available</i> unless you turn it on " + \
-            "via the settings screen.</p>" + \
-            "</div></body></html>'" + \
-            ' > /var/www/html/index.nginx-debian.html'
-        library.run_script_in_chroot(self.state, script)
-
-    def _install_libreserver_packages(self):
+        content = '<html><head><title>LibreServer</title>' + \
+            '</head><body bgcolor="linen" text="black">' + \
+            '<div style="font-size: 100px; text-align: center;">' + \
+            'LibreServer</div>' + \
+            '<div style="font-size: 38px; text-align: center;">' + \
+            'To begin installation login with:</div>' + \
+            '<div style="font-size: 38px; ' + \
+            'text-align: center;"><p role="alert">' + \
+            '<b>ssh admin@192.168.x.y</b>' + \
+            '</p></div>' + \
+            '<div style="font-size: 38px; text-align: center;">' + \
+            '<p>The initial password is <b>libreserver</b>. ' + \
+            'After changing your password ssh back in again ' + \
+            'with your chosen password.</p>' + \
+            '<p>When the install is complete <i>ssh access ' + \
+            'will not be available</i> unless you turn it on ' + \
+            'via the settings screen.</p>' + \
+            '</div></body></html>\n'
+        library.write_file(self.state,
+                           '/var/www/html/index.nginx-debian.html', content)
+
+    def _install_libreserver_packages(self, state=None):
         """Setup libreserver repo."""
-        library.install_package(self.state, 'git')
-        library.install_package(self.state, 'build-essential')
-        library.install_package(self.state, 'dialog')
-        library.install_package(self.state, 'man')
-        library.install_package(self.state, 'openssh-server')
-
-        libreserver_repo = 'https://gitlab.com/bashrc2/libreserver.git'
-        library.run_in_chroot(self.state, [
-            'git', 'clone', '--depth=1', '--branch', 'bullseye',
-            '--single-branch', libreserver_repo, '/root/libreserver'
-        ])
-
-        script = '''cd /root/libreserver;
-make install'''
-        library.run_script_in_chroot(self.state, script)
-        # echo -e "# start firstboot\necho -e '\n==LibreServer Installation==\n\nRun:\n\n  sudo libreserver menuconfig\n\nor\n\n  sudo libreserver menuconfig-onion\n\nto begin installation.\n\nFor more info:\n\n  man libreserver\n'\n# end firstboot" >> /home/admin/.bashrc
-        script = 'echo -e "# start firstboot\necho -e ' + \
-            "'\n==LibreServer Installation==\n\n" + \
+        if state is None:
+            if 'base_rootfs' in self.state:
+                return
+
+            state = self.state
+
+        library.install_package(state, 'git')
+        library.install_package(state, 'build-essential')
+        library.install_package(state, 'dialog')
+        library.install_package(state, 'man')
+        library.install_package(state, 'openssh-server')
+
+        arguments = self.builder.arguments
+        commit = self._get_libreserver_commit()
+        library.clone_git_mirror(state, self._get_libreserver_mirror(),
+                                 arguments.libreserver_branch,
+                                 '/root/libreserver',
+                                 arguments.libreserver_repository)
+
+        archive = os.path.join(
+            self.builder.cache_dir, 'libreserver-install',
+            '{}-{}.tar'.format(commit, self.builder.architecture))
+        os.makedirs(os.path.dirname(archive), exist_ok=True)
+        with library.lock_file(archive + '.lock'):
+            if not os.path.isfile(archive):
+                staging = '/tmp/libreserver-install'
+                script = '''cd /root/libreserver;
+make install DESTDIR={}'''.format(staging)
+                library.run_script_in_chroot(state, script)
+                library.archive_directory(
+                    library.path_in_root(state, staging), archive)
+                shutil.rmtree(library.path_in_root(state, staging))
+
+        library.extract_archive(state, archive)
+
+        content = "# start firstboot\necho -e '\n" + \
+            "==LibreServer Installation==\n\n" + \
             "Run:\n\n  sudo libreserver menuconfig\n\nor\n\n" + \
             "  sudo libreserver menuconfig-onion\n\n" + \
             "to begin installation.\n\n" + \
             "For more info:\n\n  man libreserver\n'" + \
-            '\n# end firstboot" >> /home/admin/.bashrc'
-        library.run_script_in_chroot(self.state, script)
+            "\n# end firstboot\n"
+        library.append_to_file(state, '/home/admin/.bashrc', content)
 
     def _enable_eth0(self):
         """Enable eth0 interface."""
-        library.run_in_chroot(self.state,
-                              ['ln', '-sf', '/dev/null',
-                               '/etc/systemd/network/99-default.link'])
+        library.make_symlink(self.state, '/dev/null',
+                             '/etc/systemd/network/99-default.link')
         library.update_initramfs(self.state)
-        # echo -e 'auto eth0\nallow-hotplug eth0\niface eth0 inet dhcp' > /etc/network/interfaces.d/dynamic
-        script = 'echo -e ' + \
-            "'auto eth0\nallow-hotplug eth0\niface eth0 inet dhcp'" + \
-            ' > /etc/network/interfaces.d/dynamic'
-        library.run_script_in_chroot(self.state, script)
+        library.write_file(
+            self.state, '/etc/network/interfaces.d/dynamic',
+            'auto eth0\nallow-hotplug eth0\niface eth0 inet dhcp\n')
 
     def _lock_root_user(self):
         """Lock the root user account."""
         logger.info('Locking root user')
         library.run_in_chroot(self.state, ['passwd', '-l', 'root'])
 
-    def _create_sudo_user(self):
+    def _create_sudo_user(self, state=None):
         """Create a user in the image with sudo permissions."""
-        library.install_package(self.state, 'sudo')
+        if state is None:
+            if 'base_rootfs' in self.state:
+                return
+
+            state = self.state
+
+        library.install_package(state, 'sudo')
         username = 'admin'
         logger.info('Creating a new sudo user %s', username)
         library.run_in_chroot(
-            self.state,
+            state,
             ['adduser', '--gecos', username, '--disabled-password', username])
 
-        library.run_in_chroot(self.state, ['adduser', username, 'sudo'])
-        script = 'chpasswd <<<"' + username + ':libreserver"'
-        library.run_script_in_chroot(self.state, script)
+        library.run_in_chroot(state, ['adduser', username, 'sudo'])
+        library.run_in_chroot(state, ['chpasswd'],
+                              feed_stdin=(username + ':libreserver').encode())
         # password should be changed on first login
-        library.run_in_chroot(self.state, ['chage', '-d0', 'admin'])
+        library.run_in_chroot(state, ['chage', '-d0', 'admin'])
 
     def _set_libreserver_disk_image_flag(self):
         """Set a flag to indicate that this is a LibreServer image.
@@ -352,34 +678,35 @@ make install'''
         And that LibreServer is not installed using a Debian package.
 
         """
-        library.run_in_chroot(
-            self.state, ['mkdir', '-p', '-m', '755', '/var/lib/libreserver'])
-        library.run_in_chroot(
-            self.state,
-            ['touch', '/var/lib/libreserver/is-libreserver-disk-image'])
+        library.make_directory(self.state, '/var/lib/libreserver', 0o755)
+        library.write_file(self.state,
+                           '/var/lib/libreserver/is-libreserver-disk-image',
+                           '')
 
     def _remove_ssh_keys(self):
         """Remove SSH keys so that images don't contain known keys."""
-        library.run_in_chroot(self.state,
-                              ['sh', '-c', 'rm -f /etc/ssh/ssh_host_*'],
-                              ignore_fail=True)
+        library.remove_files(self.state, '/etc/ssh/ssh_host_*')
 
     def _generate_keys_on_first_boot(self):
         """Generates keys on first boot."""
-        # echo -e '#!/bin/bash\nif [ ! -f /etc/ssh/ssh_host_ed25519_key.pub ]; then\n  dpkg-reconfigure openssh-server\nfi' > /usr/bin/firstboot_generate_keys
-        # chmod +x /usr/bin/firstboot_generate_keys
-        # echo '*/1 *   * * *   root    /usr/bin/firstboot_generate_keys' >> /etc/crontab
-        script = 'echo -e "#!/bin/bash\n' + \
+        content = '#!/bin/bash\n' + \
             'if [ ! -f /etc/ssh/ssh_host_ed25519_key.pub ]; then\n' + \
-            '  dpkg-reconfigure openssh-server\nfi"' + \
-            ' > /usr/bin/firstboot_generate_keys'
-        library.run_script_in_chroot(self.state, script)
-        library.run_in_chroot(self.state,
-                              ['chmod', '+x',
-                               '/usr/bin/firstboot_generate_keys'])
+            '  dpkg-reconfigure openssh-server\nfi\n'
+        library.write_file(self.state, '/usr/bin/firstboot_generate_keys',
+                           content, mode=0o755)
         script = '/usr/bin/bash -c /usr/bin/firstboot_generate_keys'
         library.add_cron_in_chroot(self.state, 1, script)
 
+    def _grow_root_on_first_boot(self):
+        """Grow the shrunk root partition to fill the disk on first boot."""
+        if not self.builder.shrink_image:
+            return
+
+        library.write_file(self.state, '/usr/bin/firstboot_grow_root',
+                           GROW_ROOT_SCRIPT, mode=0o755)
+        script = '/usr/bin/bash -c /usr/bin/firstboot_grow_root'
+        library.add_cron_in_chroot(self.state, 1, script)
+
     def _create_fstab(self):
         """Create fstab with entries for each paritition."""
         library.add_fstab_entry(self.state, 'root',
@@ -414,19 +741,44 @@ make install'''
 
         library.update_initramfs(self.state)
 
-    def _setup_build_apt(self):
+    def _update_initramfs(self):
+        """Run the initramfs update deferred during the build.
+
+        gzip is much cheaper than the default compressors when run under
+        emulation for foreign architectures.
+
+        """
+        compress = None
+        if not library.is_native_architecture(self.builder.architecture):
+            compress = 'gzip'
+
+        library.finish_initramfs_updates(self.state, compress=compress)
+
+    def _setup_build_apt(self, state=None):
         """Setup apt to use as the build mirror."""
+        state = self.state if state is None else state
         use_backports = self._should_use_backports()
-        library.setup_apt(self.state, self.builder.arguments.build_mirror,
+        security_mirror = library.SECURITY_MIRROR
+        snapshot = self.builder.arguments.snapshot
+        if snapshot:
+            library.enable_snapshot_apt(state)
+            security_mirror = library.SNAPSHOT_SECURITY_MIRROR.format(
+                snapshot)
+
+        library.setup_apt(state, self.builder.arguments.build_mirror,
                           self.builder.arguments.distribution,
                           self._get_components(),
-                          enable_backports=use_backports)
+                          enable_backports=use_backports,
+                          security_mirror=security_mirror)
 
     def _setup_final_apt(self):
         """Setup apt to use the image mirror."""
+        empty_lists = self.builder.arguments.empty_apt_lists
         library.setup_apt(self.state, self.builder.arguments.mirror,
                           self.builder.arguments.distribution,
-                          self._get_components())
+                          self._get_components(), update=not empty_lists)
+        if empty_lists:
+            library.remove_apt_lists(self.state)
 
     def _fill_free_space_with_zeros(self):
         """Fill up the free space in the image with zeros.
@@ -437,4 +789,12 @@ make install'''
 
     def _teardown(self):
         """Run cleanup operations for each step that executed."""
-        library.cleanup(self.state)
+        try:
+            library.cleanup(self.state)
+        finally:
+            library.report_leaked_loop_devices(self.state)
+
+    def _write_profile(self):
+        """Write timing of the build steps next to the image."""
+        library.write_build_profile(self.state, self.builder.profile_file)
+
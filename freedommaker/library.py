@@ -7,16 +7,75 @@ state of build process.
 """
 
 import contextlib
+import datetime
+import fcntl
+import glob
+import hashlib
+import json
 import logging
 import os
+import platform
 import re
 import shutil
+import signal
 import tempfile
+import time
+import urllib.request
+import uuid
 
 import cliapp
 
+from . import loop_devices, utils
+
+APT_LISTS = 'var/lib/apt/lists'
+DPKG_UNSAFE_IO_CONFIG = 'etc/dpkg/dpkg.cfg.d/freedommaker-unsafe-io'
+INITRAMFS_CONFIG = 'etc/initramfs-tools/update-initramfs.conf'
+INITRAMFS_COMPRESS_CONFIG = 'etc/initramfs-tools/conf.d/freedommaker-compress'
+APT_SNAPSHOT_CONFIG = 'etc/apt/apt.conf.d/freedommaker-snapshot'
+
+SECURITY_MIRROR = 'http://security.debian.org/debian-security/'
+SNAPSHOT_MIRROR = 'https://snapshot.debian.org/archive/debian/{}/'
+SNAPSHOT_SECURITY_MIRROR = \
+    'https://snapshot.debian.org/archive/debian-security/{}/'
+SNAPSHOT_FORMAT = '%Y%m%dT%H%M%SZ'
+
+PROCESS_CLEANUP_ATTEMPTS = 10
+
+# Alignment of partition and image sizes when shrinking the image
+SIZE_ALIGNMENT = 1024 * 1024
+
+# Largest file zstd can create patches for with --patch-from
+DELTA_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+# Backup GPT header and partition entries at the end of the disk
+GPT_BACKUP_SECTORS = 33
+
+# Namespace of UUIDs derived from build fingerprints in reproducible builds
+REPRODUCIBLE_UUID_NAMESPACE = uuid.UUID('13502a28-1d8a-4bc4-a5b6-340b240e083f')
+
+# Files that differ between builds of the same inputs
+VOLATILE_FILES = [
+    'var/cache/debconf/*-old',
+    'var/cache/ldconfig/aux-cache',
+    'var/lib/dpkg/*-old',
+    'var/log/alternatives.log',
+    'var/log/apt/*.log',
+    'var/log/apt/eipp.log.xz',
+    'var/log/bootstrap.log',
+    'var/log/dpkg.log',
+]
+
+# Bytes at the start of the disk occupied by each type of partition table
+PARTITION_TABLE_SIZES = {
+    'msdos': 512,
+    'gpt': 34 * 512,
+}
+
 logger = logging.getLogger(__name__)
 
+_updated_git_mirrors = set()
+_release_checksums = {}
+
 
 def run(*args, **kwargs):
     """Run a command."""
@@ -54,10 +113,8 @@ def run_script_in_chroot(state, script):
 
 def add_cron_in_chroot(state, mins, commandStr):
     """Add a cron entry inside chroot"""
-    script = 'echo "*/' + str(mins) + \
-        ' *   * * *   ' + \
-        'root    ' + commandStr + '" >> /etc/crontab'
-    run_script_in_chroot(state, script)
+    line = '*/' + str(mins) + ' *   * * *   ' + 'root    ' + commandStr
+    append_to_file(state, 'etc/crontab', line + '\n')
 
 
 def path_in_mount(state, path):
@@ -69,6 +126,82 @@ def path_in_mount(state, path):
     return os.path.join(state['mount_point'], path)
 
 
+def path_in_root(state, path):
+    """Return the host path for an absolute or relative path in the image."""
+    return path_in_mount(state, path.lstrip('/'))
+
+
+def make_directory(state, path, mode=0o755):
+    """Create a directory and its parents inside the image."""
+    logger.info('Creating directory %s in image', path)
+    full_path = path_in_root(state, path)
+    os.makedirs(full_path, exist_ok=True)
+    os.chmod(full_path, mode)
+
+
+def write_file(state, path, content, mode=0o644):
+    """Write a file inside the image replacing any existing file."""
+    logger.info('Writing file %s in image with mode %o', path, mode)
+    full_path = path_in_root(state, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    # Don't follow links that may point outside the image
+    if os.path.islink(full_path):
+        os.unlink(full_path)
+
+    with open(full_path, 'w') as file_handle:
+        file_handle.write(content)
+
+    os.chmod(full_path, mode)
+
+
+def append_to_file(state, path, content):
+    """Append content to a file inside the image."""
+    logger.info('Appending to file %s in image', path)
+    full_path = path_in_root(state, path)
+    with open(full_path, 'a') as file_handle:
+        file_handle.write(content)
+
+
+def edit_file(state, path, method):
+    """Rewrite a file inside the image using a method on its content."""
+    logger.info('Editing file %s in image', path)
+    full_path = path_in_root(state, path)
+    with open(full_path, 'r') as file_handle:
+        content = file_handle.read()
+
+    with open(full_path, 'w') as file_handle:
+        file_handle.write(method(content))
+
+
+def make_symlink(state, target, path):
+    """Create or replace a symbolic link inside the image."""
+    logger.info('Linking %s to %s in image', path, target)
+    full_path = path_in_root(state, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    if os.path.lexists(full_path):
+        os.unlink(full_path)
+
+    os.symlink(target, full_path)
+
+
+def remove_files(state, pattern):
+    """Remove files matching a glob pattern inside the image."""
+    logger.info('Removing files %s in image', pattern)
+    for full_path in glob.glob(path_in_root(state, pattern)):
+        os.unlink(full_path)
+
+
+@contextlib.contextmanager
+def lock_file(path):
+    """Hold an exclusive lock on a file while in the context."""
+    with open(path, 'a') as file_handle:
+        fcntl.flock(file_handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file_handle, fcntl.LOCK_UN)
+
+
 def schedule_cleanup(state, method, *args, **kwargs):
     """Make a note of the cleanup operations to happen."""
     state.setdefault('cleanup', []).append([method, args, kwargs])
@@ -82,6 +215,17 @@ def cleanup(state):
         method(*args, **kwargs)
 
 
+def write_build_profile(state, profile_file):
+    """Write the profile of the build as JSON."""
+    profile = state.get('profile', {})
+    logger.info('Critical path of the build (%.1fs): %s',
+                profile.get('critical_path_duration', 0),
+                ' -> '.join(profile.get('critical_path', [])))
+    logger.info('Writing build profile %s', profile_file)
+    with open(profile_file, 'w') as file_handle:
+        json.dump(profile, file_handle, indent=4, sort_keys=True)
+
+
 def create_ram_directory_image(state, image_file, size):
     """Create a temporary RAM directory."""
     logger.info('Create RAM directory for image: %s (%s)', image_file, size)
@@ -140,11 +284,107 @@ def create_image(state, size):
     run(['qemu-img', 'create', '-f', 'raw', state['image_file'], size])
 
 
+def shrink_filesystem(state, label, filesystem_type, margin):
+    """Shrink a mounted file system to its contents plus a margin in bytes.
+
+    Only btrfs file systems are shrunk. The new size is recorded in the state
+    for shrink_image().
+
+    """
+    if not state['success']:
+        return
+
+    mount_point = state['mount_point']
+    if filesystem_type != 'btrfs':
+        logger.warning('Shrinking %s file system is not supported',
+                       filesystem_type)
+        return
+
+    output = run(['btrfs', 'inspect-internal', 'min-dev-size', mount_point])
+    minimum_size = int(output.decode().split()[0])
+    size = _round_up(minimum_size + margin, SIZE_ALIGNMENT)
+    logger.info('Shrinking file system on %s to %s (minimum %s)', mount_point,
+                size, minimum_size)
+    run(['btrfs', 'filesystem', 'resize', str(size), mount_point])
+    state.setdefault('filesystem_sizes', {})[label] = size
+
+
+def shrink_image(state, label):
+    """Shrink the last partition and the image to fit its file system.
+
+    The file system must have been shrunk with shrink_filesystem() and its
+    partition must be the last one in the image.
+
+    """
+    if not state['success'] or \
+       label not in state.get('filesystem_sizes', {}):
+        return
+
+    image_file = state['image_file']
+    partition_number = state['partitions'].index(label) + 1
+    output = run(['sfdisk', '--json', image_file])
+    table = json.loads(output.decode())['partitiontable']
+    sector_size = table.get('sectorsize', 512)
+    partition = table['partitions'][partition_number - 1]
+
+    sectors = -(-state['filesystem_sizes'][label] // sector_size)
+    logger.info('Shrinking partition %s of %s to %s sectors', partition_number,
+                image_file, sectors)
+    run([
+        'sfdisk', '--no-reread', '--no-tell-kernel', '-N',
+        str(partition_number), image_file
+    ], feed_stdin=',{}\n'.format(sectors).encode())
+
+    size = (partition['start'] + sectors) * sector_size
+    if table['label'] == 'gpt':
+        size += GPT_BACKUP_SECTORS * sector_size
+
+    size = _round_up(size, SIZE_ALIGNMENT)
+    logger.info('Truncating image %s to %s bytes', image_file, size)
+    os.truncate(image_file, size)
+    if table['label'] == 'gpt':
+        run(['sfdisk', '--relocate', 'gpt-bak-std', image_file])
+
+
+def _round_up(value, alignment):
+    """Round up a value to a multiple of alignment."""
+    return -(-value // alignment) * alignment
+
+
 def create_partition_table(state, partition_table_type):
     """Create an empty partition table in given device."""
     logger.info('Creating partition table on %s of type %s',
                 state['image_file'], partition_table_type)
     run(['parted', '-s', state['image_file'], 'mklabel', partition_table_type])
+    state['partition_table_type'] = partition_table_type
+
+
+def get_reproducible_uuid(seed, name):
+    """Return a UUID that depends only on a seed and a name."""
+    return str(uuid.uuid5(REPRODUCIBLE_UUID_NAMESPACE, seed + '/' + name))
+
+
+def set_disk_identifiers(state, seed):
+    """Replace the random identifiers of the partition table.
+
+    The disk identifier and, for GPT, the partition UUIDs are derived from a
+    seed.
+
+    """
+    image_file = state['image_file']
+    logger.info('Setting partition table identifiers of %s', image_file)
+    disk_uuid = get_reproducible_uuid(seed, 'disk')
+    if state['partition_table_type'] != 'gpt':
+        run(['sfdisk', '--disk-id', image_file, '0x' + disk_uuid[:8]])
+        return
+
+    run(['sfdisk', '--disk-id', image_file, disk_uuid])
+    for number, label in enumerate(state['partitions'], start=1):
+        run([
+            'sfdisk', '--part-uuid', image_file,
+            str(number),
+            get_reproducible_uuid(seed, 'partition/' + label)
+        ])
 
 
 def create_partition(state, label, start, end, filesystem_type):
@@ -161,6 +401,9 @@ def create_partition(state, label, start, end, filesystem_type):
     ])
 
     state.setdefault('partitions', []).append(label)
+    start = utils.parse_disk_offset(start)
+    state['first_partition_start'] = min(
+        start, state.get('first_partition_start', start))
 
 
 def set_boot_flag(state, partition_number):
@@ -176,8 +419,11 @@ def set_boot_flag(state, partition_number):
 def loopback_setup(state):
     """Perform mapping to loopback devices from partitions in image file."""
     logger.info('Setting up loopback mappings for %s', state['image_file'])
-    output = run(['kpartx', '-asv', state['image_file']]).decode()
-    loop_device = None
+    loop_device = loop_devices.attach(state['image_file'])
+    state['loop_device'] = loop_device
+    schedule_cleanup(state, release_loop_device, loop_device)
+
+    output = run(['kpartx', '-asv', loop_device]).decode()
     devices = []
     partition_number = 0
     for line in output.splitlines():
@@ -188,19 +434,12 @@ def loopback_setup(state):
             state.setdefault('devices', {})[label] = device
             devices.append(device)
             partition_number += 1
-            if not loop_device:
-                loop_device = re.match(r'^(loop\d+)p\d+$', columns[2])[1]
-                loop_device = '/dev/{}'.format(loop_device)
-                state['loop_device'] = loop_device
 
     # Cleanup runs in reverse order
-    if loop_device:
-        schedule_cleanup(state, force_release_loop_device, loop_device)
-
     for device in devices:
         schedule_cleanup(state, force_release_partition_loop, device)
 
-    schedule_cleanup(state, loopback_teardown, state['image_file'])
+    schedule_cleanup(state, loopback_teardown, loop_device)
 
 
 def force_release_partition_loop(loop_device):
@@ -209,23 +448,54 @@ def force_release_partition_loop(loop_device):
     run(['dmsetup', 'remove', loop_device], ignore_fail=True)
 
 
-def force_release_loop_device(loop_device):
-    """Force release of a loop setup for entire device"""
-    logger.info('Force releasing loop setup for device %s', loop_device)
-    run(['losetup', '-d', loop_device], ignore_fail=True)
+def release_loop_device(loop_device):
+    """Release a loop device allocated for the build."""
+    logger.info('Releasing loop device %s', loop_device)
+    loop_devices.detach(loop_device)
+
+
+def loopback_teardown(loop_device):
+    """Unmap partitions of a loop device."""
+    logger.info('Tearing down loopback mappings for %s', loop_device)
+    run(['kpartx', '-dsv', loop_device])
+
+
+def reclaim_loop_devices():
+    """Release loop devices left behind by builds that no longer run."""
+    for loop_device in loop_devices.get_stale_devices():
+        logger.warning('Reclaiming loop device %s left by a dead build',
+                       loop_device)
+        run(['kpartx', '-dsv', loop_device], ignore_fail=True)
+        loop_devices.detach(loop_device)
+
 
+def report_leaked_loop_devices(state):
+    """Record loop devices that are still attached after cleanup."""
+    leaked = loop_devices.get_leaked_devices()
+    if leaked:
+        logger.warning('Loop devices leaked by the build: %s',
+                       ', '.join(leaked))
 
-def loopback_teardown(image_file):
-    """Unmap loopback devices from partitions in image file."""
-    logger.info('Tearing down loopback mappings for %s', image_file)
-    run(['kpartx', '-dsv', image_file])
+    state.setdefault('profile', {})['leaked_loop_devices'] = leaked
 
 
-def create_filesystem(device, filesystem_type):
-    """Create a filesystem on a given device."""
+def create_filesystem(device, filesystem_type, filesystem_uuid=None):
+    """Create a filesystem on a given device.
+
+    A UUID for the file system may be given instead of a random one.
+
+    """
     logger.info('Creating filesystem on %s of type %s', device,
                 filesystem_type)
-    run(['mkfs', '-t', filesystem_type, device])
+    options = []
+    if filesystem_uuid and filesystem_type == 'vfat':
+        options = ['-i', filesystem_uuid.replace('-', '')[:8]]
+    elif filesystem_uuid and filesystem_type.startswith('ext'):
+        options = ['-U', filesystem_uuid, '-E', 'hash_seed=' + filesystem_uuid]
+    elif filesystem_uuid:
+        options = ['-U', filesystem_uuid]
+
+    run(['mkfs', '-t', filesystem_type] + options + [device])
 
     # Due to a bug, probably in udev, /dev/disk/by-uuid/<uuid> link is not
     # reliably created after the creation of the filesystem. This leads to
@@ -270,13 +540,81 @@ def unmount_filesystem(device, mount_point, ignore_fail=False):
     run(['umount', mount_point], ignore_fail=ignore_fail)
 
 
+def get_mount_points(directory):
+    """Return mount points at or below a directory, most recent first."""
+    directory = os.path.realpath(directory)
+    mount_points = []
+    with open('/proc/self/mounts') as file_handle:
+        for line in file_handle:
+            # Spaces and other special characters are escaped in octal
+            mount_point = re.sub(r'\\([0-7]{3})',
+                                 lambda match: chr(int(match.group(1), 8)),
+                                 line.split()[1])
+            if mount_point == directory or \
+               mount_point.startswith(directory + '/'):
+                mount_points.append(mount_point)
+
+    return list(reversed(mount_points))
+
+
+def remove_chroot_directory(directory):
+    """Remove a directory that may hold a chroot with file systems mounted.
+
+    File systems left mounted by an interrupted build, such as bind mounts of
+    the host's /dev, are unmounted first. Nothing is removed if any of them
+    remain mounted.
+
+    """
+    for mount_point in get_mount_points(directory):
+        logger.warning('Unmounting leftover mount point %s', mount_point)
+        run(['umount', mount_point], ignore_fail=True)
+
+    remaining = get_mount_points(directory)
+    if remaining:
+        raise RuntimeError('Refusing to remove {}, still mounted: {}'.format(
+            directory, ', '.join(remaining)))
+
+    shutil.rmtree(directory, ignore_errors=True)
+
+
 def process_cleanup(state):
     """Kill all processes using a given mount point."""
     mount_point = state['mount_point']
     logger.info('Killing all processes on the mount point %s', mount_point)
-    run(['fuser', '-mvk', mount_point], ignore_fail=True)
-    # XXX: Twice seems to work better?
-    run(['fuser', '-mvk', mount_point], ignore_fail=True)
+    for _ in range(PROCESS_CLEANUP_ATTEMPTS):
+        # fuser prints the PIDs it has found on stdout
+        output = run(['fuser', '-mvk', mount_point], ignore_fail=True)
+        if not output.strip():
+            return
+
+        time.sleep(1)
+
+    logger.warning('Processes still remain on the mount point %s',
+                   mount_point)
+
+
+def kill_chroot_processes(state):
+    """Kill all processes whose root directory is inside the mount point.
+
+    Unlike process_cleanup(), this works when the mount point is a directory
+    on the host's file system.
+
+    """
+    mount_point = os.path.realpath(state['mount_point'])
+    logger.info('Killing all processes chrooted into %s', mount_point)
+    for root_link in glob.glob('/proc/[0-9]*/root'):
+        try:
+            root = os.readlink(root_link)
+        except OSError:
+            continue
+
+        if root == mount_point or root.startswith(mount_point + '/'):
+            pid = int(root_link.split('/')[2])
+            logger.info('Killing process %d', pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
 
 
 def setup_extra_storage(state, file_system_type, size):
@@ -288,8 +626,7 @@ def setup_extra_storage(state, file_system_type, size):
     mount_point = state['mount_point']
     logger.info('Adding extra storage to file system %s', mount_point)
     run(['qemu-img', 'create', '-f', 'raw', extra_storage_file, size])
-    output = run(['losetup', '--show', '--find', extra_storage_file])
-    loop_device = output.decode().strip()
+    loop_device = loop_devices.attach(extra_storage_file)
     run(['btrfs', 'device', 'add', loop_device, mount_point])
 
     schedule_cleanup(state, cleanup_extra_storage, state, loop_device,
@@ -307,7 +644,7 @@ def cleanup_extra_storage(state, loop_device, extra_storage_file):
 
     # Remove the extra storage device from btrfs filesystem
     run(['btrfs', 'device', 'remove', loop_device, mount_point])
-    run(['losetup', '--detach', loop_device])
+    release_loop_device(loop_device)
     run(['rm', '-f', extra_storage_file])
 
     _btrfs_rebalance(mount_point)
@@ -355,6 +692,16 @@ def qemu_debootstrap(state, architecture, distribution, variant, components,
                      ignore_fail=True)
 
 
+def copy_rootfs(state, source):
+    """Copy a root file system directory into the mount point."""
+    logger.info('Copying root file system %s to %s', source,
+                state['mount_point'])
+    run([
+        'cp', '--archive', '--reflink=auto', source + '/.',
+        state['mount_point']
+    ])
+
+
 def qemu_remove_binary(state):
     """Remove Qemu binary that may have been installed by qemu-debootstrap."""
     binaries = path_in_mount(state, 'usr/bin/qemu-*-static')
@@ -362,6 +709,35 @@ def qemu_remove_binary(state):
     run(['rm', '-f', binaries])
 
 
+def enable_unsafe_io(state):
+    """Make dpkg inside the image skip syncing each file it unpacks.
+
+    Writes of a failed build are thrown away anyway. This is done before
+    debootstrap so that its dpkg runs benefit too. All the data is flushed
+    with a single sync when the build is done.
+
+    """
+    logger.info('Enabling unsafe I/O for dpkg')
+    config_path = path_in_mount(state, DPKG_UNSAFE_IO_CONFIG)
+    os.makedirs(os.path.dirname(config_path), exist_ok=True)
+    with open(config_path, 'w') as file_handle:
+        file_handle.write('force-unsafe-io\n')
+
+    schedule_cleanup(state, disable_unsafe_io, state)
+
+
+def disable_unsafe_io(state):
+    """Restore safe I/O for dpkg and flush all data to the image."""
+    logger.info('Disabling unsafe I/O for dpkg')
+    try:
+        os.unlink(path_in_mount(state, DPKG_UNSAFE_IO_CONFIG))
+    except FileNotFoundError:
+        pass
+
+    logger.info('Flushing file system buffers')
+    os.sync()
+
+
 @contextlib.contextmanager
 def no_run_daemon_policy(state):
     """Context manager to ensure daemons are not run during installs."""
@@ -400,6 +776,16 @@ def install_package(state, package, install_from_backports=False):
             run_in_chroot(state, ['apt', 'autoremove', '-y'])
 
 
+def install_packages(state, packages):
+    """Install a list of packages using apt in one transaction."""
+    if not packages:
+        return
+
+    logger.info('Installing packages %s', ', '.join(packages))
+    with no_run_daemon_policy(state):
+        run_in_chroot(state, ['apt-get', 'install', '-y'] + packages)
+
+
 def install_custom_package(state, package_path):
     """Install a custom .deb file."""
     logger.info('Install custom .deb package %s', package_path)
@@ -413,6 +799,200 @@ def install_custom_package(state, package_path):
         run_in_chroot(state, ['gdebi', '-n', package_path])
 
 
+def update_git_mirror(repository, mirror_path):
+    """Create or update a bare mirror of a git repository on the host.
+
+    The mirror is updated only once per run of the program.
+
+    """
+    if mirror_path in _updated_git_mirrors:
+        return
+
+    os.makedirs(os.path.dirname(mirror_path), exist_ok=True)
+    with lock_file(mirror_path + '.lock'):
+        if os.path.isdir(mirror_path):
+            logger.info('Updating git mirror %s', mirror_path)
+            run(['git', '--git-dir', mirror_path, 'remote', 'set-url',
+                 'origin', repository])
+            run(['git', '--git-dir', mirror_path, 'remote', 'update',
+                 '--prune'])
+        else:
+            logger.info('Creating git mirror %s of %s', mirror_path,
+                        repository)
+            run(['git', 'clone', '--mirror', repository, mirror_path])
+
+    _updated_git_mirrors.add(mirror_path)
+
+
+def get_git_commit(mirror_path, branch):
+    """Return the commit hash of a branch in a git mirror."""
+    output = run([
+        'git', '--git-dir', mirror_path, 'rev-parse', '--verify',
+        branch + '^{commit}'
+    ])
+    return output.decode().strip()
+
+
+def get_release_checksum(mirror, distribution):
+    """Return the checksum of the Release file of a distribution in a mirror.
+
+    The Release file lists checksums of all package indices, so it changes
+    whenever any package in the distribution changes. It is fetched only once
+    per run of the program.
+
+    """
+    key = (mirror, distribution)
+    if key not in _release_checksums:
+        url = '{}/dists/{}/Release'.format(mirror.rstrip('/'), distribution)
+        logger.info('Fetching %s', url)
+        with urllib.request.urlopen(url) as response:
+            _release_checksums[key] = hashlib.sha256(
+                response.read()).hexdigest()
+
+    return _release_checksums[key]
+
+
+def clone_git_mirror(state, mirror_path, branch, path, origin):
+    """Clone a branch of a host git mirror into the image.
+
+    The clone is done by the host's git and its origin is then pointed to the
+    original repository.
+
+    """
+    destination = path_in_root(state, path)
+    logger.info('Cloning %s from mirror %s into %s', branch, mirror_path,
+                destination)
+    run([
+        'git', 'clone', '--depth=1', '--branch', branch, '--single-branch',
+        'file://' + os.path.abspath(mirror_path), destination
+    ])
+    run(['git', '-C', destination, 'remote', 'set-url', 'origin', origin])
+
+
+def archive_directory(directory, archive):
+    """Create a tar archive from the contents of a directory."""
+    if not os.listdir(directory):
+        raise ValueError('Refusing to archive empty directory ' + directory)
+
+    logger.info('Archiving %s into %s', directory, archive)
+    temp_archive = archive + '.temp'
+    run([
+        'tar', '--create', '--numeric-owner', '--file', temp_archive,
+        '--directory', directory, '.'
+    ])
+    os.rename(temp_archive, archive)
+
+
+def extract_archive(state, archive):
+    """Extract a tar archive into the root of the image.
+
+    Existing directories and symbolic links to directories, such as /bin in
+    merged /usr layout, are kept as they are.
+
+    """
+    logger.info('Extracting %s into image', archive)
+    run([
+        'tar', '--extract', '--numeric-owner', '--keep-directory-symlink',
+        '--no-overwrite-dir', '--file', archive, '--directory',
+        state['mount_point']
+    ])
+
+
+def get_source_package_files(state, package):
+    """Return the files of a source package as known to apt in the image.
+
+    Each item is a tuple of URL, file name, size and checksum.
+
+    """
+    output = run_in_chroot(
+        state, ['apt-get', 'source', '--print-uris', '--quiet', package])
+    files = []
+    for line in output.decode().splitlines():
+        match = re.match(r"^'([^']+)' (\S+) (\d+) (\S+)$", line)
+        if match:
+            files.append((match[1], match[2], int(match[3]), match[4]))
+
+    if not files:
+        raise ValueError('No source files found for package ' + package)
+
+    return files
+
+
+def _get_checksum_hash(checksum):
+    """Return a hash object and expected digest for an apt checksum.
+
+    apt prints checksums as '<type>:<digest>', or just the MD5 digest in
+    older versions.
+
+    """
+    hash_type, _, digest = checksum.rpartition(':')
+    hash_type = {'': 'md5', 'md5sum': 'md5'}.get(hash_type.lower(),
+                                                 hash_type.lower())
+    return hashlib.new(hash_type), digest.lower()
+
+
+def download_file(url, path, checksum):
+    """Download a file on the host and verify its checksum."""
+    logger.info('Downloading %s to %s', url, path)
+    file_hash, digest = _get_checksum_hash(checksum)
+    temp_path = path + '.temp'
+    with urllib.request.urlopen(url) as response, \
+            open(temp_path, 'wb') as file_handle:
+        for data in iter(lambda: response.read(1024 * 1024), b''):
+            file_hash.update(data)
+            file_handle.write(data)
+
+    if file_hash.hexdigest() != digest:
+        os.unlink(temp_path)
+        raise ValueError('Checksum mismatch for ' + url)
+
+    os.rename(temp_path, path)
+
+
+def fetch_source_package(state, package, cache_dir):
+    """Download and extract the upstream sources of a package on the host.
+
+    The version of the package available to apt in the image is used. Only
+    upstream tarballs are extracted, Debian changes are not applied. The
+    extracted sources are cached by version and the directory is returned.
+
+    """
+    files = get_source_package_files(state, package)
+    dsc_name = next(name for _, name, _, _ in files if name.endswith('.dsc'))
+    directory = os.path.join(cache_dir, 'sources', dsc_name[:-len('.dsc')])
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    with lock_file(directory + '.lock'):
+        if os.path.isdir(directory):
+            logger.info('Using cached sources %s', directory)
+            return directory
+
+        temp_directory = directory + '.temp'
+        shutil.rmtree(temp_directory, ignore_errors=True)
+        os.makedirs(temp_directory)
+        for url, name, _, checksum in files:
+            match = re.search(r'\.orig(-([\w-]+))?\.tar\.\w+$', name)
+            if not match and (re.search(r'\.debian\.tar\.\w+$', name)
+                              or not re.search(r'\.tar\.\w+$', name)):
+                continue
+
+            tarball = os.path.join(temp_directory, name)
+            download_file(url, tarball, checksum)
+            destination = temp_directory
+            if match and match[2]:
+                destination = os.path.join(temp_directory, match[2])
+                os.makedirs(destination)
+
+            run([
+                'tar', '--extract', '--no-same-owner', '--strip-components=1',
+                '--file', tarball, '--directory', destination
+            ])
+            os.unlink(tarball)
+
+        os.rename(temp_directory, directory)
+
+    return directory
+
+
 def set_hostname(state, hostname):
     """Set the hostname inside the image."""
     logger.info('Setting hostname to %s', hostname)
@@ -481,11 +1061,18 @@ def install_grub(state, target=None, is_efi=False):
     run_in_chroot(state, ['grub-install', device] + args)
 
 
-def setup_apt(state, mirror, distribution, components, enable_backports=False):
-    """Setup apt sources and update the cache."""
+def setup_apt(state, mirror, distribution, components, enable_backports=False,
+              update=True, security_mirror=SECURITY_MIRROR):
+    """Setup apt sources and update the cache.
+
+    The cache is not updated when the sources are same as the ones already
+    in the image and package lists for them are present.
+
+    """
     logger.info('Setting apt for mirror %s', mirror)
     values = {
         'mirror': mirror,
+        'security_mirror': security_mirror,
         'distribution': distribution,
         'components': ' '.join(components)
     }
@@ -498,33 +1085,137 @@ deb {mirror} {distribution}-updates {components}
 deb-src {mirror} {distribution}-updates {components}
 '''
     old_security_template = '''
-deb http://security.debian.org/debian-security/ {distribution}/updates {components}
-deb-src http://security.debian.org/debian-security/ {distribution}/updates {components}
+deb {security_mirror} {distribution}/updates {components}
+deb-src {security_mirror} {distribution}/updates {components}
 '''
     security_template = '''
-deb http://security.debian.org/debian-security/ {distribution}-security {components}
-deb-src http://security.debian.org/debian-security/ {distribution}-security {components}
+deb {security_mirror} {distribution}-security {components}
+deb-src {security_mirror} {distribution}-security {components}
 '''
     buster_backports_template = '''
-deb http://deb.debian.org/debian buster-backports main
-deb-src http://deb.debian.org/debian buster-backports main
+deb {mirror} buster-backports main
+deb-src {mirror} buster-backports main
 '''
+    content = basic_template.format(**values)
+    if distribution not in ('sid', 'unstable'):
+        content += updates_template.format(**values)
+        if enable_backports:
+            content += buster_backports_template.format(**values)
+        if distribution in ('bullseye', 'testing'):
+            content += security_template.format(**values)
+        else:  # stable/buster
+            content += old_security_template.format(**values)
+
     file_path = path_in_mount(state, 'etc/apt/sources.list')
-    with open(file_path, 'w') as file_handle:
-        file_handle.write(basic_template.format(**values))
-        if distribution not in ('sid', 'unstable'):
-            file_handle.write(updates_template.format(**values))
-            if enable_backports:
-                file_handle.write(buster_backports_template)
-            if distribution in ('bullseye', 'testing'):
-                file_handle.write(security_template.format(**values))
-            else:  # stable/buster
-                file_handle.write(old_security_template.format(**values))
-
-    run_in_chroot(state, ['apt-get', 'update'])
+    try:
+        with open(file_path, 'r') as file_handle:
+            unchanged = file_handle.read() == content
+    except FileNotFoundError:
+        unchanged = False
+
+    if unchanged and has_apt_lists(state):
+        logger.info('Apt sources are unchanged, not updating package lists')
+        update = False
+    else:
+        with open(file_path, 'w') as file_handle:
+            file_handle.write(content)
+
+    if update:
+        run_in_chroot(state, ['apt-get', 'update'])
+
     run_in_chroot(state, ['apt-get', 'clean'])
 
 
+def get_snapshot_id(snapshot):
+    """Return the timestamp of a snapshot of the Debian archive.
+
+    'now' is resolved to the current time, other values must already be
+    timestamps like 20210101T000000Z as used by snapshot.debian.org.
+
+    """
+    if snapshot == 'now':
+        return datetime.datetime.utcnow().strftime(SNAPSHOT_FORMAT)
+
+    try:
+        datetime.datetime.strptime(snapshot, SNAPSHOT_FORMAT)
+    except ValueError:
+        raise ValueError('Invalid snapshot: ' + snapshot)
+
+    return snapshot
+
+
+def enable_snapshot_apt(state):
+    """Let apt use the expired Release files of an archive snapshot."""
+    logger.info('Allowing apt to use expired Release files of snapshot')
+    config_path = path_in_mount(state, APT_SNAPSHOT_CONFIG)
+    with open(config_path, 'w') as file_handle:
+        file_handle.write('Acquire::Check-Valid-Until "false";\n')
+
+    schedule_cleanup(state, disable_snapshot_apt, state)
+
+
+def disable_snapshot_apt(state):
+    """Restore the checking of Release file expiry in apt."""
+    try:
+        os.unlink(path_in_mount(state, APT_SNAPSHOT_CONFIG))
+    except FileNotFoundError:
+        pass
+
+
+def get_local_mirror_path(mirror):
+    """Return the path of a mirror on the host's file system or None."""
+    if mirror.startswith('file://'):
+        return mirror[len('file://'):]
+
+    return None
+
+
+def mount_local_mirror(state, mirror):
+    """Bind mount a mirror on the host's file system into the image.
+
+    The mirror is made available at the same path inside the image so that
+    file:// sources work for apt in the chroot.
+
+    """
+    path = get_local_mirror_path(mirror)
+    if not path:
+        return
+
+    sub_mount_point = path.strip('/')
+    created_directories = []
+    directory = path_in_mount(state, sub_mount_point)
+    while not os.path.exists(directory):
+        created_directories.append(directory)
+        directory = os.path.dirname(directory)
+
+    # Scheduled first so that they are removed after unmounting
+    for directory in reversed(created_directories):
+        schedule_cleanup(state, os.rmdir, directory)
+
+    mount_filesystem(state, path, sub_mount_point, is_bind_mount=True)
+
+
+def has_apt_lists(state):
+    """Return whether package lists have been downloaded in the image."""
+    lists_path = path_in_mount(state, APT_LISTS)
+    return bool(glob.glob(os.path.join(lists_path, '*Release')))
+
+
+def remove_apt_lists(state):
+    """Remove downloaded package lists from the image."""
+    logger.info('Removing apt package lists')
+    lists_path = path_in_mount(state, APT_LISTS)
+    for file_path in glob.glob(os.path.join(lists_path, '*')):
+        if os.path.basename(file_path) == 'lock':
+            continue
+
+        if os.path.isdir(file_path):
+            for partial_path in glob.glob(os.path.join(file_path, '*')):
+                os.unlink(partial_path)
+        else:
+            os.unlink(file_path)
+
+
 def setup_flash_kernel(state, machine_name, kernel_options,
                        boot_filesystem_type):
     """Setup and install flash-kernel package."""
@@ -551,26 +1242,174 @@ def setup_flash_kernel(state, machine_name, kernel_options,
         run_in_chroot(state, ['flash-kernel'])
 
 
+def defer_initramfs_updates(state):
+    """Suppress initramfs regeneration until the end of the build.
+
+    Package installs trigger update-initramfs and the build itself needs it
+    several times. Under emulation, each run takes minutes. Disable the
+    updates in the image and remember that one is due instead.
+
+    """
+    config_path = path_in_mount(state, INITRAMFS_CONFIG)
+    if not os.path.isfile(config_path):
+        logger.info('Not deferring initramfs updates, %s not found',
+                    INITRAMFS_CONFIG)
+        return
+
+    logger.info('Deferring initramfs updates')
+    with open(config_path, 'r') as file_handle:
+        content = file_handle.read()
+
+    state['initramfs_config'] = content
+    new_content, count = re.subn(r'^update_initramfs=.*$',
+                                 'update_initramfs=no', content,
+                                 flags=re.MULTILINE)
+    if not count:
+        new_content += 'update_initramfs=no\n'
+
+    with open(config_path, 'w') as file_handle:
+        file_handle.write(new_content)
+
+    schedule_cleanup(state, restore_initramfs_config, state)
+
+
+def restore_initramfs_config(state):
+    """Re-enable initramfs updates in the image."""
+    content = state.pop('initramfs_config', None)
+    if content is None:
+        return
+
+    logger.info('Re-enabling initramfs updates')
+    with open(path_in_mount(state, INITRAMFS_CONFIG), 'w') as file_handle:
+        file_handle.write(content)
+
+
 def update_initramfs(state):
     """Update the initramfs in the disk image to make it use fstab etc."""
+    if 'initramfs_config' in state:
+        logger.info('Deferring initramfs update to the end of the build')
+        state['initramfs_pending'] = True
+        return
+
     logger.info('Updating initramfs')
     run_in_chroot(state, ['update-initramfs', '-u'])
 
 
-def install_boot_loader_part(state, path, seek, size, count=None):
-    """Do a dd copy for a file onto the disk image."""
+def finish_initramfs_updates(state, compress=None):
+    """Re-enable initramfs updates and run the deferred update once.
+
+    If compress is given, it overrides the compression method used for this
+    update only.
+
+    """
+    restore_initramfs_config(state)
+    if not state.pop('initramfs_pending', False):
+        return
+
+    compress_path = path_in_mount(state, INITRAMFS_COMPRESS_CONFIG)
+    if compress:
+        os.makedirs(os.path.dirname(compress_path), exist_ok=True)
+        logger.info('Using %s to compress initramfs', compress)
+        with open(compress_path, 'w') as file_handle:
+            file_handle.write('COMPRESS={}\n'.format(compress))
+
+    try:
+        update_initramfs(state)
+    finally:
+        if compress:
+            os.unlink(compress_path)
+
+
+def is_native_architecture(architecture):
+    """Return whether binaries of a Debian architecture run without qemu."""
+    native_architectures = {
+        'x86_64': ('amd64', 'i386'),
+        'i686': ('i386', ),
+        'aarch64': ('arm64', ),
+        'armv7l': ('armhf', ),
+    }
+    return architecture in native_architectures.get(platform.machine(), ())
+
+
+def install_boot_loader_part(state, path, offset, max_size=None):
+    """Write a file from the image onto the disk image at a byte offset.
+
+    The file must fit between the partition table and the first partition and,
+    if given, must not be larger than max_size. Written data is read back and
+    verified.
+
+    """
     image_file = state['image_file']
     full_path = path_in_mount(state, path)
-    logger.info('Installing boot loader part %s at seek=%s, size=%s, count=%s',
-                full_path, seek, size, count)
-    command = [
-        'dd', 'if=' + full_path, 'of=' + image_file, 'seek=' + seek,
-        'bs=' + size, 'conv=notrunc'
-    ]
-    if count:
-        command.append('count=' + count)
+    logger.info('Installing boot loader part %s at offset=%s, max_size=%s',
+                full_path, offset, max_size)
+    with open(full_path, 'rb') as file_handle:
+        data = file_handle.read()
+
+    if max_size is not None and len(data) > max_size:
+        raise ValueError('Boot loader part {} is larger than {} bytes'.format(
+            full_path, max_size))
+
+    table_end = PARTITION_TABLE_SIZES.get(state.get('partition_table_type'),
+                                          PARTITION_TABLE_SIZES['msdos'])
+    if offset < table_end:
+        raise ValueError(
+            'Boot loader part {} at {} overlaps partition table'.format(
+                full_path, offset))
+
+    first_partition_start = state.get('first_partition_start')
+    if first_partition_start is not None and \
+       offset + len(data) > first_partition_start:
+        raise ValueError(
+            'Boot loader part {} at {} overlaps first partition'.format(
+                full_path, offset))
+
+    file_descriptor = os.open(image_file, os.O_RDWR)
+    try:
+        written = 0
+        while written < len(data):
+            written += os.pwrite(file_descriptor, data[written:],
+                                 offset + written)
+
+        read_data = os.pread(file_descriptor, len(data), offset)
+    finally:
+        os.close(file_descriptor)
+
+    if hashlib.sha256(read_data).digest() != hashlib.sha256(data).digest():
+        raise ValueError(
+            'Verification failed for boot loader part ' + full_path)
+
+
+def remove_volatile_files(state):
+    """Remove files in the image that differ between identical builds.
+
+    /etc/machine-id is emptied so that it is generated on first boot.
+
+    """
+    for pattern in VOLATILE_FILES:
+        remove_files(state, pattern)
+
+    machine_id = path_in_mount(state, 'etc/machine-id')
+    if os.path.isfile(machine_id):
+        open(machine_id, 'w').close()
+
+    dbus_machine_id = path_in_mount(state, 'var/lib/dbus/machine-id')
+    if os.path.isfile(dbus_machine_id) and \
+       not os.path.islink(dbus_machine_id):
+        os.unlink(dbus_machine_id)
 
-    run(command)
+
+def clamp_timestamps(state, sub_mount_point, epoch):
+    """Set modification times newer than epoch to epoch in a file system."""
+    path = state['mount_point']
+    if sub_mount_point:
+        path = path_in_mount(state, sub_mount_point)
+
+    logger.info('Clamping modification times in %s to %d', path, epoch)
+    run([
+        'find', path, '-xdev', '-newermt', '@{}'.format(epoch), '-exec',
+        'touch', '--no-dereference', '--date=@{}'.format(epoch), '{}', '+'
+    ])
 
 
 def fill_free_space_with_zeros(state):
@@ -585,6 +1424,30 @@ def fill_free_space_with_zeros(state):
     run(['rm', '-f', zeros_path])
 
 
+def sparsify_image(image_file):
+    """Turn blocks of zeros in an image into holes."""
+    logger.info('Making image %s sparse', image_file)
+    run(['fallocate', '--dig-holes', image_file])
+
+
+def create_delta(source_file, target_file, delta_file):
+    """Create a zstd patch that turns source file into target file."""
+    logger.info('Creating delta %s from %s to %s', delta_file, source_file,
+                target_file)
+    run([
+        'zstd', '-19', '--threads=0', '--long=31', '--force',
+        '--patch-from=' + source_file, target_file, '-o', delta_file
+    ])
+
+
+def copy_file(source_file, target_file):
+    """Copy a file keeping it sparse."""
+    logger.info('Copying file: %s -> %s', source_file, target_file)
+    run([
+        'cp', '--sparse=always', '--reflink=auto', source_file, target_file
+    ])
+
+
 def compress(archive_file, image_file):
     """Compress an image using xz."""
     logger.info('Compressing file %s to %s', image_file, archive_file)
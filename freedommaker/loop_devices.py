@@ -0,0 +1,196 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Allocate and release loop devices through the kernel's loop control device.
+
+Allocations are recorded in a registry file shared by all builds running on
+the host so that devices left behind by builds that died can be found and
+released by later builds.
+"""
+
+import contextlib
+import errno
+import fcntl
+import json
+import logging
+import os
+import struct
+
+LOOP_CONTROL = '/dev/loop-control'
+REGISTRY_FILE = '/run/freedom-maker/loop-devices.json'
+
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_CTL_GET_FREE = 0x4C82
+LO_FLAGS_AUTOCLEAR = 4
+LO_NAME_SIZE = 64
+
+# struct loop_info64 from linux/loop.h
+LOOP_INFO64_FORMAT = '=QQQQQIIII64s64s32s2Q'
+
+ATTACH_ATTEMPTS = 10
+
+logger = logging.getLogger(__name__)
+
+_open_devices = {}
+
+
+@contextlib.contextmanager
+def _locked_registry():
+    """Yield the registry of allocated loop devices while holding its lock.
+
+    Changes made to the yielded dictionary are written back.
+
+    """
+    os.makedirs(os.path.dirname(REGISTRY_FILE), exist_ok=True)
+    with open(REGISTRY_FILE + '.lock', 'a') as lock_handle:
+        fcntl.flock(lock_handle, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(REGISTRY_FILE, 'r') as file_handle:
+                    registry = json.load(file_handle)
+            except (FileNotFoundError, ValueError):
+                registry = {}
+
+            yield registry
+
+            temp_file = REGISTRY_FILE + '.temp'
+            with open(temp_file, 'w') as file_handle:
+                json.dump(registry, file_handle, indent=4, sort_keys=True)
+
+            os.rename(temp_file, REGISTRY_FILE)
+        finally:
+            fcntl.flock(lock_handle, fcntl.LOCK_UN)
+
+
+def _is_process_alive(pid):
+    """Return whether a process with given PID exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def get_backing_file(device):
+    """Return the file attached to a loop device or None if it is free."""
+    name = os.path.basename(device)
+    try:
+        with open('/sys/block/{}/loop/backing_file'.format(name)) as file_:
+            return file_.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def attach(backing_file):
+    """Attach a file to a free loop device and return the device path.
+
+    The device is set to be cleared automatically once it is no longer used.
+    It is kept open by this process until detach() is called.
+
+    """
+    backing_file = os.path.abspath(backing_file)
+    file_descriptor = os.open(backing_file, os.O_RDWR)
+    try:
+        control = os.open(LOOP_CONTROL, os.O_RDWR)
+        try:
+            for _ in range(ATTACH_ATTEMPTS):
+                number = fcntl.ioctl(control, LOOP_CTL_GET_FREE)
+                device = '/dev/loop{}'.format(number)
+                loop_descriptor = os.open(device, os.O_RDWR)
+                try:
+                    fcntl.ioctl(loop_descriptor, LOOP_SET_FD, file_descriptor)
+                    break
+                except OSError as exception:
+                    os.close(loop_descriptor)
+                    # Another process took the device in the meantime
+                    if exception.errno != errno.EBUSY:
+                        raise
+            else:
+                raise RuntimeError('Unable to find a free loop device')
+        finally:
+            os.close(control)
+    finally:
+        os.close(file_descriptor)
+
+    file_name = backing_file.encode()[:LO_NAME_SIZE - 1]
+    info = struct.pack(LOOP_INFO64_FORMAT, 0, 0, 0, 0, 0, number, 0, 0,
+                       LO_FLAGS_AUTOCLEAR, file_name, b'', b'', 0, 0)
+    try:
+        fcntl.ioctl(loop_descriptor, LOOP_SET_STATUS64, info)
+    except OSError:
+        fcntl.ioctl(loop_descriptor, LOOP_CLR_FD)
+        os.close(loop_descriptor)
+        raise
+
+    _open_devices[device] = loop_descriptor
+    with _locked_registry() as registry:
+        registry[device] = {'pid': os.getpid(), 'backing_file': backing_file}
+
+    logger.info('Attached %s to loop device %s', backing_file, device)
+    return device
+
+
+def detach(device):
+    """Detach a loop device allocated by this process.
+
+    If the device is still in use, the kernel detaches it once the last user
+    closes it.
+
+    """
+    loop_descriptor = _open_devices.pop(device, None)
+    if loop_descriptor is None:
+        loop_descriptor = os.open(device, os.O_RDWR)
+
+    try:
+        fcntl.ioctl(loop_descriptor, LOOP_CLR_FD)
+    except OSError as exception:
+        if exception.errno != errno.ENXIO:
+            raise
+    finally:
+        os.close(loop_descriptor)
+
+    with _locked_registry() as registry:
+        registry.pop(device, None)
+
+    logger.info('Detached loop device %s', device)
+
+
+def get_stale_devices():
+    """Return devices allocated by processes that no longer exist.
+
+    Entries for devices that have already been released are dropped from the
+    registry.
+
+    """
+    stale = []
+    with _locked_registry() as registry:
+        for device, entry in list(registry.items()):
+            if _is_process_alive(entry['pid']):
+                continue
+
+            if get_backing_file(device) == entry['backing_file']:
+                stale.append(device)
+            else:
+                del registry[device]
+
+    return stale
+
+
+def get_leaked_devices():
+    """Return devices allocated by this process that are still attached."""
+    leaked = []
+    with _locked_registry() as registry:
+        for device, entry in list(registry.items()):
+            if entry['pid'] != os.getpid():
+                continue
+
+            if get_backing_file(device) == entry['backing_file']:
+                leaked.append(device)
+            else:
+                del registry[device]
+
+    return leaked
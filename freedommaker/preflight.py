@@ -0,0 +1,274 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Checks that the build host is capable of building the selected targets.
+
+All checks are run in parallel before any build starts so that a missing tool
+or kernel feature is reported in seconds instead of failing the build after
+an hour. Checks of the host that don't change between runs are cached.
+"""
+
+import concurrent.futures
+import json
+import logging
+import os
+import shutil
+import time
+
+from . import library, utils
+from .builder import get_build_image_size
+
+COMMANDS = [
+    'blkid', 'btrfs', 'dmsetup', 'fallocate', 'fuser', 'git', 'kpartx', 'mkfs',
+    'mount', 'parted', 'qemu-debootstrap', 'qemu-img', 'sfdisk', 'tar',
+    'udevadm', 'umount'
+]
+
+# Names used by binfmt_misc handlers registered by qemu-user-static
+QEMU_ARCHITECTURES = {
+    'amd64': 'x86_64',
+    'arm64': 'aarch64',
+    'armhf': 'arm',
+    'i386': 'i386',
+}
+
+CACHE_FILE = 'preflight.json'
+CACHE_VALIDITY = 24 * 60 * 60
+
+logger = logging.getLogger(__name__)
+
+
+class Check():
+    """A single capability of the host that is required for building."""
+    def __init__(self, name, method, *args, cacheable=True):
+        """Initialize the check.
+
+        method is called with args and returns None if the host has the
+        capability or a message explaining what is missing. Only cacheable
+        checks are remembered across runs.
+
+        """
+        self.name = name
+        self.method = method
+        self.args = args
+        self.cacheable = cacheable
+
+    def run(self):
+        """Run the check and return None or a failure message."""
+        try:
+            return self.method(*self.args)
+        except Exception as exception:  # pylint: disable=broad-except
+            return '{}: {}'.format(self.name, exception)
+
+
+def check_command(command):
+    """Check that a command is available."""
+    if not shutil.which(command):
+        return 'Command "{}" not found'.format(command)
+
+    return None
+
+
+def check_binfmt(architecture):
+    """Check that binaries of an architecture can be run through qemu."""
+    if library.is_native_architecture(architecture):
+        return None
+
+    qemu_architecture = QEMU_ARCHITECTURES.get(architecture, architecture)
+    handler = '/proc/sys/fs/binfmt_misc/qemu-' + qemu_architecture
+    try:
+        with open(handler) as file_handle:
+            if file_handle.readline().strip() == 'enabled':
+                return None
+    except FileNotFoundError:
+        pass
+
+    return 'No enabled binfmt_misc handler for {} binaries ({}), install ' \
+        'qemu-user-static and binfmt-support'.format(architecture, handler)
+
+
+def check_filesystem(filesystem_type):
+    """Check that the kernel supports a file system."""
+    with open('/proc/filesystems') as file_handle:
+        for line in file_handle:
+            if filesystem_type in line.split():
+                return None
+
+    # Module is loaded on first mount
+    modules_file = '/lib/modules/{}/modules.dep'.format(os.uname().release)
+    try:
+        with open(modules_file) as file_handle:
+            for line in file_handle:
+                module = line.split(':', maxsplit=1)[0]
+                if os.path.basename(module).startswith(filesystem_type +
+                                                       '.ko'):
+                    return None
+    except FileNotFoundError:
+        pass
+
+    return 'Kernel does not support {} file system, try "modprobe {}"'.format(
+        filesystem_type, filesystem_type)
+
+
+def check_loop_control():
+    """Check that loop devices can be allocated."""
+    if not os.path.exists('/dev/loop-control'):
+        return '/dev/loop-control not found, try "modprobe loop"'
+
+    return None
+
+
+def check_root():
+    """Check that the build is running as root."""
+    if os.geteuid() != 0:
+        return 'Building images requires running as "root" user'
+
+    return None
+
+
+def check_disk_space(directory, size):
+    """Check that a directory has a given number of bytes free."""
+    os.makedirs(directory, exist_ok=True)
+    stat = os.statvfs(directory)
+    available = stat.f_bavail * stat.f_frsize
+    if available < size:
+        return 'Not enough free space in {}: {} needed, {} available'.format(
+            directory, utils.format_disk_size(size),
+            utils.format_disk_size(available))
+
+    return None
+
+
+def check_memory(size):
+    """Check that a given number of bytes of memory is available."""
+    with open('/proc/meminfo') as file_handle:
+        for line in file_handle:
+            if line.startswith('MemAvailable:'):
+                available = int(line.split()[1]) * 1024
+                break
+        else:
+            return 'Unable to find available memory in /proc/meminfo'
+
+    if available < size:
+        return 'Not enough memory to build in RAM: {} needed, {} ' \
+            'available'.format(utils.format_disk_size(size),
+                               utils.format_disk_size(available))
+
+    return None
+
+
+def get_checks(builder_classes, arguments):
+    """Return the checks needed to build images with given builders."""
+    commands = set(COMMANDS)
+    architectures = set()
+    root_filesystem_types = set()
+    image_size = utils.parse_disk_size(
+        get_build_image_size(arguments.image_size))
+    build_size = 0
+    for cls in builder_classes:
+        commands.update(cls.required_commands)
+        architectures.add(cls.architecture)
+        root_filesystem_types.add(cls.root_filesystem_type)
+        for filesystem_type in (cls.root_filesystem_type,
+                                cls.boot_filesystem_type,
+                                cls.efi_filesystem_type,
+                                cls.firmware_filesystem_type):
+            if filesystem_type:
+                commands.add('mkfs.' + filesystem_type)
+
+        extra_storage_size = utils.parse_disk_size(cls.extra_storage_size)
+        build_size = max(build_size, image_size + extra_storage_size)
+
+    if not arguments.skip_compression:
+        commands.add('xz')
+
+    if arguments.sign:
+        commands.add('gpg')
+
+    if arguments.delta:
+        commands.add('zstd')
+
+    checks = [Check('root', check_root, cacheable=False)]
+    checks += [
+        Check('command:' + command, check_command, command)
+        for command in sorted(commands)
+    ]
+    checks += [
+        Check('binfmt:' + architecture, check_binfmt, architecture)
+        for architecture in sorted(architectures)
+    ]
+    checks += [
+        Check('filesystem:' + filesystem_type, check_filesystem,
+              filesystem_type)
+        for filesystem_type in sorted(root_filesystem_types)
+    ]
+    checks.append(Check('loop-control', check_loop_control))
+    checks.append(
+        Check('disk-space', check_disk_space, arguments.build_dir,
+              build_size, cacheable=False))
+    if arguments.build_in_ram:
+        ram_size = build_size + utils.parse_disk_size('100M')
+        checks.append(
+            Check('memory', check_memory, ram_size, cacheable=False))
+
+    return checks
+
+
+def _get_host_key():
+    """Return a key identifying the host setup that cached checks ran on."""
+    return utils.get_fingerprint({
+        'uname': list(os.uname()),
+        'path': os.environ.get('PATH'),
+    })
+
+
+def _read_cache(cache_file):
+    """Return names of checks that recently passed on this host."""
+    try:
+        with open(cache_file) as file_handle:
+            cache = json.load(file_handle)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+    if cache.get('host') != _get_host_key():
+        return {}
+
+    now = time.time()
+    return {
+        name: passed_time
+        for name, passed_time in cache.get('passed', {}).items()
+        if now - passed_time < CACHE_VALIDITY
+    }
+
+
+def _write_cache(cache_file, passed):
+    """Remember the checks that passed on this host."""
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file, 'w') as file_handle:
+        json.dump({
+            'host': _get_host_key(),
+            'passed': passed
+        }, file_handle, indent=4, sort_keys=True)
+
+
+def run_checks(checks, cache_dir):
+    """Run checks in parallel and return a list of failure messages."""
+    cache_file = os.path.join(cache_dir, CACHE_FILE)
+    passed = _read_cache(cache_file)
+    pending = [
+        check for check in checks
+        if not (check.cacheable and check.name in passed)
+    ]
+    logger.info('Running %d preflight checks, %d cached', len(pending),
+                len(checks) - len(pending))
+
+    failures = []
+    now = time.time()
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        for check, failure in zip(pending, executor.map(Check.run, pending)):
+            if failure:
+                failures.append(failure)
+            elif check.cacheable:
+                passed[check.name] = now
+
+    _write_cache(cache_file, passed)
+    return failures
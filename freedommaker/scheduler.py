@@ -0,0 +1,180 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Dependency aware scheduler for the steps that make up an image build.
+"""
+
+import concurrent.futures
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Step():
+    """A unit of work in the build along with what it depends on."""
+    def __init__(self, name, method, requires=(), resources=()):
+        """Initialize the step.
+
+        requires is a list of names of steps that must finish before this step
+        starts. resources is a list of names of resources that this step holds
+        exclusively while it is running.
+
+        """
+        self.name = name
+        self.method = method
+        self.requires = tuple(requires)
+        self.resources = frozenset(resources)
+
+    def __repr__(self):
+        """Return a printable representation of the step."""
+        return 'Step({})'.format(self.name)
+
+
+def validate_steps(steps):
+    """Raise ValueError if the steps don't form a proper dependency graph."""
+    names = [step.name for step in steps]
+    if len(names) != len(set(names)):
+        raise ValueError('Duplicate step names')
+
+    for step in steps:
+        for requirement in step.requires:
+            if requirement not in names:
+                raise ValueError('Step {} requires unknown step {}'.format(
+                    step.name, requirement))
+
+    sort_steps(steps)
+
+
+def sort_steps(steps):
+    """Return steps in an order where each step follows its requirements.
+
+    Among the steps that are ready at a time, the declared order is kept.
+
+    """
+    done = set()
+    result = []
+    pending = list(steps)
+    while pending:
+        for step in pending:
+            if set(step.requires) <= done:
+                break
+        else:
+            raise ValueError('Cyclic dependency among steps: {}'.format(
+                ', '.join(step.name for step in pending)))
+
+        pending.remove(step)
+        done.add(step.name)
+        result.append(step)
+
+    return result
+
+
+def run_steps(steps, jobs=1, profile=None):
+    """Run steps concurrently while honoring dependencies and resources.
+
+    A step is started as soon as all the steps it requires have finished and
+    none of its resources are held by another running step. If a step fails,
+    no further steps are started, the running ones are waited for and the
+    first exception is raised.
+
+    If a profile dictionary is given, timing of each step and the critical
+    path of the build are recorded into it.
+
+    """
+    validate_steps(steps)
+    if profile is None:
+        profile = {}
+
+    profile.setdefault('steps', {})
+    profile['jobs'] = jobs
+    start_time = time.monotonic()
+
+    done = set()
+    held = set()
+    pending = list(steps)
+    running = {}
+    failure = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            if failure is None:
+                for step in list(pending):
+                    if len(running) >= jobs:
+                        break
+
+                    if not set(step.requires) <= done or \
+                       step.resources & held:
+                        continue
+
+                    pending.remove(step)
+                    held |= step.resources
+                    future = executor.submit(_run_step, step, profile,
+                                             start_time)
+                    running[future] = step
+
+            if not running:
+                break
+
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                held -= step.resources
+                try:
+                    future.result()
+                    done.add(step.name)
+                except Exception as exception:  # pylint: disable=broad-except
+                    logger.error('Step failed - %s', step.name)
+                    failure = failure or exception
+
+    profile['duration'] = time.monotonic() - start_time
+    path, duration = critical_path(steps, profile)
+    profile['critical_path'] = path
+    profile['critical_path_duration'] = duration
+
+    if failure:
+        raise failure
+
+
+def _run_step(step, profile, start_time):
+    """Run a single step and record its timing."""
+    logger.info('Running step - %s', step.name)
+    timing = {'start': time.monotonic() - start_time}
+    profile['steps'][step.name] = timing
+    try:
+        step.method()
+    finally:
+        timing['end'] = time.monotonic() - start_time
+        timing['duration'] = timing['end'] - timing['start']
+
+
+def critical_path(steps, profile):
+    """Return the longest chain of dependent steps and its total duration.
+
+    Only steps that have been run, as recorded in the profile, are
+    considered.
+
+    """
+    timings = profile.get('steps', {})
+    costs = {}
+    previous = {}
+    for step in sort_steps(steps):
+        if step.name not in timings:
+            continue
+
+        requirements = [name for name in step.requires if name in costs]
+        before = max(requirements, key=lambda name: costs[name], default=None)
+        previous[step.name] = before
+        costs[step.name] = timings[step.name].get('duration', 0) + \
+            (costs[before] if before else 0)
+
+    if not costs:
+        return [], 0
+
+    last = max(costs, key=lambda name: costs[name])
+    duration = costs[last]
+    path = []
+    while last:
+        path.insert(0, last)
+        last = previous[last]
+
+    return path, duration
@@ -0,0 +1,91 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Tests for the benchmarks of image building.
+"""
+
+import argparse
+import os
+import subprocess
+import tempfile
+import unittest
+
+from ..benchmarks import pipeline, primitives
+
+
+class TestPipelineBenchmark(unittest.TestCase):
+    """Test running build steps against recorded commands."""
+    def setUp(self):
+        """Common setup for each test."""
+        self.arguments = argparse.Namespace(targets=['amd64', 'raspberry3'],
+                                            jobs=2, timings=False,
+                                            latencies={}, default_latency=0)
+
+    def test_run_benchmark(self):
+        """Test that all steps run and counts are the same on every run."""
+        results = pipeline.run_benchmark(self.arguments)
+        self.assertEqual(sorted(results['targets']), ['amd64', 'raspberry3'])
+        for result in results['targets'].values():
+            self.assertGreater(result['spawns'], 0)
+            self.assertGreater(result['chroot_invocations'], 0)
+            self.assertIn('debootstrap', result['steps'])
+            self.assertIn(pipeline.TEARDOWN, result['steps'])
+            self.assertTrue(result['projected_critical_path'])
+            self.assertNotIn('duration', result)
+
+        self.assertEqual(pipeline.run_benchmark(self.arguments), results)
+
+    def test_parse_latency(self):
+        """Test parsing simulated latencies of commands."""
+        self.assertEqual(pipeline.parse_latency('apt-get=0.5'),
+                         ('apt-get', 0.5))
+        with self.assertRaises(argparse.ArgumentTypeError):
+            pipeline.parse_latency('apt-get')
+
+
+class TestPrimitivesBenchmark(unittest.TestCase):
+    """Test the helpers of benchmarks on real image files."""
+    def test_create_sample_image(self):
+        """Test that sample images have data, zeros and holes."""
+        with tempfile.TemporaryDirectory() as directory:
+            image_file = os.path.join(directory, 'sample.img')
+            size = 4 * primitives.STRIPE_SIZE
+            primitives.create_sample_image(image_file, size)
+            self.assertEqual(os.path.getsize(image_file), size)
+            with open(image_file, 'rb') as file_handle:
+                data = file_handle.read()
+
+            stripes = [
+                data[offset:offset + primitives.STRIPE_SIZE]
+                for offset in range(0, size, primitives.STRIPE_SIZE)
+            ]
+            self.assertNotEqual(stripes[0], bytes(primitives.STRIPE_SIZE))
+            self.assertEqual(stripes[2], bytes(primitives.STRIPE_SIZE))
+            self.assertEqual(stripes[3], bytes(primitives.STRIPE_SIZE))
+
+    def test_measure(self):
+        """Test measuring a method in a forked process."""
+        # Memory of the parent process is not counted
+        parent_data = bytearray(64 * 1024 * 1024)
+        result = primitives.measure(sum, [1, 2])
+        self.assertGreaterEqual(result['duration'], 0)
+        self.assertEqual(result['commands_peak_rss'], 0)
+        self.assertLess(result['rss_increase'], 16 * 1024 * 1024)
+        del parent_data
+
+        result = primitives.measure(bytearray, 64 * 1024 * 1024)
+        self.assertGreater(result['rss_increase'], 48 * 1024 * 1024)
+
+        result = primitives.measure(subprocess.run, ['true'], check=True)
+        self.assertGreater(result['commands_peak_rss'], 0)
+
+        result = primitives.measure(os.stat, '/freedom-maker-missing')
+        self.assertIn('freedom-maker-missing', result['error'])
+
+    def test_skip_reason(self):
+        """Test that benchmarks with missing commands are skipped."""
+        benchmark = primitives.Benchmark('test', None,
+                                         ('freedom-maker-missing', ))
+        self.assertIn('not found', benchmark.get_skip_reason())
+        self.assertEqual(
+            primitives.run_benchmark(benchmark, {}, 1),
+            {'skipped': benchmark.get_skip_reason()})
@@ -0,0 +1,69 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Tests for creating block maps of images.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+import unittest
+
+from .. import bmap
+
+
+class TestBmap(unittest.TestCase):
+    """Test creating block maps of sparse images."""
+    def setUp(self):
+        """Common setup for each test."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.image_file = os.path.join(self.directory.name, 'test.img')
+        self.bmap_file = self.image_file + '.bmap'
+
+    def tearDown(self):
+        """Cleanup the test case."""
+        self.directory.cleanup()
+
+    def test_get_block_ranges(self):
+        """Test converting byte ranges into merged block ranges."""
+        self.assertEqual(
+            bmap.get_block_ranges([(0, 4096), (4096, 8193), (20480, 20481)]),
+            [(0, 2), (5, 5)])
+        self.assertEqual(bmap.get_block_ranges([(100, 200), (300, 400)]),
+                         [(0, 0)])
+        self.assertEqual(bmap.get_block_ranges([]), [])
+
+    def test_write_bmap(self):
+        """Test writing a block map for a sparse image."""
+        data = b'x' * 4096
+        size = 1024 * 1024 + 100
+        with open(self.image_file, 'wb') as file_handle:
+            file_handle.truncate(size)
+            file_handle.write(data)
+            file_handle.seek(size - 100)
+            file_handle.write(b'y' * 100)
+
+        bmap.write_bmap(self.image_file, self.bmap_file)
+        with open(self.bmap_file) as file_handle:
+            content = file_handle.read()
+
+        self.assertIn('<ImageSize> {} </ImageSize>'.format(size), content)
+        self.assertIn('<BlocksCount> 257 </BlocksCount>', content)
+        self.assertIn(
+            '<Range chksum="{}"> 0 </Range>'.format(
+                hashlib.sha256(data).hexdigest()), content)
+
+        last_block = size // 4096 * 4096
+        with open(self.image_file, 'rb') as file_handle:
+            file_handle.seek(last_block)
+            last_data = file_handle.read()
+
+        self.assertIn(
+            '<Range chksum="{}"> 256 </Range>'.format(
+                hashlib.sha256(last_data).hexdigest()), content)
+
+        checksum = re.search(r'<BmapFileChecksum> (\w+) </BmapFileChecksum>',
+                             content)[1]
+        zeroed = content.replace(checksum, '0' * 64)
+        self.assertEqual(
+            hashlib.sha256(zeroed.encode()).hexdigest(), checksum)
@@ -0,0 +1,238 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Tests for the registry of image builders.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import pkgutil
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from .. import builders
+from ..builder import ImageBuilder
+from ..builders.beaglebone import BeagleBoneImageBuilder
+
+
+class TestBuilders(unittest.TestCase):
+    """Test looking up builders for targets."""
+    def test_get_builder_class(self):
+        """Test that each registered target maps to its builder."""
+        for target in builders.get_target_names():
+            cls = ImageBuilder.get_builder_class(target)
+            self.assertTrue(issubclass(cls, ImageBuilder))
+            self.assertEqual(cls.get_target_name(), target)
+
+        with self.assertRaises(ValueError):
+            ImageBuilder.get_builder_class('unknown-target')
+
+    def test_all_builders_registered(self):
+        """Test that every builder with a target is in the registry."""
+        for module_info in pkgutil.iter_modules(builders.__path__):
+            importlib.import_module('.' + module_info.name,
+                                    builders.__name__)
+
+        # Base classes have no target or the default machine 'all'
+        targets = {
+            subclass.get_target_name()
+            for subclass in ImageBuilder.get_subclasses()
+        }
+        self.assertEqual(targets - {None, 'all'},
+                         set(builders.get_target_names()))
+
+
+class TestDelta(unittest.TestCase):
+    """Test creating deltas from previous builds of a target."""
+    def setUp(self):
+        """Common setup for each test."""
+        self.build_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        """Cleanup the test case."""
+        self.build_dir.cleanup()
+
+    def get_builder(self, build_stamp):
+        """Return a builder with an image built for a build stamp."""
+        arguments = argparse.Namespace(build_dir=self.build_dir.name,
+                                       cache_dir=None,
+                                       distribution='bullseye',
+                                       build_stamp=build_stamp, delta=True,
+                                       image_size='7800M')
+        builder = BeagleBoneImageBuilder(arguments)
+        with open(builder.image_file, 'wb') as file_handle:
+            file_handle.write(build_stamp.encode())
+
+        return builder
+
+    @patch('freedommaker.library.copy_file', side_effect=shutil.copyfile)
+    @patch('freedommaker.library.create_delta')
+    def test_create_delta(self, create_delta, _copy_file):
+        """Test that deltas are created against the previous build."""
+        builder = self.get_builder('2021-01-01')
+        builder.create_delta(builder.image_file)
+        create_delta.assert_not_called()
+
+        builder = self.get_builder('2021-01-02')
+        builder.create_delta(builder.image_file)
+        previous_file = create_delta.call_args[0][0]
+        self.assertEqual(os.path.basename(previous_file),
+                         'libreserver-bullseye-free_previous_beaglebone-'
+                         'armhf.img')
+        delta_file = builder.image_file + '.delta.zst'
+        create_delta.assert_called_once_with(previous_file,
+                                             builder.image_file, delta_file)
+        with open(delta_file + '.json') as file_handle:
+            info = json.load(file_handle)
+
+        self.assertEqual(info['source']['build_stamp'], '2021-01-01')
+        self.assertEqual(info['target']['build_stamp'], '2021-01-02')
+        with open(previous_file) as file_handle:
+            self.assertEqual(file_handle.read(), '2021-01-02')
+
+
+class TestFingerprint(unittest.TestCase):
+    """Test skipping builds whose inputs have not changed."""
+    def setUp(self):
+        """Common setup for each test."""
+        self.build_dir = tempfile.TemporaryDirectory()
+        patcher = patch(
+            'freedommaker.internal.InternalBuilderBackend.'
+            'get_fingerprint_inputs', return_value={'packages': ['a']})
+        self.backend_inputs = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """Cleanup the test case."""
+        self.build_dir.cleanup()
+
+    def get_builder(self, **kwargs):
+        """Return a builder for given arguments."""
+        arguments = dict(build_dir=self.build_dir.name, cache_dir=None,
+                         distribution='bullseye', build_stamp='2021-01-01',
+                         image_size='7800M', custom_package=None, jobs=4,
+                         hostname='libreserver')
+        arguments.update(kwargs)
+        return BeagleBoneImageBuilder(argparse.Namespace(**arguments))
+
+    def test_get_fingerprint(self):
+        """Test that only inputs affecting the images change fingerprint."""
+        fingerprint = self.get_builder().get_fingerprint()
+        self.assertEqual(self.get_builder(jobs=1).get_fingerprint(),
+                         fingerprint)
+        self.assertNotEqual(
+            self.get_builder(hostname='other').get_fingerprint(),
+            fingerprint)
+
+        self.backend_inputs.return_value = {'packages': ['b']}
+        self.assertNotEqual(self.get_builder().get_fingerprint(),
+                            fingerprint)
+
+    def test_get_fingerprint_custom_package(self):
+        """Test that contents of custom packages change fingerprint."""
+        package = os.path.join(self.build_dir.name, 'custom.deb')
+        with open(package, 'w') as file_handle:
+            file_handle.write('1')
+
+        builder = self.get_builder(custom_package=[package])
+        fingerprint = builder.get_fingerprint()
+        with open(package, 'w') as file_handle:
+            file_handle.write('2')
+
+        self.assertNotEqual(builder.get_fingerprint(), fingerprint)
+
+    def test_is_built(self):
+        """Test detecting images already built from the same inputs."""
+        builder = self.get_builder()
+        self.assertFalse(builder.is_built('abcd'))
+
+        archive_file = builder.image_file + '.xz'
+        builder.add_artifact(archive_file)
+        builder.write_fingerprint('abcd')
+        self.assertFalse(builder.is_built('abcd'))
+
+        open(archive_file, 'w').close()
+        self.assertTrue(builder.is_built('abcd'))
+        self.assertFalse(builder.is_built('efgh'))
+
+
+class TestBaseRootfs(unittest.TestCase):
+    """Test sharing base root file systems between boards."""
+    def setUp(self):
+        """Common setup for each test."""
+        self.build_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.build_dir.cleanup)
+        for name, value in (('get_release_checksum', 'release1'),
+                            ('copy_rootfs', None)):
+            patcher = patch('freedommaker.library.' + name,
+                            return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        patcher = patch(
+            'freedommaker.library.remove_chroot_directory',
+            side_effect=lambda directory: shutil.rmtree(directory, True))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch(
+            'freedommaker.internal.InternalBuilderBackend.'
+            '_get_libreserver_commit', return_value='commit1')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch(
+            'freedommaker.internal.InternalBuilderBackend._build_base_rootfs',
+            side_effect=os.makedirs)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_backend(self, **kwargs):
+        """Return the build backend of a board for given arguments."""
+        arguments = dict(build_dir=self.build_dir.name, cache_dir=None,
+                         distribution='bullseye', build_stamp='2021-01-01',
+                         image_size='7800M', custom_package=None, jobs=4,
+                         hostname='libreserver', package=None,
+                         release_component=None, disable_backports=False,
+                         build_mirror='http://deb.debian.org/debian')
+        arguments.update(kwargs)
+        builder = BeagleBoneImageBuilder(argparse.Namespace(**arguments))
+        return builder.builder_backends['internal']
+
+    def get_base_rootfs_names(self):
+        """Return the names of the base root file systems in the cache."""
+        directory = os.path.join(self.build_dir.name, 'cache', 'rootfs')
+        return sorted(name for name in os.listdir(directory)
+                      if os.path.isdir(os.path.join(directory, name)))
+
+    def test_board_packages(self):
+        """Test that packages of a board are not in the base."""
+        backend = self.get_backend(package=['extra'])
+        self.assertEqual(backend._get_base_rootfs_inputs(),
+                         self.get_backend()._get_base_rootfs_inputs())
+        self.assertIn('extra', backend._get_board_packages())
+        self.assertIn('u-boot', backend._get_board_packages())
+        self.assertNotIn('linux-image-armmp',
+                         backend._get_board_packages())
+
+    def test_prune_base_rootfs(self):
+        """Test that only superseded base root file systems are removed."""
+        backend = self.get_backend()
+        base_inputs = backend._get_base_rootfs_inputs()
+        other_inputs = dict(base_inputs, packages=['linux-image-armmp-lpae'])
+        with patch.object(backend, '_get_base_rootfs_inputs') as get_inputs:
+            get_inputs.return_value = base_inputs
+            base = os.path.basename(backend._copy_base_rootfs())
+            get_inputs.return_value = other_inputs
+            other = os.path.basename(backend._copy_base_rootfs())
+            self.assertEqual(self.get_base_rootfs_names(),
+                             sorted([base, other]))
+
+            get_inputs.return_value = dict(base_inputs,
+                                           build_mirror_release='release2')
+            updated = os.path.basename(backend._copy_base_rootfs())
+            self.assertEqual(self.get_base_rootfs_names(),
+                             sorted([other, updated]))
@@ -0,0 +1,118 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Tests for the deduplicating chunk store of images.
+"""
+
+import json
+import os
+import random
+import tempfile
+import unittest
+
+from .. import chunks
+
+
+class TestChunks(unittest.TestCase):
+    """Test splitting images into chunks and assembling them back."""
+    def setUp(self):
+        """Common setup for each test."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = os.path.join(self.directory.name, 'store')
+        self.random = random.Random(0)
+
+    def tearDown(self):
+        """Cleanup the test case."""
+        self.directory.cleanup()
+
+    def write_image(self, name, parts):
+        """Write an image made of given parts and return its path."""
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'wb') as file_handle:
+            for part in parts:
+                if isinstance(part, int):
+                    file_handle.seek(part, os.SEEK_CUR)
+                else:
+                    file_handle.write(part)
+
+            file_handle.truncate()
+
+        return path
+
+    def random_data(self, size):
+        """Return random bytes of given size."""
+        return bytes(self.random.getrandbits(8) for _ in range(size))
+
+    def test_chunk_boundaries(self):
+        """Test that chunks cover the image and respect size limits."""
+        data = self.random_data(1024 * 1024)
+        image = self.write_image('a.img', [data, 65536, data[:1000]])
+        result = list(chunks.iter_chunks(image))
+        offset = 0
+        for chunk_offset, size, chunk_data in result:
+            self.assertEqual(chunk_offset, offset)
+            offset += size
+            if chunk_data is not None:
+                self.assertEqual(len(chunk_data), size)
+                self.assertLessEqual(size,
+                                     chunks.MAX_BLOCKS * chunks.BLOCK_SIZE)
+
+        self.assertEqual(offset, os.path.getsize(image))
+        self.assertIn((1024 * 1024, 65536, None), result)
+
+    def test_shared_chunks(self):
+        """Test that common data in different images is stored once."""
+        common = self.random_data(1024 * 1024)
+        image1 = self.write_image('a.img', [self.random_data(8192), common])
+        image2 = self.write_image('b.img', [self.random_data(16384), common])
+        chunks.store_image(image1, self.store, image1 + '.chunks.json')
+        count = sum(len(files) for _, _, files in os.walk(self.store))
+        chunks.store_image(image2, self.store, image2 + '.chunks.json')
+        new_count = sum(len(files) for _, _, files in os.walk(self.store))
+        self.assertLess(new_count - count, count // 2)
+
+    def test_assemble_image(self):
+        """Test assembling an image from the store and a seed."""
+        common = self.random_data(512 * 1024)
+        image = self.write_image('a.img', [
+            self.random_data(8192), 1024 * 1024, common,
+            self.random_data(100)
+        ])
+        index = image + '.chunks.json'
+        chunks.store_image(image, self.store, index)
+        output = os.path.join(self.directory.name, 'out.img')
+        chunks.assemble_image(index, self.store, output)
+        with open(image, 'rb') as file1, open(output, 'rb') as file2:
+            self.assertEqual(file1.read(), file2.read())
+
+        # Chunks missing from store are taken from the seed
+        seed = self.write_image('seed.img', [common])
+        with open(index) as file_handle:
+            index_data = json.load(file_handle)
+
+        seed_ids = {
+            chunks.get_chunk_id(data)
+            for _, _, data in chunks.iter_chunks(seed) if data
+        }
+        for _, _, chunk_id in index_data['chunks']:
+            if chunk_id in seed_ids:
+                os.remove(
+                    os.path.join(self.store,
+                                 chunks._get_chunk_path(chunk_id)))
+
+        chunks.assemble_image(index, self.store, output, [seed])
+        with open(image, 'rb') as file1, open(output, 'rb') as file2:
+            self.assertEqual(file1.read(), file2.read())
+
+    def test_corrupt_chunk(self):
+        """Test that corrupt chunks in store are detected."""
+        image = self.write_image('a.img', [self.random_data(8192)])
+        chunks.store_image(image, self.store, image + '.chunks.json')
+        chunk_id = chunks.get_chunk_id(self.random_data(10))
+        path = os.path.join(self.store,
+                            chunks._get_chunk_path(chunk_id))
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as file_handle:
+            file_handle.write(chunks.lzma.compress(b'other'))
+
+        with self.assertRaises(ValueError):
+            chunks.read_chunk(self.store, chunk_id)
@@ -4,13 +4,15 @@ Tests for checking Freedom Maker's internal library of actions.
 """
 
 import contextlib
+import hashlib
+import json
 import os
 import random
 import stat
 import string
 import tempfile
 import unittest
-from unittest.mock import Mock, call, patch
+from unittest.mock import Mock, call, mock_open, patch
 
 from .. import library
 
@@ -92,6 +94,67 @@ class TestLibrary(unittest.TestCase):
         output = library.path_in_mount(self.state, '/boot')
         self.assertEqual(output, '/boot')
 
+    def test_path_in_root(self):
+        """Test that absolute paths are kept inside the mount point."""
+        output = library.path_in_root(self.state, '/etc/hosts')
+        self.assertEqual(output, self.state['mount_point'] + '/etc/hosts')
+
+    def test_write_file(self):
+        """Test writing a file inside the image."""
+        file_path = self.state['mount_point'] + '/usr/bin/test'
+        with self.assert_file_change(file_path, None, 'content\n'):
+            library.write_file(self.state, '/usr/bin/test', 'content\n',
+                               mode=0o755)
+
+        self.assertEqual(oct(os.stat(file_path)[stat.ST_MODE])[-3:], '755')
+
+        link_path = self.state['mount_point'] + '/tmp/link'
+        os.symlink(self.state['mount_point'] + '/tmp/target', link_path)
+        library.write_file(self.state, '/tmp/link', 'x')
+        self.assertFalse(os.path.islink(link_path))
+        self.assertFalse(os.path.exists(self.state['mount_point'] +
+                                        '/tmp/target'))
+
+    def test_append_and_edit_file(self):
+        """Test appending to and editing a file inside the image."""
+        file_path = self.state['mount_point'] + '/etc/crontab'
+        with self.assert_file_change(file_path, 'a\n', 'a\nb\n'):
+            library.append_to_file(self.state, '/etc/crontab', 'b\n')
+
+        with self.assert_file_change(file_path, 'a\n', 'A\n'):
+            library.edit_file(self.state, '/etc/crontab', str.upper)
+
+    def test_add_cron_in_chroot(self):
+        """Test adding a cron entry inside the image."""
+        file_path = self.state['mount_point'] + '/etc/crontab'
+        expected_content = '# crontab\n*/5 *   * * *   root    /bin/true\n'
+        with self.assert_file_change(file_path, '# crontab\n',
+                                     expected_content):
+            library.add_cron_in_chroot(self.state, 5, '/bin/true')
+
+    def test_make_symlink(self):
+        """Test creating a symbolic link inside the image."""
+        link_path = self.state['mount_point'] + '/etc/systemd/network/a.link'
+        library.make_symlink(self.state, '/dev/null',
+                             '/etc/systemd/network/a.link')
+        self.assertEqual(os.readlink(link_path), '/dev/null')
+
+        library.make_symlink(self.state, '/dev/zero',
+                             '/etc/systemd/network/a.link')
+        self.assertEqual(os.readlink(link_path), '/dev/zero')
+
+    def test_make_directory_and_remove_files(self):
+        """Test creating a directory and removing files in the image."""
+        directory = self.state['mount_point'] + '/var/lib/test'
+        library.make_directory(self.state, '/var/lib/test', 0o700)
+        self.assertEqual(oct(os.stat(directory)[stat.ST_MODE])[-3:], '700')
+
+        for name in ('key_1', 'key_2', 'other'):
+            open(os.path.join(directory, name), 'w').close()
+
+        library.remove_files(self.state, '/var/lib/test/key_*')
+        self.assertEqual(os.listdir(directory), ['other'])
+
     def test_schedule_clean(self):
         """Test scheduling cleanup jobs."""
         cleanup = Mock()
@@ -193,6 +256,64 @@ class TestLibrary(unittest.TestCase):
         run.assert_called_once_with(
             ['parted', '-s', self.image, 'mklabel', 'msdos'])
 
+    @patch('freedommaker.library.run')
+    def test_shrink_filesystem(self, run):
+        """Test shrinking a file system to its contents."""
+        mount_point = self.state['mount_point']
+        run.return_value = b'1048577 bytes (1.00MiB)\n'
+        library.shrink_filesystem(self.state, 'root', 'btrfs', 1024 * 1024)
+        self.assertEqual(run.call_args_list, [
+            call(['btrfs', 'inspect-internal', 'min-dev-size', mount_point]),
+            call([
+                'btrfs', 'filesystem', 'resize', str(3 * 1024 * 1024),
+                mount_point
+            ])
+        ])
+        self.assertEqual(self.state['filesystem_sizes'],
+                         {'root': 3 * 1024 * 1024})
+
+        run.reset_mock()
+        library.shrink_filesystem(self.state, 'root', 'ext4', 1024 * 1024)
+        self.state['success'] = False
+        library.shrink_filesystem(self.state, 'root', 'btrfs', 1024 * 1024)
+        run.assert_not_called()
+
+    @patch('freedommaker.library.run')
+    def test_shrink_image(self, run):
+        """Test shrinking the last partition and truncating the image."""
+        image_file = self.state['mount_point'] + '/image'
+        with open(image_file, 'wb') as file_handle:
+            file_handle.truncate(64 * 1024 * 1024)
+
+        self.state['image_file'] = image_file
+        self.state['partitions'] = ['boot', 'root']
+        self.state['filesystem_sizes'] = {'root': 10 * 1024 * 1024}
+        table = {
+            'partitiontable': {
+                'label': 'gpt',
+                'sectorsize': 512,
+                'partitions': [{'start': 8192}, {'start': 16384}]
+            }
+        }
+        run.return_value = json.dumps(table).encode()
+        library.shrink_image(self.state, 'root')
+        self.assertEqual(run.call_args_list, [
+            call(['sfdisk', '--json', image_file]),
+            call([
+                'sfdisk', '--no-reread', '--no-tell-kernel', '-N', '2',
+                image_file
+            ], feed_stdin=b',20480\n'),
+            call(['sfdisk', '--relocate', 'gpt-bak-std', image_file])
+        ])
+        self.assertEqual(os.path.getsize(image_file), 19 * 1024 * 1024)
+
+        run.reset_mock()
+        table['partitiontable']['label'] = 'dos'
+        run.return_value = json.dumps(table).encode()
+        library.shrink_image(self.state, 'root')
+        self.assertEqual(len(run.call_args_list), 2)
+        self.assertEqual(os.path.getsize(image_file), 18 * 1024 * 1024)
+
     @patch('freedommaker.library.run')
     def test_create_partition(self, run):
         """Test creating a partition table."""
@@ -203,6 +324,7 @@ class TestLibrary(unittest.TestCase):
         ])
 
         self.assertEqual(self.state['partitions'], ['root'])
+        self.assertEqual(self.state['first_partition_start'], 10 * 1024 * 1024)
 
         library.create_partition(self.state, 'root', '10mib', '50%', 'vfat')
         run.assert_called_with([
@@ -217,10 +339,12 @@ class TestLibrary(unittest.TestCase):
         run.assert_called_with(
             ['parted', '-s', self.image, 'set', '3', 'boot', 'on'])
 
+    @patch('freedommaker.loop_devices.attach')
     @patch('freedommaker.library.run')
-    def test_loopback_setup(self, run):
+    def test_loopback_setup(self, run, attach):
         """Test that loopback device is properly setup."""
         self.state['partitions'] = ['firmware', 'boot', 'root']
+        attach.return_value = '/dev/loop99'
 
         run.return_value = b'''remove x x
 add x loop99p1
@@ -229,7 +353,8 @@ add x loop99p3
 modify x x
 '''
         library.loopback_setup(self.state)
-        run.assert_called_with(['kpartx', '-asv', self.image])
+        attach.assert_called_once_with(self.image)
+        run.assert_called_with(['kpartx', '-asv', '/dev/loop99'])
         self.assertEqual(
             self.state['devices'], {
                 'firmware': '/dev/mapper/loop99p1',
@@ -239,7 +364,7 @@ modify x x
         self.assertEqual(self.state['loop_device'], '/dev/loop99')
         self.assertEqual(
             self.state['cleanup'],
-            [[library.force_release_loop_device, ('/dev/loop99', ), {}],
+            [[library.release_loop_device, ('/dev/loop99', ), {}],
              [
                  library.force_release_partition_loop,
                  ('/dev/mapper/loop99p1', ), {}
@@ -251,7 +376,7 @@ modify x x
              [
                  library.force_release_partition_loop,
                  ('/dev/mapper/loop99p3', ), {}
-             ], [library.loopback_teardown, (self.image, ), {}]])
+             ], [library.loopback_teardown, ('/dev/loop99', ), {}]])
 
     @staticmethod
     @patch('freedommaker.library.run')
@@ -262,12 +387,31 @@ modify x x
                                ignore_fail=True)
 
     @staticmethod
+    @patch('freedommaker.loop_devices.detach')
+    def test_release_loop_device(detach):
+        """Test loop device is released."""
+        library.release_loop_device('/dev/loop99')
+        detach.assert_called_once_with('/dev/loop99')
+
+    @staticmethod
+    @patch('freedommaker.loop_devices.detach')
+    @patch('freedommaker.loop_devices.get_stale_devices')
     @patch('freedommaker.library.run')
-    def test_force_release_loop_device(run):
-        """Test loop device is forcefully released."""
-        library.force_release_partition_loop('/dev/test/loop99')
-        run.assert_called_with(['dmsetup', 'remove', '/dev/test/loop99'],
-                               ignore_fail=True)
+    def test_reclaim_loop_devices(run, get_stale_devices, detach):
+        """Test releasing loop devices left behind by dead builds."""
+        get_stale_devices.return_value = ['/dev/loop98']
+        library.reclaim_loop_devices()
+        run.assert_called_once_with(['kpartx', '-dsv', '/dev/loop98'],
+                                    ignore_fail=True)
+        detach.assert_called_once_with('/dev/loop98')
+
+    @patch('freedommaker.loop_devices.get_leaked_devices')
+    def test_report_leaked_loop_devices(self, get_leaked_devices):
+        """Test recording leaked loop devices in the profile."""
+        get_leaked_devices.return_value = ['/dev/loop97']
+        library.report_leaked_loop_devices(self.state)
+        self.assertEqual(self.state['profile']['leaked_loop_devices'],
+                         ['/dev/loop97'])
 
     @staticmethod
     @patch('freedommaker.library.run')
@@ -286,6 +430,53 @@ modify x x
             call(['udevadm', 'settle'])
         ])
 
+    @patch('freedommaker.library.run')
+    def test_create_filesystem_uuid(self, run):
+        """Test creating filesystems with a given UUID."""
+        uuid = '01234567-89ab-cdef-0123-456789abcdef'
+        library.create_filesystem('/dev/test/loop99p1', 'btrfs', uuid)
+        library.create_filesystem('/dev/test/loop99p2', 'ext4', uuid)
+        library.create_filesystem('/dev/test/loop99p3', 'vfat', uuid)
+        self.assertEqual(run.call_args_list[0::3], [
+            call(['mkfs', '-t', 'btrfs', '-U', uuid, '/dev/test/loop99p1']),
+            call([
+                'mkfs', '-t', 'ext4', '-U', uuid, '-E', 'hash_seed=' + uuid,
+                '/dev/test/loop99p2'
+            ]),
+            call(['mkfs', '-t', 'vfat', '-i', '01234567',
+                  '/dev/test/loop99p3']),
+        ])
+
+    @patch('freedommaker.library.run')
+    def test_set_disk_identifiers(self, run):
+        """Test replacing the random identifiers of a partition table."""
+        self.state['partition_table_type'] = 'msdos'
+        self.state['partitions'] = ['boot', 'root']
+        disk_uuid = library.get_reproducible_uuid('seed', 'disk')
+        self.assertEqual(disk_uuid,
+                         library.get_reproducible_uuid('seed', 'disk'))
+        self.assertNotEqual(disk_uuid,
+                            library.get_reproducible_uuid('other', 'disk'))
+
+        library.set_disk_identifiers(self.state, 'seed')
+        run.assert_called_once_with(
+            ['sfdisk', '--disk-id', self.image, '0x' + disk_uuid[:8]])
+
+        run.reset_mock()
+        self.state['partition_table_type'] = 'gpt'
+        library.set_disk_identifiers(self.state, 'seed')
+        self.assertEqual(run.call_args_list, [
+            call(['sfdisk', '--disk-id', self.image, disk_uuid]),
+            call([
+                'sfdisk', '--part-uuid', self.image, '1',
+                library.get_reproducible_uuid('seed', 'partition/boot')
+            ]),
+            call([
+                'sfdisk', '--part-uuid', self.image, '2',
+                library.get_reproducible_uuid('seed', 'partition/root')
+            ]),
+        ])
+
     @patch('freedommaker.library.run')
     def test_mount_filesystem(self, run):
         """Test mounting a filesystem and setting proper state."""
@@ -329,23 +520,25 @@ modify x x
 
     @patch('freedommaker.library.run')
     def test_process_cleanup(self, run):
-        """Test cleaning up processes."""
-        library.process_cleanup(self.state)
+        """Test cleaning up processes until none remain."""
+        run.side_effect = [b' 1234 1235', b' 1236', b'']
+        with patch('time.sleep'):
+            library.process_cleanup(self.state)
+
         self.assertEqual(run.call_args_list, [
-            call(['fuser', '-mvk', self.state['mount_point']],
-                 ignore_fail=True),
             call(['fuser', '-mvk', self.state['mount_point']],
                  ignore_fail=True)
-        ])
+        ] * 3)
 
+    @patch('freedommaker.loop_devices.attach')
     @patch('freedommaker.library.run')
-    def test_setup_extra_storage(self, run):
+    def test_setup_extra_storage(self, run, attach):
         """Test that setting up extra storage works."""
         extra_storage_file = self.image + '.extra'
         size = '100M'
         mount_point = self.state['mount_point']
         loop_device = self.random_string()
-        run.return_value = f'{loop_device}\n'.encode()
+        attach.return_value = loop_device
 
         library.setup_extra_storage(self.state, 'ext4', '100M')
         run.assert_not_called()
@@ -354,7 +547,6 @@ modify x x
         run.assert_has_calls([
             call(['qemu-img', 'create', '-f', 'raw', extra_storage_file,
                   size]),
-            call(['losetup', '--show', '--find', extra_storage_file]),
             call(['btrfs', 'device', 'add', loop_device, mount_point])
         ])
 
@@ -363,8 +555,9 @@ modify x x
             (self.state, loop_device, extra_storage_file), {}
         ]])
 
+    @patch('freedommaker.loop_devices.detach')
     @patch('freedommaker.library.run')
-    def test_cleanup_extra_storage(self, run):
+    def test_cleanup_extra_storage(self, run, detach):
         """Test that extra storage will be cleaned properly."""
         extra_storage_file = self.image + '.extra'
         loop_device = self.random_string()
@@ -397,7 +590,6 @@ modify x x
             call(['btrfs', 'balance', 'start', '-mconvert=dup', mount_point],
                  ignore_fail=True),
             call(['btrfs', 'device', 'remove', loop_device, mount_point]),
-            call(['losetup', '--detach', loop_device]),
             call(['rm', '-f', extra_storage_file]),
             call(['btrfs', 'balance', 'start', '-musage=0', mount_point],
                  ignore_fail=True),
@@ -420,6 +612,7 @@ modify x x
             call(['btrfs', 'balance', 'start', '-dusage=80', mount_point],
                  ignore_fail=True),
         ])
+        detach.assert_called_once_with(loop_device)
 
     @patch('freedommaker.library.run')
     def test_qemu_debootstrap(self, run):
@@ -443,6 +636,213 @@ modify x x
                  }
              ]])
 
+    @patch('freedommaker.library.run')
+    def test_create_delta(self, run):
+        """Test creating a binary delta between two files."""
+        library.create_delta('/a.img', '/b.img', '/b.img.delta.zst')
+        run.assert_called_once_with([
+            'zstd', '-19', '--threads=0', '--long=31', '--force',
+            '--patch-from=/a.img', '/b.img', '-o', '/b.img.delta.zst'
+        ])
+
+    @patch('freedommaker.library.run')
+    def test_copy_file(self, run):
+        """Test copying a sparse file."""
+        library.copy_file('/a.img', '/b.img')
+        run.assert_called_once_with(
+            ['cp', '--sparse=always', '--reflink=auto', '/a.img', '/b.img'])
+
+    @patch('freedommaker.library.run')
+    def test_copy_rootfs(self, run):
+        """Test copying a base root file system into the mount point."""
+        library.copy_rootfs(self.state, '/var/cache/rootfs')
+        run.assert_called_once_with([
+            'cp', '--archive', '--reflink=auto', '/var/cache/rootfs/.',
+            self.state['mount_point']
+        ])
+
+    def test_get_mount_points(self):
+        """Test finding mount points below a directory."""
+        mounts = '/dev/sda1 / ext4 rw 0 0\n' \
+            'udev /cache/rootfs/a/dev devtmpfs rw 0 0\n' \
+            'devpts /cache/rootfs/a/dev/pts devpts rw 0 0\n' \
+            'proc /cache/rootfs/a\\040b/proc proc rw 0 0\n' \
+            'proc /cache/rootfs/ab/proc proc rw 0 0\n'
+        with patch('builtins.open', mock_open(read_data=mounts)):
+            self.assertEqual(library.get_mount_points('/cache/rootfs/a'), [
+                '/cache/rootfs/a/dev/pts', '/cache/rootfs/a/dev'
+            ])
+            self.assertEqual(library.get_mount_points('/cache/rootfs/a b'),
+                             ['/cache/rootfs/a b/proc'])
+
+    @patch('freedommaker.library.run')
+    def test_remove_chroot_directory(self, run):
+        """Test that mounts are released before removing a chroot."""
+        with tempfile.TemporaryDirectory() as directory:
+            chroot = os.path.join(directory, 'rootfs')
+            os.makedirs(os.path.join(chroot, 'dev'))
+            with patch('freedommaker.library.get_mount_points',
+                       side_effect=[[chroot + '/dev'], [chroot + '/dev']]):
+                with self.assertRaises(RuntimeError):
+                    library.remove_chroot_directory(chroot)
+
+            self.assertTrue(os.path.isdir(chroot))
+            run.assert_called_once_with(['umount', chroot + '/dev'],
+                                        ignore_fail=True)
+
+            with patch('freedommaker.library.get_mount_points',
+                       side_effect=[[chroot + '/dev'], []]):
+                library.remove_chroot_directory(chroot)
+
+            self.assertFalse(os.path.exists(chroot))
+
+    @patch('freedommaker.library.run')
+    def test_update_git_mirror(self, run):
+        """Test creating and updating a git mirror once per run."""
+        mirror = self.state['mount_point'] + '/tmp/cache/repo.git'
+        library.update_git_mirror('https://example.com/repo.git', mirror)
+        run.assert_called_once_with(
+            ['git', 'clone', '--mirror', 'https://example.com/repo.git',
+             mirror])
+
+        run.reset_mock()
+        library.update_git_mirror('https://example.com/repo.git', mirror)
+        run.assert_not_called()
+
+        library._updated_git_mirrors.discard(mirror)
+        os.makedirs(mirror)
+        library.update_git_mirror('https://example.com/repo.git', mirror)
+        self.assertEqual(run.call_args_list, [
+            call([
+                'git', '--git-dir', mirror, 'remote', 'set-url', 'origin',
+                'https://example.com/repo.git'
+            ]),
+            call(['git', '--git-dir', mirror, 'remote', 'update', '--prune'])
+        ])
+        library._updated_git_mirrors.discard(mirror)
+
+    @patch('freedommaker.library.run')
+    def test_get_git_commit(self, run):
+        """Test getting the commit of a branch in a mirror."""
+        run.return_value = b'0123abcd\n'
+        self.assertEqual(library.get_git_commit('/cache/repo.git', 'main'),
+                         '0123abcd')
+        run.assert_called_once_with([
+            'git', '--git-dir', '/cache/repo.git', 'rev-parse', '--verify',
+            'main^{commit}'
+        ])
+
+    def test_get_release_checksum(self):
+        """Test getting the checksum of a Release file once per run."""
+        mirror = self.state['mount_point'] + '/mirror'
+        release = mirror + '/dists/bullseye/Release'
+        os.makedirs(os.path.dirname(release))
+        with open(release, 'w') as file_handle:
+            file_handle.write('Suite: stable\n')
+
+        checksum = hashlib.sha256(b'Suite: stable\n').hexdigest()
+        self.assertEqual(
+            library.get_release_checksum('file://' + mirror, 'bullseye'),
+            checksum)
+
+        os.remove(release)
+        self.assertEqual(
+            library.get_release_checksum('file://' + mirror, 'bullseye'),
+            checksum)
+        library._release_checksums.clear()
+
+    @patch('freedommaker.library.run')
+    def test_clone_git_mirror(self, run):
+        """Test cloning a git mirror into the image."""
+        library.clone_git_mirror(self.state, '/cache/repo.git', 'main',
+                                 '/root/repo', 'https://example.com/repo.git')
+        destination = self.state['mount_point'] + '/root/repo'
+        self.assertEqual(run.call_args_list, [
+            call([
+                'git', 'clone', '--depth=1', '--branch', 'main',
+                '--single-branch', 'file:///cache/repo.git', destination
+            ]),
+            call([
+                'git', '-C', destination, 'remote', 'set-url', 'origin',
+                'https://example.com/repo.git'
+            ])
+        ])
+
+    @patch('freedommaker.library.run')
+    def test_archive_directory(self, run):
+        """Test archiving a directory and refusing empty ones."""
+        directory = self.state['mount_point'] + '/tmp'
+        with self.assertRaises(ValueError):
+            library.archive_directory(directory, '/cache/a.tar')
+
+        open(directory + '/file', 'w').close()
+        with patch('os.rename') as rename:
+            library.archive_directory(directory, '/cache/a.tar')
+            rename.assert_called_once_with('/cache/a.tar.temp', '/cache/a.tar')
+
+        run.assert_called_once_with([
+            'tar', '--create', '--numeric-owner', '--file',
+            '/cache/a.tar.temp', '--directory', directory, '.'
+        ])
+
+    @patch('freedommaker.library.run')
+    def test_extract_archive(self, run):
+        """Test extracting an archive into the image."""
+        library.extract_archive(self.state, '/cache/a.tar')
+        run.assert_called_once_with([
+            'tar', '--extract', '--numeric-owner', '--keep-directory-symlink',
+            '--no-overwrite-dir', '--file', '/cache/a.tar', '--directory',
+            self.state['mount_point']
+        ])
+
+    @patch('freedommaker.library.run')
+    def test_get_source_package_files(self, run):
+        """Test parsing the list of files of a source package."""
+        run.return_value = b'\n'.join([
+            b'Reading package lists...',
+            b"'http://deb.example.com/f/firmware_1.0-1.dsc' "
+            b'firmware_1.0-1.dsc 1234 SHA256:aaaa',
+            b"'http://deb.example.com/f/firmware_1.0.orig.tar.xz' "
+            b'firmware_1.0.orig.tar.xz 5678 SHA256:bbbb',
+        ])
+        files = library.get_source_package_files(self.state, 'firmware')
+        self.assertEqual(files, [
+            ('http://deb.example.com/f/firmware_1.0-1.dsc',
+             'firmware_1.0-1.dsc', 1234, 'SHA256:aaaa'),
+            ('http://deb.example.com/f/firmware_1.0.orig.tar.xz',
+             'firmware_1.0.orig.tar.xz', 5678, 'SHA256:bbbb'),
+        ])
+        run.assert_called_once_with([
+            'chroot', self.state['mount_point'], 'apt-get', 'source',
+            '--print-uris', '--quiet', 'firmware'
+        ])
+
+    def test_download_file(self):
+        """Test downloading a file and verifying its checksum."""
+        source = self.state['mount_point'] + '/tmp/source'
+        with open(source, 'wb') as file_handle:
+            file_handle.write(b'test')
+
+        path = self.state['mount_point'] + '/tmp/downloaded'
+        library.download_file(
+            'file://' + source, path, 'SHA256:9f86d081884c7d659a2feaa0c55ad0'
+            '15a3bf4f1b2b0b822cd15d6c15b0f00a08')
+        with open(path, 'rb') as file_handle:
+            self.assertEqual(file_handle.read(), b'test')
+
+        with self.assertRaises(ValueError):
+            library.download_file('file://' + source, path + '2',
+                                  'SHA256:0000')
+
+        self.assertFalse(os.path.exists(path + '2'))
+        self.assertFalse(os.path.exists(path + '2.temp'))
+
+    def test_lock_file(self):
+        """Test holding a lock on a file."""
+        lock_path = self.state['mount_point'] + '/tmp/test.lock'
+        with library.lock_file(lock_path):
+            self.assertTrue(os.path.isfile(lock_path))
+
     @patch('freedommaker.library.run')
     def test_qemu_remove_binary(self, run):
         """Test removing the qemu binary within the mount point."""
@@ -450,6 +850,21 @@ modify x x
         run.assert_called_with(
             ['rm', '-f', self.state['mount_point'] + '/usr/bin/qemu-*-static'])
 
+    @patch('os.sync')
+    def test_unsafe_io(self, sync):
+        """Test enabling and disabling unsafe I/O for dpkg."""
+        config_path = self.state['mount_point'] + \
+            '/etc/dpkg/dpkg.cfg.d/freedommaker-unsafe-io'
+        with self.assert_file_change(config_path, None, 'force-unsafe-io\n'):
+            library.enable_unsafe_io(self.state)
+
+        self.assertEqual(self.state['cleanup'],
+                         [[library.disable_unsafe_io, (self.state, ), {}]])
+
+        library.disable_unsafe_io(self.state)
+        self.assertFalse(os.path.exists(config_path))
+        sync.assert_called_once_with()
+
     def test_no_daemon_policy(self):
         """Test that no daemon run policy is properly set."""
         file_path = self.state['mount_point'] + '/usr/sbin/policy-rc.d'
@@ -487,6 +902,17 @@ modify x x
             call(self.state, ['apt', 'autoremove', '-y'])
         ])
 
+    @patch('freedommaker.library.run_in_chroot')
+    def test_install_packages(self, run):
+        """Test installing a list of packages at once."""
+        library.install_packages(self.state, ['u-boot', 'btrfs-progs'])
+        run.assert_called_once_with(
+            self.state, ['apt-get', 'install', '-y', 'u-boot', 'btrfs-progs'])
+        run.reset_mock()
+
+        library.install_packages(self.state, [])
+        run.assert_not_called()
+
     @patch('freedommaker.library.install_package')
     @patch('freedommaker.library.run_in_chroot')
     def test_install_custom_package(self, run, install_package):
@@ -616,6 +1042,131 @@ deb-src http://ftp.us.debian.org/debian unstable main contrib non-free
             library.setup_apt(self.state, 'http://ftp.us.debian.org/debian',
                               'unstable', ['main', 'contrib', 'non-free'])
 
+    @patch('freedommaker.library.run_in_chroot')
+    def test_setup_apt_unchanged(self, run):
+        """Test that apt cache is not updated for unchanged sources."""
+        lists_path = self.state['mount_point'] + '/var/lib/apt/lists'
+        os.makedirs(lists_path + '/partial')
+        library.setup_apt(self.state, 'http://deb.debian.org/debian', 'sid',
+                          ['main'])
+        open(lists_path + '/deb.debian.org_debian_dists_sid_InRelease',
+             'w').close()
+
+        run.reset_mock()
+        library.setup_apt(self.state, 'http://deb.debian.org/debian', 'sid',
+                          ['main'])
+        self.assertEqual(run.call_args_list,
+                         [call(self.state, ['apt-get', 'clean'])])
+
+        run.reset_mock()
+        library.setup_apt(self.state, 'http://ftp.us.debian.org/debian',
+                          'sid', ['main'], update=False)
+        self.assertEqual(run.call_args_list,
+                         [call(self.state, ['apt-get', 'clean'])])
+
+    @patch('freedommaker.library.run_in_chroot')
+    def test_setup_apt_security_mirror(self, run):
+        """Test setting up apt with a snapshot of the security archive."""
+        sources_path = self.state['mount_point'] + '/etc/apt/sources.list'
+        mirror = library.SNAPSHOT_MIRROR.format('20210101T000000Z')
+        security_mirror = library.SNAPSHOT_SECURITY_MIRROR.format(
+            '20210101T000000Z')
+        library.setup_apt(self.state, mirror, 'bullseye', ['main'],
+                          security_mirror=security_mirror)
+        with open(sources_path) as file_handle:
+            content = file_handle.read()
+
+        self.assertIn(
+            'deb https://snapshot.debian.org/archive/debian/20210101T000000Z/ '
+            'bullseye-updates main', content)
+        self.assertIn(
+            'deb https://snapshot.debian.org/archive/debian-security/'
+            '20210101T000000Z/ bullseye-security main', content)
+
+    def test_get_snapshot_id(self):
+        """Test resolving snapshots of the Debian archive."""
+        self.assertEqual(library.get_snapshot_id('20210101T000000Z'),
+                         '20210101T000000Z')
+        self.assertRegex(library.get_snapshot_id('now'),
+                         r'^\d{8}T\d{6}Z$')
+        with self.assertRaises(ValueError):
+            library.get_snapshot_id('2021-01-01')
+
+    def test_enable_snapshot_apt(self):
+        """Test allowing apt to use expired Release files of snapshots."""
+        config_path = self.state['mount_point'] + '/' + \
+            library.APT_SNAPSHOT_CONFIG
+        os.makedirs(os.path.dirname(config_path))
+        library.enable_snapshot_apt(self.state)
+        with open(config_path) as file_handle:
+            self.assertEqual(file_handle.read(),
+                             'Acquire::Check-Valid-Until "false";\n')
+
+        library.cleanup(self.state)
+        self.assertFalse(os.path.exists(config_path))
+
+    @patch('freedommaker.library.run')
+    def test_mount_local_mirror(self, run):
+        """Test bind mounting a local mirror into the image."""
+        library.mount_local_mirror(self.state, 'http://deb.debian.org/debian')
+        run.assert_not_called()
+
+        os.makedirs(self.state['mount_point'] + '/srv')
+        library.mount_local_mirror(self.state, 'file:///srv/mirror/debian')
+        mount_point = self.state['mount_point'] + '/srv/mirror/debian'
+        run.assert_called_once_with(
+            ['mount', '/srv/mirror/debian', mount_point, '-o', 'bind'])
+        self.assertTrue(os.path.isdir(mount_point))
+
+        library.cleanup(self.state)
+        self.assertFalse(
+            os.path.exists(self.state['mount_point'] + '/srv/mirror'))
+        self.assertTrue(os.path.isdir(self.state['mount_point'] + '/srv'))
+
+    def test_remove_volatile_files(self):
+        """Test removing files that differ between identical builds."""
+        mount_point = self.state['mount_point']
+        for path in ('etc/machine-id', 'var/log/dpkg.log',
+                     'var/log/apt/term.log', 'var/lib/dpkg/status-old',
+                     'var/lib/dpkg/status', 'var/lib/dbus/machine-id'):
+            os.makedirs(os.path.dirname(os.path.join(mount_point, path)),
+                        exist_ok=True)
+            with open(os.path.join(mount_point, path), 'w') as file_handle:
+                file_handle.write('data')
+
+        library.remove_volatile_files(self.state)
+        self.assertEqual(
+            os.path.getsize(os.path.join(mount_point, 'etc/machine-id')), 0)
+        for path in ('var/log/dpkg.log', 'var/log/apt/term.log',
+                     'var/lib/dpkg/status-old', 'var/lib/dbus/machine-id'):
+            self.assertFalse(os.path.exists(os.path.join(mount_point, path)))
+
+        self.assertTrue(
+            os.path.exists(os.path.join(mount_point, 'var/lib/dpkg/status')))
+
+    @patch('freedommaker.library.run')
+    def test_clamp_timestamps(self, run):
+        """Test clamping modification times in a file system."""
+        library.clamp_timestamps(self.state, 'boot/efi', 1609459200)
+        run.assert_called_once_with([
+            'find', self.state['mount_point'] + '/boot/efi', '-xdev',
+            '-newermt', '@1609459200', '-exec', 'touch', '--no-dereference',
+            '--date=@1609459200', '{}', '+'
+        ])
+
+    def test_remove_apt_lists(self):
+        """Test removing package lists from the image."""
+        lists_path = self.state['mount_point'] + '/var/lib/apt/lists'
+        os.makedirs(lists_path + '/partial')
+        for path in ('lock', 'x_InRelease', 'x_Packages', 'partial/y'):
+            open(os.path.join(lists_path, path), 'w').close()
+
+        self.assertTrue(library.has_apt_lists(self.state))
+        library.remove_apt_lists(self.state)
+        self.assertFalse(library.has_apt_lists(self.state))
+        self.assertEqual(sorted(os.listdir(lists_path)), ['lock', 'partial'])
+        self.assertEqual(os.listdir(lists_path + '/partial'), [])
+
     @patch('freedommaker.library.run_in_chroot')
     def test_setup_flash_kernel(self, run):
         """Test setting up flash kernel."""
@@ -649,22 +1200,81 @@ deb-src http://ftp.us.debian.org/debian unstable main contrib non-free
         self.assertEqual(run.call_args_list,
                          [call(self.state, ['update-initramfs', '-u'])])
 
-    @patch('freedommaker.library.run')
-    def test_install_boot_loader_path(self, run):
-        """Test installing boot loader components using dd."""
+    @patch('freedommaker.library.run_in_chroot')
+    def test_deferred_initramfs_updates(self, run):
+        """Test that initramfs updates are coalesced into one."""
+        config_path = self.state['mount_point'] + \
+            '/etc/initramfs-tools/update-initramfs.conf'
+        compress_path = self.state['mount_point'] + \
+            '/etc/initramfs-tools/conf.d/freedommaker-compress'
+        os.makedirs(os.path.dirname(config_path))
+        content = 'update_initramfs=yes\nbackup_initramfs=no\n'
+        with open(config_path, 'w') as file_handle:
+            file_handle.write(content)
+
+        with self.assert_file_change(
+                config_path, None,
+                'update_initramfs=no\nbackup_initramfs=no\n'):
+            library.defer_initramfs_updates(self.state)
+
+        self.assertEqual(self.state['cleanup'], [[
+            library.restore_initramfs_config, (self.state, ), {}
+        ]])
+
+        library.update_initramfs(self.state)
+        library.update_initramfs(self.state)
+        run.assert_not_called()
+
+        def check_compress(*args):
+            with open(compress_path, 'r') as file_handle:
+                self.assertEqual(file_handle.read(), 'COMPRESS=gzip\n')
+
+        run.side_effect = check_compress
+        with self.assert_file_change(config_path, None, content):
+            library.finish_initramfs_updates(self.state, compress='gzip')
+
+        self.assertEqual(run.call_args_list,
+                         [call(self.state, ['update-initramfs', '-u'])])
+        self.assertFalse(os.path.exists(compress_path))
+
+        run.reset_mock()
+        library.finish_initramfs_updates(self.state)
+        library.restore_initramfs_config(self.state)
+        run.assert_not_called()
+
+    def test_install_boot_loader_part(self):
+        """Test writing boot loader components onto the image."""
         path = 'u-boot/path'
-        full_path = self.state['mount_point'] + '/' + path
-        library.install_boot_loader_part(self.state, path, '533', '515')
-        run.assert_called_with([
-            'dd', 'if=' + full_path, 'of=' + self.image, 'seek=533', 'bs=515',
-            'conv=notrunc'
-        ])
+        os.makedirs(self.state['mount_point'] + '/u-boot')
+        with open(self.state['mount_point'] + '/' + path, 'wb') as file_handle:
+            file_handle.write(b'boot' * 256)
 
-        library.install_boot_loader_part(self.state, path, '533', '515', '90')
-        run.assert_called_with([
-            'dd', 'if=' + full_path, 'of=' + self.image, 'seek=533', 'bs=515',
-            'conv=notrunc', 'count=90'
-        ])
+        self.state['image_file'] = self.state['mount_point'] + '/image'
+        with open(self.state['image_file'], 'wb') as file_handle:
+            file_handle.truncate(64 * 1024)
+
+        self.state['first_partition_start'] = 16 * 1024
+        library.install_boot_loader_part(self.state, path, 8 * 1024)
+        with open(self.state['image_file'], 'rb') as file_handle:
+            data = file_handle.read()
+
+        self.assertEqual(len(data), 64 * 1024)
+        self.assertEqual(data[8 * 1024:9 * 1024], b'boot' * 256)
+        self.assertEqual(data[:8 * 1024], b'\0' * 8 * 1024)
+
+        with self.assertRaises(ValueError):
+            library.install_boot_loader_part(self.state, path, 8 * 1024,
+                                             max_size=512)
+
+        with self.assertRaises(ValueError):
+            library.install_boot_loader_part(self.state, path, 15 * 1024 + 1)
+
+        with self.assertRaises(ValueError):
+            library.install_boot_loader_part(self.state, path, 256)
+
+        self.state['partition_table_type'] = 'gpt'
+        with self.assertRaises(ValueError):
+            library.install_boot_loader_part(self.state, path, 1024)
 
     @patch('freedommaker.library.run')
     def test_fill_free_space_with_zeros(self, run):
@@ -0,0 +1,86 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Tests for the registry of loop devices allocated by builds.
+"""
+
+import json
+import os
+import struct
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from .. import loop_devices
+
+
+class TestLoopDevices(unittest.TestCase):
+    """Test the loop device registry."""
+    def setUp(self):
+        """Common setup for each test."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.registry_file = os.path.join(self.directory.name, 'loop.json')
+        patcher = patch('freedommaker.loop_devices.REGISTRY_FILE',
+                        self.registry_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """Cleanup the test case."""
+        self.directory.cleanup()
+
+    def write_registry(self, registry):
+        """Write the given registry contents."""
+        with open(self.registry_file, 'w') as file_handle:
+            json.dump(registry, file_handle)
+
+    def read_registry(self):
+        """Return the registry contents."""
+        with open(self.registry_file) as file_handle:
+            return json.load(file_handle)
+
+    def test_loop_info_size(self):
+        """Test that struct loop_info64 has the size expected by kernel."""
+        self.assertEqual(struct.calcsize(loop_devices.LOOP_INFO64_FORMAT),
+                         232)
+
+    @patch('freedommaker.loop_devices.get_backing_file')
+    @patch('freedommaker.loop_devices._is_process_alive')
+    def test_get_stale_devices(self, is_process_alive, get_backing_file):
+        """Test finding devices left behind by dead builds."""
+        self.write_registry({
+            '/dev/loop1': {'pid': 1, 'backing_file': '/a.img'},
+            '/dev/loop2': {'pid': 2, 'backing_file': '/b.img'},
+            '/dev/loop3': {'pid': 3, 'backing_file': '/c.img'},
+        })
+        is_process_alive.side_effect = lambda pid: pid == 1
+        get_backing_file.side_effect = {
+            '/dev/loop2': '/b.img',
+            '/dev/loop3': '/other.img',
+        }.get
+
+        self.assertEqual(loop_devices.get_stale_devices(), ['/dev/loop2'])
+        self.assertEqual(set(self.read_registry()),
+                         {'/dev/loop1', '/dev/loop2'})
+
+    @patch('freedommaker.loop_devices.get_backing_file')
+    def test_get_leaked_devices(self, get_backing_file):
+        """Test finding devices of this process still attached."""
+        pid = os.getpid()
+        self.write_registry({
+            '/dev/loop1': {'pid': pid, 'backing_file': '/a.img'},
+            '/dev/loop2': {'pid': pid, 'backing_file': '/b.img'},
+            '/dev/loop3': {'pid': pid + 1, 'backing_file': '/c.img'},
+        })
+        get_backing_file.side_effect = {'/dev/loop1': '/a.img'}.get
+
+        self.assertEqual(loop_devices.get_leaked_devices(), ['/dev/loop1'])
+        self.assertEqual(set(self.read_registry()),
+                         {'/dev/loop1', '/dev/loop3'})
+
+    def test_corrupt_registry(self):
+        """Test that an unreadable registry is treated as empty."""
+        with open(self.registry_file, 'w') as file_handle:
+            file_handle.write('{')
+
+        self.assertEqual(loop_devices.get_stale_devices(), [])
+        self.assertEqual(self.read_registry(), {})
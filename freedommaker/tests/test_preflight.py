@@ -0,0 +1,89 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Tests for the checks of the build host.
+"""
+
+import argparse
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+from .. import preflight
+from ..builders.beaglebone import BeagleBoneImageBuilder
+from ..builders.virtualbox_amd64 import VirtualBoxAmd64ImageBuilder
+
+
+class TestPreflight(unittest.TestCase):
+    """Test checking the build host before building."""
+    def setUp(self):
+        """Common setup for each test."""
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.arguments = argparse.Namespace(image_size='4G',
+                                            skip_compression=False,
+                                            sign=False, delta=True,
+                                            build_in_ram=True,
+                                            build_dir=self.cache_dir.name)
+
+    def tearDown(self):
+        """Cleanup the test case."""
+        self.cache_dir.cleanup()
+
+    def test_get_checks(self):
+        """Test that checks are collected for the selected builders."""
+        checks = preflight.get_checks(
+            [BeagleBoneImageBuilder, VirtualBoxAmd64ImageBuilder],
+            self.arguments)
+        names = [check.name for check in checks]
+        for name in ('root', 'command:kpartx', 'command:mkfs.btrfs',
+                     'command:mkfs.ext2', 'command:VBoxManage',
+                     'command:xz', 'command:zstd', 'binfmt:amd64',
+                     'binfmt:armhf',
+                     'filesystem:btrfs', 'loop-control', 'disk-space',
+                     'memory'):
+            self.assertIn(name, names)
+
+        self.assertNotIn('command:gpg', names)
+        disk_space = checks[names.index('disk-space')]
+        self.assertEqual(disk_space.args[1], (4096 + 1000) * 1024 * 1024)
+
+    def test_check_command(self):
+        """Test checking for commands."""
+        self.assertIsNone(preflight.check_command('sh'))
+        self.assertIn('not found',
+                      preflight.check_command('freedom-maker-missing'))
+
+    def test_check_disk_space(self):
+        """Test checking for free disk space."""
+        self.assertIsNone(
+            preflight.check_disk_space(self.cache_dir.name, 1))
+        self.assertIn(
+            'Not enough free space',
+            preflight.check_disk_space(self.cache_dir.name, 1 << 49))
+
+    def test_check_exception(self):
+        """Test that an exception in a check is reported as a failure."""
+        check = preflight.Check('test', Mock(side_effect=OSError('failed')))
+        self.assertEqual(check.run(), 'test: failed')
+
+    def test_run_checks_cache(self):
+        """Test that passed cacheable checks are not run again."""
+        passing = Mock(return_value=None)
+        failing = Mock(return_value='missing')
+        dynamic = Mock(return_value=None)
+        checks = [
+            preflight.Check('passing', passing),
+            preflight.Check('failing', failing),
+            preflight.Check('dynamic', dynamic, cacheable=False),
+        ]
+        self.assertEqual(preflight.run_checks(checks, self.cache_dir.name),
+                         ['missing'])
+        self.assertEqual(preflight.run_checks(checks, self.cache_dir.name),
+                         ['missing'])
+        self.assertEqual(passing.call_count, 1)
+        self.assertEqual(failing.call_count, 2)
+        self.assertEqual(dynamic.call_count, 2)
+
+        with patch('os.uname', return_value=('other', )):
+            preflight.run_checks(checks, self.cache_dir.name)
+
+        self.assertEqual(passing.call_count, 2)
@@ -0,0 +1,125 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Tests for the scheduler of build steps.
+"""
+
+import threading
+import unittest
+from unittest.mock import Mock
+
+from ..scheduler import Step, critical_path, run_steps, sort_steps
+
+
+class TestScheduler(unittest.TestCase):
+    """Test running build steps as a dependency graph."""
+    def setUp(self):
+        """Common setup for each test."""
+        self.order = []
+        self.lock = threading.Lock()
+
+    def record(self, name, event=None, wait=None):
+        """Return a step method that records its execution."""
+        def method():
+            if wait:
+                self.assertTrue(wait.wait(timeout=5))
+
+            with self.lock:
+                self.order.append(name)
+
+            if event:
+                event.set()
+
+        return method
+
+    def test_sequential_order(self):
+        """Test that with one job, declared order is kept."""
+        steps = [
+            Step('a', self.record('a')),
+            Step('b', self.record('b'), ['a']),
+            Step('c', self.record('c'), ['a']),
+            Step('d', self.record('d'), ['b', 'c']),
+        ]
+        run_steps(steps, jobs=1)
+        self.assertEqual(self.order, ['a', 'b', 'c', 'd'])
+
+    def test_parallel_steps(self):
+        """Test that independent steps run at the same time."""
+        b_started = threading.Event()
+        steps = [
+            Step('a', self.record('a')),
+            Step('b', self.record('b', event=b_started), ['a']),
+            Step('c', self.record('c', wait=b_started), ['a']),
+        ]
+        run_steps(steps, jobs=2)
+        self.assertEqual(self.order, ['a', 'b', 'c'])
+
+    def test_resources_are_exclusive(self):
+        """Test that steps sharing a resource don't run together."""
+        active = []
+
+        def method():
+            with self.lock:
+                active.append(1)
+                self.assertEqual(len(active), 1)
+
+            with self.lock:
+                active.pop()
+
+        steps = [Step(name, method, resources=['apt']) for name in 'abcd']
+        run_steps(steps, jobs=4)
+
+    def test_failure(self):
+        """Test that a failed step stops scheduling of dependent steps."""
+        after = Mock()
+        steps = [
+            Step('a', Mock(side_effect=RuntimeError('failed'))),
+            Step('b', after, ['a']),
+        ]
+        with self.assertRaises(RuntimeError):
+            run_steps(steps, jobs=2)
+
+        after.assert_not_called()
+
+    def test_invalid_graph(self):
+        """Test that unknown and cyclic requirements are rejected."""
+        with self.assertRaises(ValueError):
+            run_steps([Step('a', Mock(), ['x'])])
+
+        with self.assertRaises(ValueError):
+            run_steps([Step('a', Mock(), ['b']), Step('b', Mock(), ['a'])])
+
+        with self.assertRaises(ValueError):
+            run_steps([Step('a', Mock()), Step('a', Mock())])
+
+    def test_sort_steps(self):
+        """Test sorting steps by dependencies."""
+        steps = [Step('b', None, ['a']), Step('a', None)]
+        self.assertEqual([step.name for step in sort_steps(steps)],
+                         ['a', 'b'])
+
+    def test_critical_path(self):
+        """Test finding the longest chain of dependent steps."""
+        steps = [
+            Step('a', None),
+            Step('b', None, ['a']),
+            Step('c', None, ['a']),
+            Step('d', None, ['b', 'c']),
+        ]
+        profile = {
+            'steps': {
+                'a': {'duration': 1},
+                'b': {'duration': 5},
+                'c': {'duration': 2},
+                'd': {'duration': 1},
+            }
+        }
+        self.assertEqual(critical_path(steps, profile), (['a', 'b', 'd'], 7))
+
+    def test_profile(self):
+        """Test that timings are recorded in the profile."""
+        profile = {}
+        run_steps([Step('a', Mock()), Step('b', Mock(), ['a'])],
+                  profile=profile)
+        self.assertEqual(set(profile['steps']), {'a', 'b'})
+        self.assertEqual(profile['critical_path'], ['a', 'b'])
+        self.assertIn('duration', profile['steps']['a'])
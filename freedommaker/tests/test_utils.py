@@ -3,6 +3,8 @@
 Tests for miscellaneous utility methods.
 """
 
+import hashlib
+import tempfile
 import unittest
 
 from freedommaker import utils
@@ -23,6 +25,13 @@ class TestUtils(unittest.TestCase):
         self.assertRaises(ValueError, utils.add_disk_offsets, 'xMiB', '1MiB')
         self.assertRaises(ValueError, utils.add_disk_offsets, 'xMiB', 'xMiB')
 
+    def test_parse_disk_offset(self):
+        """Test parsing disk offsets."""
+        self.assertEqual(utils.parse_disk_offset('4MiB'), 4 * 1024 * 1024)
+        self.assertEqual(utils.parse_disk_offset('10mib'), 10 * 1024 * 1024)
+        self.assertRaises(NotImplementedError, utils.parse_disk_offset, '50%')
+        self.assertRaises(ValueError, utils.parse_disk_offset, 'xMiB')
+
     def test_parse_disk_size(self):
         """Test parsing disk sizes."""
         self.assertEqual(utils.parse_disk_size(0), 0)
@@ -65,3 +74,21 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(utils.add_disk_sizes('1G', '1K'), '1048577K')
         self.assertEqual(utils.add_disk_sizes('512M', '512M'), '1G')
         self.assertEqual(utils.add_disk_sizes('3800M', '1000M'), '4800M')
+
+    def test_get_fingerprint(self):
+        """Test hashing a set of inputs."""
+        fingerprint = utils.get_fingerprint({'a': 1, 'b': ['x', 'y']})
+        self.assertEqual(len(fingerprint), 64)
+        self.assertEqual(fingerprint,
+                         utils.get_fingerprint({'b': ['x', 'y'], 'a': 1}))
+        self.assertNotEqual(fingerprint,
+                            utils.get_fingerprint({'a': 1, 'b': ['y', 'x']}))
+
+    def test_get_file_checksum(self):
+        """Test hashing the contents of a file."""
+        with tempfile.NamedTemporaryFile() as file_handle:
+            file_handle.write(b'test' * 1024 * 1024)
+            file_handle.flush()
+            self.assertEqual(
+                utils.get_file_checksum(file_handle.name),
+                hashlib.sha256(b'test' * 1024 * 1024).hexdigest())
@@ -3,6 +3,8 @@
 Miscellaneous utilities that don't fit anywhere else.
 """
 
+import hashlib
+import json
 import re
 
 
@@ -22,6 +24,18 @@ def add_disk_offsets(offset1, offset2):
     return '{}MiB'.format(result)
 
 
+def parse_disk_offset(offset):
+    """Return offset in bytes for a disk offset as understood by parted.
+
+    Currently only offsets in MiB (or mib) are supported.
+
+    """
+    if not offset.lower().endswith('mib'):
+        raise NotImplementedError('Parsing anything but offsets in MiB')
+
+    return int(offset[:-len('MiB')]) * 1024 * 1024
+
+
 def parse_disk_size(input_size):
     """Return integer size for size strings like 1000M, 2G etc."""
     try:
@@ -58,3 +72,19 @@ def format_disk_size(size):
 def add_disk_sizes(size1, size2):
     """Add two string sizes represented as 1000M, 2G, etc."""
     return format_disk_size(parse_disk_size(size1) + parse_disk_size(size2))
+
+
+def get_fingerprint(inputs):
+    """Return a stable hash of a JSON serializable set of inputs."""
+    data = json.dumps(inputs, sort_keys=True).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_file_checksum(path):
+    """Return the sha256 hex digest of a file's contents."""
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as file_handle:
+        for data in iter(lambda: file_handle.read(1024 * 1024), b''):
+            checksum.update(data)
+
+    return checksum.hexdigest()
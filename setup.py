@@ -16,7 +16,10 @@ setuptools.setup(
     author_email='bob@libreserver.org',
     url='https://libreserver.org',
     packages=setuptools.find_packages(),
-    scripts=['bin/passwd-in-image', 'bin/vagrant-package'],
+    scripts=[
+        'bin/apply-image-delta', 'bin/assemble-image', 'bin/passwd-in-image',
+        'bin/vagrant-package'
+    ],
     entry_points={'console_scripts': ['freedom-maker = freedommaker:main']},
     test_suite='freedommaker.tests',
     license='COPYING',